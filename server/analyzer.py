@@ -1,58 +1,599 @@
+import argparse
 import http.server
 import socketserver
+import socket
+import signal
 import json
 import urllib.request
 import ssl
 import time
 import sqlite3
 import hashlib
+import math
 import random
 import threading
+import queue
+import heapq
+import atexit
+import cProfile
+import hmac
+import io
+import itertools
+import pstats
+import csv
+import ipaddress
+import mmap
+import struct
 from datetime import datetime, timedelta
 from urllib.parse import urlparse, parse_qs
 from http.client import HTTPResponse
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, List, Optional, Tuple
 import uuid
 import re
 import os
+import zlib
+import sys
+import base64
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import lru_cache
+from operator import itemgetter
 
-class TrafficAnalytics:
-    def __init__(self):
-        # Major countries and cities for region-wise analytics
-        self.major_countries = {
-            'US': {'name': 'United States', 'cities': ['New York', 'Los Angeles', 'Chicago', 'Houston', 'Phoenix', 'Philadelphia', 'San Antonio', 'San Diego', 'Dallas', 'San Jose']},
-            'CN': {'name': 'China', 'cities': ['Shanghai', 'Beijing', 'Guangzhou', 'Shenzhen', 'Chengdu', 'Tianjin', 'Chongqing', 'Nanjing', 'Wuhan', 'Xi\'an']},
-            'IN': {'name': 'India', 'cities': ['Mumbai', 'Delhi', 'Bangalore', 'Hyderabad', 'Chennai', 'Kolkata', 'Pune', 'Ahmedabad', 'Surat', 'Jaipur']},
-            'GB': {'name': 'United Kingdom', 'cities': ['London', 'Birmingham', 'Manchester', 'Glasgow', 'Liverpool', 'Leeds', 'Sheffield', 'Edinburgh', 'Bristol', 'Cardiff']},
-            'DE': {'name': 'Germany', 'cities': ['Berlin', 'Hamburg', 'Munich', 'Cologne', 'Frankfurt', 'Stuttgart', 'Düsseldorf', 'Dortmund', 'Essen', 'Leipzig']},
-            'FR': {'name': 'France', 'cities': ['Paris', 'Marseille', 'Lyon', 'Toulouse', 'Nice', 'Nantes', 'Strasbourg', 'Montpellier', 'Bordeaux', 'Lille']},
-            'JP': {'name': 'Japan', 'cities': ['Tokyo', 'Yokohama', 'Osaka', 'Nagoya', 'Sapporo', 'Fukuoka', 'Kobe', 'Kyoto', 'Kawasaki', 'Saitama']},
-            'BR': {'name': 'Brazil', 'cities': ['São Paulo', 'Rio de Janeiro', 'Brasília', 'Salvador', 'Fortaleza', 'Belo Horizonte', 'Manaus', 'Curitiba', 'Recife', 'Porto Alegre']},
-            'CA': {'name': 'Canada', 'cities': ['Toronto', 'Montreal', 'Vancouver', 'Calgary', 'Edmonton', 'Ottawa', 'Winnipeg', 'Quebec City', 'Hamilton', 'Kitchener']},
-            'AU': {'name': 'Australia', 'cities': ['Sydney', 'Melbourne', 'Brisbane', 'Perth', 'Adelaide', 'Gold Coast', 'Newcastle', 'Canberra', 'Sunshine Coast', 'Wollongong']},
-            'RU': {'name': 'Russia', 'cities': ['Moscow', 'Saint Petersburg', 'Novosibirsk', 'Yekaterinburg', 'Kazan', 'Nizhny Novgorod', 'Chelyabinsk', 'Samara', 'Omsk', 'Rostov']},
-            'KR': {'name': 'South Korea', 'cities': ['Seoul', 'Busan', 'Incheon', 'Daegu', 'Daejeon', 'Gwangju', 'Suwon', 'Ulsan', 'Changwon', 'Seongnam']},
-            'IT': {'name': 'Italy', 'cities': ['Rome', 'Milan', 'Naples', 'Turin', 'Palermo', 'Genoa', 'Bologna', 'Florence', 'Bari', 'Catania']},
-            'ES': {'name': 'Spain', 'cities': ['Madrid', 'Barcelona', 'Valencia', 'Seville', 'Zaragoza', 'Málaga', 'Murcia', 'Palma', 'Las Palmas', 'Bilbao']},
-            'MX': {'name': 'Mexico', 'cities': ['Mexico City', 'Guadalajara', 'Monterrey', 'Puebla', 'Tijuana', 'Ciudad Juárez', 'León', 'Zapopan', 'Nezahualcóyotl', 'Guadalupe']}
-        }
-        self.db_path = 'traffic_analytics.db'
-        self.init_database()
-        self.sessions = {}
-        self.heatmap_data = {}
-        self.conversion_funnels = {}
-        self.alerts = []
+try:
+    import numpy
+except ImportError:
+    # Optional: vectorized aggregation backend, see AGGREGATION_BACKENDS
+    numpy = None
+
+# Referrer hosts for the traffic source breakdown
+SEARCH_ENGINES = ('google.', 'bing.', 'yahoo.', 'duckduckgo.', 'baidu.', 'yandex.', 'ecosia.')
+SOCIAL_NETWORKS = ('facebook.', 'twitter.', 't.co', 'x.com', 'linkedin.', 'instagram.', 'reddit.',
+                   'youtube.', 'pinterest.', 'tiktok.')
+
+@lru_cache(maxsize=4096)
+def classify_source(referrer: Optional[str]) -> str:
+    """Map a referrer to Direct, Organic, Social, Paid or Referral"""
+    if not referrer or referrer == 'direct':
+        return 'Direct'
+    lowered = referrer.lower()
+    if 'utm_medium=cpc' in lowered or 'utm_medium=paid' in lowered or 'gclid=' in lowered:
+        return 'Paid'
+    host = urlparse(lowered if '//' in lowered else '//' + lowered).hostname or ''
+    if _host_matches(host, SEARCH_ENGINES):
+        return 'Organic'
+    if _host_matches(host, SOCIAL_NETWORKS):
+        return 'Social'
+    return 'Referral'
+
+def _host_matches(host: str, names) -> bool:
+    """Names ending in '.' match any TLD ("google." -> www.google.co.uk); others match the domain and its subdomains"""
+    for name in names:
+        if name.endswith('.'):
+            if host.startswith(name) or ('.' + name) in host:
+                return True
+        elif host == name or host.endswith('.' + name):
+            return True
+    return False
+
+# User agent classification; the first matching pattern wins. Tablets are
+# tested before phones because most tablet user agents also match a phone
+# pattern ("Android", "Mobile"), and browsers whose user agents name the
+# browsers they are built on go first. Patterns are matched against the
+# lowercased user agent; re.I makes alternations several times slower.
+BOT_PATTERN = re.compile(r'bot\b|crawl|spider|slurp|bingpreview|facebookexternalhit|headless|'
+                         r'curl/|wget/|python-requests|httpclient|okhttp')
+TABLET_PATTERN = re.compile(r'ipad|tablet|playbook|silk/|kindle|sm-t\d|android(?!.*mobile)')
+MOBILE_PATTERN = re.compile(r'mobi|iphone|ipod|android|blackberry|opera mini|windows phone|iemobile')
+BROWSER_PATTERNS = tuple((name, re.compile(pattern)) for name, pattern in (
+    ('Edge', r'edge?/|edg[ai]os/'),
+    ('Opera', r'opr/|opera'),
+    ('Samsung Internet', r'samsungbrowser/'),
+    ('Firefox', r'firefox/|fxios/'),
+    ('Chrome', r'chrome/|crios/|chromium/'),
+    ('Safari', r'safari/'),
+    ('Internet Explorer', r'msie |trident/')
+))
+OS_PATTERNS = tuple((name, re.compile(pattern)) for name, pattern in (
+    ('iOS', r'iphone|ipad|ipod'),
+    ('Android', r'android'),
+    ('Windows', r'windows'),
+    ('ChromeOS', r'cros'),
+    ('macOS', r'mac os x|macintosh'),
+    ('Linux', r'linux|x11')
+))
+
+@lru_cache(maxsize=8192)
+def classify_user_agent(user_agent: Optional[str]) -> Tuple[str, str, str]:
+    """Map a user agent to (device type, browser, OS); device type is Desktop, Mobile, Tablet, Bot or Other"""
+    if not user_agent:
+        return 'Other', 'Other', 'Other'
+    user_agent = user_agent.lower()
+    if BOT_PATTERN.search(user_agent):
+        device_type = 'Bot'
+    elif TABLET_PATTERN.search(user_agent):
+        device_type = 'Tablet'
+    elif MOBILE_PATTERN.search(user_agent):
+        device_type = 'Mobile'
+    else:
+        device_type = 'Desktop'
+    browser = next((name for name, pattern in BROWSER_PATTERNS if pattern.search(user_agent)), 'Other')
+    os_name = next((name for name, pattern in OS_PATTERNS if pattern.search(user_agent)), 'Other')
+    return device_type, browser, os_name
+
+# Device types every device_breakdown lists, even at zero
+DEVICE_TYPES = ('Desktop', 'Mobile', 'Tablet')
+
+def classify_device(user_agent: Optional[str]) -> str:
+    return classify_user_agent(user_agent)[0]
+
+# Duration percentiles. Values are counted into DDSketch bins: bin i holds
+# values in (gamma^(i-1), gamma^i], and reading a value back as its bin's
+# midpoint is off by at most DURATION_ACCURACY, relative, however skewed the
+# distribution. Bin counts simply add up, so every hour and day bucket stores
+# them and percentiles of any range can be read off the sum. The bins don't
+# depend on the metric, so other durations such as load times can share them.
+DURATION_ACCURACY = 0.02
+DURATION_GAMMA = (1 + DURATION_ACCURACY) / (1 - DURATION_ACCURACY)
+# Bin of zero and negative values, below every real bin
+DURATION_ZERO_BIN = -(1 << 15)
+
+def duration_bin(value: Optional[float]) -> Optional[int]:
+    """DDSketch bin of a duration; None for a missing one"""
+    if value is None:
+        return None
+    if value <= 0:
+        return DURATION_ZERO_BIN
+    return math.ceil(math.log(value) / math.log(DURATION_GAMMA))
+
+# Python functions callable from SQL on every pooled connection
+SQL_FUNCTIONS = {
+    'source_type': (1, classify_source),
+    'device_type': (1, classify_device),
+    'duration_bin': (1, duration_bin)
+}
+
+# Rollup tables as (table, bucket format, bucket width), finest first. Buckets
+# are stored in the same text format as the raw timestamps so they compare.
+ROLLUP_GRANULARITIES = (
+    ('rollup_minute', '%Y-%m-%d %H:%M:00', timedelta(minutes=1)),
+    ('rollup_hour', '%Y-%m-%d %H:00:00', timedelta(hours=1)),
+    ('rollup_day', '%Y-%m-%d 00:00:00', timedelta(days=1))
+)
+# Minute rollups only need to cover the longest dashboard range
+ROLLUP_MINUTE_RETENTION = timedelta(days=31)
+
+ROLLUP_COLUMNS = ('bucket, url, country_code, country_name, city, source_type, device_type, '
+                  'pageviews, bounces, time_on_page_sum')
+
+def rollup_table_sql(table: str) -> str:
+    return f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            bucket TEXT NOT NULL,
+            url TEXT NOT NULL,
+            country_code TEXT NOT NULL,
+            country_name TEXT NOT NULL,
+            city TEXT NOT NULL,
+            source_type TEXT NOT NULL,
+            device_type TEXT NOT NULL,
+            pageviews INTEGER NOT NULL,
+            bounces INTEGER NOT NULL,
+            time_on_page_sum INTEGER NOT NULL,
+            PRIMARY KEY (bucket, url, country_code, city, source_type, device_type)
+        ) WITHOUT ROWID
+    '''
+
+def backfill_rollups(conn: sqlite3.Connection, since: Optional[datetime] = None):
+    """Rebuild the rollup tables from the raw pageviews, only from since on if given"""
+    minute_cutoff = datetime.now() - ROLLUP_MINUTE_RETENTION
+    for table, bucket_format, _ in ROLLUP_GRANULARITIES:
+        start = since or ''
+        if table == 'rollup_minute':
+            start = max(since or minute_cutoff, minute_cutoff)
+        conn.execute(f'DELETE FROM {table} WHERE bucket >= ?', (start,))
+        conn.execute(f'''
+            INSERT INTO {table} ({ROLLUP_COLUMNS})
+            SELECT strftime('{bucket_format}', timestamp), COALESCE(url, ''), COALESCE(country_code, ''),
+                   MAX(COALESCE(country_name, '')), COALESCE(city, ''), source_type(referrer), device_type(user_agent),
+                   COUNT(*), SUM(CASE WHEN bounce = 1 THEN 1 ELSE 0 END), SUM(COALESCE(time_on_page, 0))
+            FROM pageviews
+            WHERE timestamp >= ?
+            GROUP BY 1, 2, 3, 5, 6, 7
+        ''', (start,))
+
+def add_rollup_device_type(conn: sqlite3.Connection):
+    """Recreate the rollups keyed by device type as well.
+    
+    Buckets that raw pageviews still cover are recounted from them; older
+    ones, whose raw rows were dropped by retention, keep their totals under
+    device type Other.
+    """
+    partitions = log_partitions(conn, 'pageview_log')
+    raw_start = partitions[0] if partitions else partition_start(datetime.now())
+    for table, _, _ in ROLLUP_GRANULARITIES:
+        conn.execute(f'ALTER TABLE {table} RENAME TO {table}_old')
+        conn.execute(rollup_table_sql(table))
+        conn.execute(f'''
+            INSERT INTO {table} ({ROLLUP_COLUMNS})
+            SELECT bucket, url, country_code, country_name, city, source_type, 'Other',
+                   pageviews, bounces, time_on_page_sum
+            FROM {table}_old WHERE bucket < ?
+        ''', (raw_start,))
+        conn.execute(f'DROP TABLE {table}_old')
+    backfill_rollups(conn, raw_start)
+
+def classify_user_agents(conn: sqlite3.Connection):
+    """Point every stored user agent at its devices row"""
+    user_agents = conn.execute('SELECT id, user_agent FROM user_agents WHERE device_id IS NULL').fetchall()
+    classified = {user_agent_id: classify_user_agent(user_agent) for user_agent_id, user_agent in user_agents}
+    conn.executemany('INSERT OR IGNORE INTO devices (device_type, browser, os) VALUES (?, ?, ?)',
+                     set(classified.values()))
+    device_ids = {tuple(row[1:]): row[0] for row in conn.execute('SELECT id, device_type, browser, os FROM devices')}
+    conn.executemany('UPDATE user_agents SET device_id = ? WHERE id = ?',
+                     [(device_ids[device], user_agent_id) for user_agent_id, device in classified.items()])
+
+def url_prefix_range(url: str) -> Tuple[str, str]:
+    """Half-open [low, high) string range holding every URL that starts with url"""
+    prefix = url.strip()
+    if prefix.endswith('/') and not prefix.endswith('://'):
+        prefix = prefix.rstrip('/')
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def backfill_urls(conn: sqlite3.Connection):
+    conn.execute("INSERT OR IGNORE INTO urls (url) SELECT DISTINCT url FROM pageviews WHERE url IS NOT NULL")
+
+def compact_history_tables(conn: sqlite3.Connection):
+    """Copy the uuid-keyed pageviews, events and heatmaps tables into the *_log tables, then drop them"""
+    conn.execute('''
+        INSERT OR IGNORE INTO urls (url)
+        SELECT url FROM pageviews WHERE url IS NOT NULL
+        UNION SELECT page_url FROM events WHERE page_url IS NOT NULL
+        UNION SELECT page_url FROM heatmaps WHERE page_url IS NOT NULL
+    ''')
+    conn.execute('INSERT OR IGNORE INTO user_agents (user_agent) SELECT DISTINCT user_agent FROM pageviews WHERE user_agent IS NOT NULL')
+    conn.execute('INSERT OR IGNORE INTO referrers (referrer) SELECT DISTINCT referrer FROM pageviews WHERE referrer IS NOT NULL')
+    conn.execute('''
+        INSERT OR IGNORE INTO cities (country_code, city, country_name, region)
+        SELECT country_code, city, MAX(country_name), MAX(region) FROM (
+            SELECT COALESCE(country_code, '') AS country_code, COALESCE(city, '') AS city,
+                   COALESCE(country_name, '') AS country_name, COALESCE(region, '') AS region
+            FROM pageviews
+            UNION ALL SELECT COALESCE(country_code, ''), COALESCE(city, ''), '', '' FROM events
+            UNION ALL SELECT COALESCE(country_code, ''), COALESCE(city, ''), '', '' FROM heatmaps
+        )
+        GROUP BY country_code, city
+    ''')
+    conn.execute('''
+        INSERT INTO pageview_log (session_id, url_id, timestamp, user_agent_id, ip_address, referrer_id,
+                                  time_on_page, bounce, city_id, latitude, longitude)
+        SELECT p.session_id, u.id, p.timestamp, a.id, p.ip_address, r.id,
+               p.time_on_page, p.bounce, c.id, p.latitude, p.longitude
+        FROM pageviews p
+        LEFT JOIN urls u ON u.url = p.url
+        LEFT JOIN user_agents a ON a.user_agent = p.user_agent
+        LEFT JOIN referrers r ON r.referrer = p.referrer
+        LEFT JOIN cities c ON c.country_code = COALESCE(p.country_code, '') AND c.city = COALESCE(p.city, '')
+    ''')
+    conn.execute('''
+        INSERT INTO event_log (session_id, event_type, event_data, timestamp, page_url_id, city_id)
+        SELECT e.session_id, e.event_type, e.event_data, e.timestamp, u.id, c.id
+        FROM events e
+        LEFT JOIN urls u ON u.url = e.page_url
+        LEFT JOIN cities c ON c.country_code = COALESCE(e.country_code, '') AND c.city = COALESCE(e.city, '')
+    ''')
+    conn.execute('''
+        INSERT INTO heatmap_log (page_url_id, x_coord, y_coord, event_type, timestamp, city_id)
+        SELECT u.id, h.x_coord, h.y_coord, h.event_type, h.timestamp, c.id
+        FROM heatmaps h
+        LEFT JOIN urls u ON u.url = h.page_url
+        LEFT JOIN cities c ON c.country_code = COALESCE(h.country_code, '') AND c.city = COALESCE(h.city, '')
+    ''')
+    for table in ('pageviews', 'events', 'heatmaps'):
+        conn.execute(f'DROP TABLE {table}')
+
+# Heatmap tile pyramid: cell edge in page pixels for each zoom level, finest
+# first. Points are counted per (page, level, hour, event type, country, city, cell).
+HEATMAP_CELL_SIZES = (4, 16, 64)
+HEATMAP_BUCKET_FORMAT = '%Y-%m-%d %H:00:00'
+# Largest grid get_heatmap_data returns; it zooms out, then crops long pages, to stay under it
+HEATMAP_MAX_CELLS = 32768
+
+HEATMAP_TILE_COLUMNS = 'page_url, level, bucket, event_type, country_code, city, cell_x, cell_y, count'
+
+def backfill_heatmap_tiles(conn: sqlite3.Connection):
+    """Rebuild every pyramid level from the raw heatmap points"""
+    conn.execute('DELETE FROM heatmap_tiles')
+    for level, cell_size in enumerate(HEATMAP_CELL_SIZES):
+        conn.execute(f'''
+            INSERT INTO heatmap_tiles ({HEATMAP_TILE_COLUMNS})
+            SELECT COALESCE(page_url, ''), ?, strftime('{HEATMAP_BUCKET_FORMAT}', timestamp),
+                   COALESCE(event_type, ''), COALESCE(country_code, ''), COALESCE(city, ''),
+                   MAX(CAST(x_coord AS INTEGER), 0) / {cell_size}, MAX(CAST(y_coord AS INTEGER), 0) / {cell_size},
+                   COUNT(*)
+            FROM heatmaps
+            WHERE x_coord IS NOT NULL AND y_coord IS NOT NULL
+              AND strftime('{HEATMAP_BUCKET_FORMAT}', timestamp) IS NOT NULL
+            GROUP BY 1, 3, 4, 5, 6, 7, 8
+        ''', (level,))
+
+def encode_grid(cells) -> Tuple[str, str, int]:
+    """Row-major counts as (dtype, base64 little-endian uint16 or uint32, largest count)"""
+    peak = int(cells.max()) if numpy is not None and isinstance(cells, numpy.ndarray) and cells.size else max(cells, default=0)
+    typecode, dtype = ('H', 'uint16') if peak < 65536 else ('I', 'uint32')
+    if numpy is not None and isinstance(cells, numpy.ndarray):
+        raw = cells.astype('<u2' if typecode == 'H' else '<u4').tobytes()
+    else:
+        grid = array(typecode, cells)
+        if sys.byteorder == 'big':
+            grid.byteswap()
+        raw = grid.tobytes()
+    return dtype, base64.b64encode(raw).decode('ascii'), peak
+
+# Result shaping for region and heatmap analytics. 'numpy' groups and bins with
+# vectorized bincounts; 'python' is the stdlib fallback; 'auto' picks numpy when
+# it is installed.
+AGGREGATION_BACKENDS = ('auto', 'python', 'numpy')
+
+def resolve_aggregation_backend(name: str) -> str:
+    if name not in AGGREGATION_BACKENDS:
+        raise ValueError(f"aggregation backend must be one of {', '.join(AGGREGATION_BACKENDS)}")
+    if name == 'numpy' and numpy is None:
+        raise ValueError('the numpy aggregation backend needs NumPy installed')
+    if name == 'auto':
+        return 'python' if numpy is None else 'numpy'
+    return name
+
+def bin_heatmap_cells(rows: List[Tuple], columns: int, grid_rows: int, backend: str = 'python') -> Dict[str, Tuple[int, object]]:
+    """(event_type, cell_x, cell_y, count) rows -> {event_type: (total, row-major grid)}.
+    
+    Totals include cells below grid_rows; the grids leave them out.
+    """
+    size = columns * grid_rows
+    if backend == 'numpy' and rows:
+        names, cell_x, cell_y, counts = zip(*rows)
+        labels, codes = numpy.unique(numpy.asarray(names), return_inverse=True)
+        codes = codes.ravel()
+        cell_x = numpy.asarray(cell_x, dtype=numpy.int64)
+        cell_y = numpy.asarray(cell_y, dtype=numpy.int64)
+        counts = numpy.asarray(counts, dtype=numpy.int64)
+        totals = numpy.bincount(codes, weights=counts, minlength=len(labels)).astype(numpy.int64)
+        inside = cell_y < grid_rows
+        flat = codes[inside] * size + cell_y[inside] * columns + cell_x[inside]
+        grids = numpy.bincount(flat, weights=counts[inside], minlength=len(labels) * size)
+        grids = grids.astype(numpy.int64).reshape(len(labels), size)
+        return {str(label): (int(totals[i]), grids[i]) for i, label in enumerate(labels)}
+    
+    grids, totals = {}, {}
+    for name, cell_x, cell_y, count in rows:
+        totals[name] = totals.get(name, 0) + count
+        if cell_y >= grid_rows:
+            continue
+        grid = grids.get(name)
+        if grid is None:
+            grid = grids[name] = [0] * size
+        grid[cell_y * columns + cell_x] += count
+    return {name: (total, grids.get(name) or [0] * size) for name, total in totals.items()}
+
+def group_region_rows(rows: List[Tuple], backend: str = 'python') -> Tuple[Dict, Dict, Dict, Dict]:
+    """Fold (country_code, country_name, city, source_type, device_type, pageviews, bounces, time_sum) rows.
+    
+    Returns ({(country_code, city): [country_name, pageviews, bounces, time_sum]},
+    {country_code: [country_name, pageviews]}, {source_type: pageviews}, {device_type: pageviews}).
+    """
+    if backend == 'numpy' and rows:
+        country, country_name, city, source, device, pageviews, bounces, time_sum = zip(*rows)
+        country = numpy.asarray([value or '' for value in country])
+        city = numpy.asarray([value or '' for value in city])
+        source = numpy.asarray([value or '' for value in source])
+        device = numpy.asarray([value or '' for value in device])
+        pageviews = numpy.asarray(pageviews, dtype=numpy.int64)
+        bounces = numpy.asarray(bounces, dtype=numpy.int64)
+        time_sum = numpy.asarray(time_sum, dtype=numpy.int64)
         
-    def init_database(self):
-        # Remove existing database to recreate with correct schema
-        if os.path.exists(self.db_path):
-            os.remove(self.db_path)
-            
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        def sums(codes, groups, weights):
+            return numpy.bincount(codes, weights=weights, minlength=groups).astype(numpy.int64)
+        
+        country_labels, country_first, country_codes = numpy.unique(country, return_index=True, return_inverse=True)
+        city_labels, city_codes = numpy.unique(city, return_inverse=True)
+        pair_labels, pair_first, pair_codes = numpy.unique(
+            country_codes.ravel() * len(city_labels) + city_codes.ravel(), return_index=True, return_inverse=True)
+        pair_codes, country_codes = pair_codes.ravel(), country_codes.ravel()
+        source_labels, source_codes = numpy.unique(source, return_inverse=True)
         
-        # Core analytics tables
-        cursor.execute('''
+        city_pageviews = sums(pair_codes, len(pair_labels), pageviews)
+        city_bounces = sums(pair_codes, len(pair_labels), bounces)
+        city_time = sums(pair_codes, len(pair_labels), time_sum)
+        cities = {
+            (str(country[first]), str(city[first])): [country_name[first], int(city_pageviews[i]),
+                                                      int(city_bounces[i]), int(city_time[i])]
+            for i, first in enumerate(pair_first)
+        }
+        country_pageviews = sums(country_codes, len(country_labels), pageviews)
+        countries = {str(label): [country_name[country_first[i]], int(country_pageviews[i])]
+                     for i, label in enumerate(country_labels)}
+        source_pageviews = sums(source_codes.ravel(), len(source_labels), pageviews)
+        sources = {str(label): int(source_pageviews[i]) for i, label in enumerate(source_labels)}
+        device_labels, device_codes = numpy.unique(device, return_inverse=True)
+        device_pageviews = sums(device_codes.ravel(), len(device_labels), pageviews)
+        devices = {str(label): int(device_pageviews[i]) for i, label in enumerate(device_labels)}
+        return cities, countries, sources, devices
+    
+    cities, countries, sources, devices = {}, {}, {}, {}
+    for row_country, row_country_name, row_city, source_type, device_type, pageviews, bounces, time_sum in rows:
+        sources[source_type] = sources.get(source_type, 0) + pageviews
+        devices[device_type] = devices.get(device_type, 0) + pageviews
+        totals = cities.setdefault((row_country, row_city), [row_country_name, 0, 0, 0])
+        totals[1] += pageviews
+        totals[2] += bounces
+        totals[3] += time_sum
+        country_totals = countries.setdefault(row_country, [row_country_name, 0])
+        country_totals[1] += pageviews
+    return cities, countries, sources, devices
+
+# Time partitions. pageview_log, event_log and heatmap_log are split into one
+# table per PARTITION_SPAN, named <log>_<YYYYMMDD> after the first day they
+# cover. Queries only read the partitions that overlap their time range, and
+# retention drops whole partitions instead of deleting rows.
+PARTITION_SPAN = timedelta(days=7)
+# A Monday, so weekly partitions run Monday to Monday
+PARTITION_EPOCH = datetime(1970, 1, 5)
+
+# Column definitions of each log table's partitions
+LOG_COLUMNS = {
+    'pageview_log': '''
+        id INTEGER PRIMARY KEY,
+        session_id TEXT,
+        url_id INTEGER,
+        timestamp DATETIME,
+        user_agent_id INTEGER,
+        ip_address TEXT,
+        referrer_id INTEGER,
+        time_on_page INTEGER,
+        bounce BOOLEAN,
+        city_id INTEGER,
+        latitude REAL,
+        longitude REAL
+    ''',
+    'event_log': '''
+        id INTEGER PRIMARY KEY,
+        session_id TEXT,
+        event_type TEXT,
+        event_data TEXT,
+        timestamp DATETIME,
+        page_url_id INTEGER,
+        city_id INTEGER
+    ''',
+    'heatmap_log': '''
+        id INTEGER PRIMARY KEY,
+        page_url_id INTEGER,
+        x_coord INTEGER,
+        y_coord INTEGER,
+        event_type TEXT,
+        timestamp DATETIME,
+        city_id INTEGER
+    '''
+}
+
+# Indexes created on every partition, as {log table: {name suffix: columns}}
+LOG_INDEXES = {
+    'pageview_log': {
+        'visitors': '(timestamp, session_id)',
+        'url_visitors': '(url_id, timestamp, session_id)',
+        'city_visitors': '(city_id, timestamp, session_id)'
+    },
+    'event_log': {
+        'timestamp': '(timestamp)',
+        'page': '(page_url_id, event_type)',
+        'session': '(session_id, timestamp)'
+    },
+    'heatmap_log': {
+        'page': '(page_url_id, event_type)'
+    }
+}
+
+# The views that keep the pre-log table names readable, as {log table: (view,
+# SELECT over one partition)}; the view is the UNION ALL over every partition
+LOG_VIEWS = {
+    'pageview_log': ('pageviews', '''
+        SELECT p.id, p.session_id, u.url, p.timestamp, a.user_agent, p.ip_address, r.referrer,
+               p.time_on_page, p.bounce, c.country_code, c.country_name, c.city, c.region,
+               p.latitude, p.longitude
+        FROM {table} p
+        LEFT JOIN urls u ON u.id = p.url_id
+        LEFT JOIN user_agents a ON a.id = p.user_agent_id
+        LEFT JOIN referrers r ON r.id = p.referrer_id
+        LEFT JOIN cities c ON c.id = p.city_id
+    '''),
+    'event_log': ('events', '''
+        SELECT e.id, e.session_id, e.event_type, e.event_data, e.timestamp, u.url AS page_url,
+               c.country_code, c.city
+        FROM {table} e
+        LEFT JOIN urls u ON u.id = e.page_url_id
+        LEFT JOIN cities c ON c.id = e.city_id
+    '''),
+    'heatmap_log': ('heatmaps', '''
+        SELECT h.id, u.url AS page_url, h.x_coord, h.y_coord, h.event_type, h.timestamp,
+               c.country_code, c.city
+        FROM {table} h
+        LEFT JOIN urls u ON u.id = h.page_url_id
+        LEFT JOIN cities c ON c.id = h.city_id
+    ''')
+}
+
+def partition_start(moment: datetime) -> datetime:
+    """First moment of the partition holding moment"""
+    return PARTITION_EPOCH + (moment - PARTITION_EPOCH) // PARTITION_SPAN * PARTITION_SPAN
+
+def log_partitions(conn: sqlite3.Connection, log: str) -> List[datetime]:
+    """Start of every existing partition of a log table, oldest first"""
+    starts = []
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?",
+                                (log + '_%',)):
+        try:
+            starts.append(datetime.strptime(name[len(log) + 1:], '%Y%m%d'))
+        except ValueError:
+            continue
+    return sorted(starts)
+
+def create_log_partition(conn: sqlite3.Connection, log: str, start: datetime) -> str:
+    table = f'{log}_{start:%Y%m%d}'
+    conn.execute(f'CREATE TABLE IF NOT EXISTS {table} ({LOG_COLUMNS[log]})')
+    for suffix, columns in LOG_INDEXES[log].items():
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_{suffix} ON {table} {columns}')
+    return table
+
+def create_log_view(conn: sqlite3.Connection, log: str):
+    """(Re)create the read-only view of a log table over its current partitions.
+    
+    The views have no INSERT triggers: rows are written through the ingest
+    queue (TrafficAnalytics.track_* or IngestQueue.put), which encodes them and
+    routes each to its partition.
+    """
+    view, select = LOG_VIEWS[log]
+    conn.execute(f'DROP VIEW IF EXISTS {view}')
+    conn.execute(f'CREATE VIEW {view} AS ' + ' UNION ALL '.join(
+        select.format(table=f'{log}_{start:%Y%m%d}') for start in log_partitions(conn, log)))
+
+def partition_log_tables(conn: sqlite3.Connection):
+    """Split the unpartitioned *_log tables into partitions; rows without a readable timestamp are dropped"""
+    for log in LOG_COLUMNS:
+        # Dropping the view drops its INSTEAD OF INSERT trigger too
+        conn.execute(f'DROP VIEW IF EXISTS {LOG_VIEWS[log][0]}')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{log}_partitioning ON {log} (timestamp)')
+        starts = {partition_start(datetime.now())}
+        for (day,) in conn.execute(f'SELECT DISTINCT substr(timestamp, 1, 10) FROM {log}'):
+            try:
+                starts.add(partition_start(datetime.strptime(str(day), '%Y-%m-%d')))
+            except ValueError:
+                continue
+        for start in sorted(starts):
+            table = create_log_partition(conn, log, start)
+            conn.execute(f'INSERT INTO {table} SELECT * FROM {log} WHERE timestamp >= ? AND timestamp < ?',
+                         (start, start + PARTITION_SPAN))
+        conn.execute(f'DROP TABLE {log}')
+        create_log_view(conn, log)
+
+def backfill_rollups_v3(conn: sqlite3.Connection):
+    """Migration 3's backfill, into the rollup shape of that step"""
+    minute_cutoff = datetime.now() - ROLLUP_MINUTE_RETENTION
+    for table, bucket_format, _ in ROLLUP_GRANULARITIES:
+        conn.execute(f'''
+            INSERT INTO {table} (bucket, url, country_code, country_name, city, source_type,
+                                 pageviews, bounces, time_on_page_sum)
+            SELECT strftime('{bucket_format}', timestamp), COALESCE(url, ''), COALESCE(country_code, ''),
+                   MAX(COALESCE(country_name, '')), COALESCE(city, ''), source_type(referrer),
+                   COUNT(*), SUM(CASE WHEN bounce = 1 THEN 1 ELSE 0 END), SUM(COALESCE(time_on_page, 0))
+            FROM pageviews
+            WHERE timestamp >= ?
+            GROUP BY 1, 2, 3, 5, 6
+        ''', (minute_cutoff if table == 'rollup_minute' else '',))
+
+# Schema migrations as (version, description, statements), applied in order by
+# TrafficAnalytics.migrate(). Never edit a released step; append a new one.
+MIGRATIONS = [
+    (1, 'core analytics tables', [
+        '''
             CREATE TABLE IF NOT EXISTS pageviews (
                 id TEXT PRIMARY KEY,
                 session_id TEXT,
@@ -70,9 +611,8 @@ class TrafficAnalytics:
                 latitude REAL,
                 longitude REAL
             )
-        ''')
-        
-        cursor.execute('''
+        ''',
+        '''
             CREATE TABLE IF NOT EXISTS sessions (
                 id TEXT PRIMARY KEY,
                 start_time DATETIME,
@@ -91,9 +631,8 @@ class TrafficAnalytics:
                 latitude REAL,
                 longitude REAL
             )
-        ''')
-        
-        cursor.execute('''
+        ''',
+        '''
             CREATE TABLE IF NOT EXISTS events (
                 id TEXT PRIMARY KEY,
                 session_id TEXT,
@@ -104,9 +643,8 @@ class TrafficAnalytics:
                 country_code TEXT,
                 city TEXT
             )
-        ''')
-        
-        cursor.execute('''
+        ''',
+        '''
             CREATE TABLE IF NOT EXISTS traffic_sources (
                 id TEXT PRIMARY KEY,
                 session_id TEXT,
@@ -119,9 +657,8 @@ class TrafficAnalytics:
                 country_code TEXT,
                 city TEXT
             )
-        ''')
-        
-        cursor.execute('''
+        ''',
+        '''
             CREATE TABLE IF NOT EXISTS seo_metrics (
                 id TEXT PRIMARY KEY,
                 url TEXT,
@@ -132,28 +669,2845 @@ class TrafficAnalytics:
                 timestamp DATETIME,
                 country_code TEXT
             )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS heatmaps (
+                id TEXT PRIMARY KEY,
+                page_url TEXT,
+                x_coord INTEGER,
+                y_coord INTEGER,
+                event_type TEXT,
+                timestamp DATETIME,
+                country_code TEXT,
+                city TEXT
+            )
+        '''
+    ]),
+    (2, 'indexes for the dashboard queries', [
+        'CREATE INDEX IF NOT EXISTS idx_pageviews_timestamp ON pageviews (timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_pageviews_region ON pageviews (country_code, city, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_pageviews_url ON pageviews (url, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_events_timestamp ON events (timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_events_page ON events (page_url, event_type)',
+        'CREATE INDEX IF NOT EXISTS idx_events_session ON events (session_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_traffic_sources_timestamp ON traffic_sources (timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_traffic_sources_region ON traffic_sources (country_code, city, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_heatmaps_page ON heatmaps (page_url, event_type)'
+    ]),
+    # The rollups as first released; step 10 rebuilds them keyed by device type too
+    (3, 'minute, hourly and daily pageview rollups', [
+        *[f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                bucket TEXT NOT NULL,
+                url TEXT NOT NULL,
+                country_code TEXT NOT NULL,
+                country_name TEXT NOT NULL,
+                city TEXT NOT NULL,
+                source_type TEXT NOT NULL,
+                pageviews INTEGER NOT NULL,
+                bounces INTEGER NOT NULL,
+                time_on_page_sum INTEGER NOT NULL,
+                PRIMARY KEY (bucket, url, country_code, city, source_type)
+            ) WITHOUT ROWID
+        ''' for table, _, _ in ROLLUP_GRANULARITIES],
+        backfill_rollups_v3
+    ]),
+    (4, 'normalized URL dictionary', [
+        '''
+            CREATE TABLE IF NOT EXISTS urls (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL UNIQUE
+            )
+        ''',
+        backfill_urls,
+        # Lets the unique-visitor pass read session ids straight from the index
+        'CREATE INDEX IF NOT EXISTS idx_pageviews_visitors ON pageviews (timestamp, session_id)'
+    ]),
+    (5, 'heatmap tile pyramid', [
+        '''
+            CREATE TABLE IF NOT EXISTS heatmap_tiles (
+                page_url TEXT NOT NULL,
+                level INTEGER NOT NULL,
+                bucket TEXT NOT NULL,
+                event_type TEXT NOT NULL,
+                country_code TEXT NOT NULL,
+                city TEXT NOT NULL,
+                cell_x INTEGER NOT NULL,
+                cell_y INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (page_url, level, bucket, event_type, country_code, city, cell_x, cell_y)
+            ) WITHOUT ROWID
+        ''',
+        backfill_heatmap_tiles
+    ]),
+    (6, 'covering index for regional unique visitors', [
+        # Supersedes idx_pageviews_region; COUNT(DISTINCT session_id) per region reads only the index
+        'CREATE INDEX IF NOT EXISTS idx_pageviews_region_visitors ON pageviews (country_code, city, timestamp, session_id)',
+        'DROP INDEX IF EXISTS idx_pageviews_region'
+    ]),
+    (7, 'integer row keys and interned dimension tables', [
+        # Dimension strings are stored once and referenced by id; ids are never
+        # reused, so processes can cache them (see DimensionTable)
+        '''
+            CREATE TABLE IF NOT EXISTS user_agents (
+                id INTEGER PRIMARY KEY,
+                user_agent TEXT NOT NULL UNIQUE
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS referrers (
+                id INTEGER PRIMARY KEY,
+                referrer TEXT NOT NULL UNIQUE
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS cities (
+                id INTEGER PRIMARY KEY,
+                country_code TEXT NOT NULL,
+                city TEXT NOT NULL,
+                country_name TEXT NOT NULL,
+                region TEXT NOT NULL,
+                UNIQUE (country_code, city)
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS pageview_log (
+                id INTEGER PRIMARY KEY,
+                session_id TEXT,
+                url_id INTEGER,
+                timestamp DATETIME,
+                user_agent_id INTEGER,
+                ip_address TEXT,
+                referrer_id INTEGER,
+                time_on_page INTEGER,
+                bounce BOOLEAN,
+                city_id INTEGER,
+                latitude REAL,
+                longitude REAL
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS event_log (
+                id INTEGER PRIMARY KEY,
+                session_id TEXT,
+                event_type TEXT,
+                event_data TEXT,
+                timestamp DATETIME,
+                page_url_id INTEGER,
+                city_id INTEGER
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS heatmap_log (
+                id INTEGER PRIMARY KEY,
+                page_url_id INTEGER,
+                x_coord INTEGER,
+                y_coord INTEGER,
+                event_type TEXT,
+                timestamp DATETIME,
+                city_id INTEGER
+            )
+        ''',
+        compact_history_tables,
+        # The old table names live on as views with the old columns, so queries
+        # that read them keep working; the dashboard reads the log tables directly
+        '''
+            CREATE VIEW pageviews AS
+            SELECT p.id, p.session_id, u.url, p.timestamp, a.user_agent, p.ip_address, r.referrer,
+                   p.time_on_page, p.bounce, c.country_code, c.country_name, c.city, c.region,
+                   p.latitude, p.longitude
+            FROM pageview_log p
+            LEFT JOIN urls u ON u.id = p.url_id
+            LEFT JOIN user_agents a ON a.id = p.user_agent_id
+            LEFT JOIN referrers r ON r.id = p.referrer_id
+            LEFT JOIN cities c ON c.id = p.city_id
+        ''',
+        '''
+            CREATE VIEW events AS
+            SELECT e.id, e.session_id, e.event_type, e.event_data, e.timestamp, u.url AS page_url,
+                   c.country_code, c.city
+            FROM event_log e
+            LEFT JOIN urls u ON u.id = e.page_url_id
+            LEFT JOIN cities c ON c.id = e.city_id
+        ''',
+        '''
+            CREATE VIEW heatmaps AS
+            SELECT h.id, u.url AS page_url, h.x_coord, h.y_coord, h.event_type, h.timestamp,
+                   c.country_code, c.city
+            FROM heatmap_log h
+            LEFT JOIN urls u ON u.id = h.page_url_id
+            LEFT JOIN cities c ON c.id = h.city_id
+        ''',
+        # Let inserts into the views reach the log tables until step 8, which
+        # partitions the logs and leaves the views read-only; the ingest queue
+        # writes the log tables directly
+        '''
+            CREATE TRIGGER pageviews_insert INSTEAD OF INSERT ON pageviews
+            BEGIN
+                INSERT OR IGNORE INTO urls (url) SELECT NEW.url WHERE NEW.url IS NOT NULL;
+                INSERT OR IGNORE INTO user_agents (user_agent) SELECT NEW.user_agent WHERE NEW.user_agent IS NOT NULL;
+                INSERT OR IGNORE INTO referrers (referrer) SELECT NEW.referrer WHERE NEW.referrer IS NOT NULL;
+                INSERT OR IGNORE INTO cities (country_code, city, country_name, region)
+                VALUES (COALESCE(NEW.country_code, ''), COALESCE(NEW.city, ''),
+                        COALESCE(NEW.country_name, ''), COALESCE(NEW.region, ''));
+                INSERT INTO pageview_log (id, session_id, url_id, timestamp, user_agent_id, ip_address, referrer_id,
+                                          time_on_page, bounce, city_id, latitude, longitude)
+                VALUES (CASE WHEN typeof(NEW.id) = 'integer' THEN NEW.id END, NEW.session_id,
+                        (SELECT id FROM urls WHERE url = NEW.url), NEW.timestamp,
+                        (SELECT id FROM user_agents WHERE user_agent = NEW.user_agent), NEW.ip_address,
+                        (SELECT id FROM referrers WHERE referrer = NEW.referrer), NEW.time_on_page, NEW.bounce,
+                        (SELECT id FROM cities WHERE country_code = COALESCE(NEW.country_code, '')
+                                                 AND city = COALESCE(NEW.city, '')),
+                        NEW.latitude, NEW.longitude);
+            END
+        ''',
+        '''
+            CREATE TRIGGER events_insert INSTEAD OF INSERT ON events
+            BEGIN
+                INSERT OR IGNORE INTO urls (url) SELECT NEW.page_url WHERE NEW.page_url IS NOT NULL;
+                INSERT OR IGNORE INTO cities (country_code, city, country_name, region)
+                VALUES (COALESCE(NEW.country_code, ''), COALESCE(NEW.city, ''), '', '');
+                INSERT INTO event_log (id, session_id, event_type, event_data, timestamp, page_url_id, city_id)
+                VALUES (CASE WHEN typeof(NEW.id) = 'integer' THEN NEW.id END, NEW.session_id, NEW.event_type,
+                        NEW.event_data, NEW.timestamp, (SELECT id FROM urls WHERE url = NEW.page_url),
+                        (SELECT id FROM cities WHERE country_code = COALESCE(NEW.country_code, '')
+                                                 AND city = COALESCE(NEW.city, '')));
+            END
+        ''',
+        '''
+            CREATE TRIGGER heatmaps_insert INSTEAD OF INSERT ON heatmaps
+            BEGIN
+                INSERT OR IGNORE INTO urls (url) SELECT NEW.page_url WHERE NEW.page_url IS NOT NULL;
+                INSERT OR IGNORE INTO cities (country_code, city, country_name, region)
+                VALUES (COALESCE(NEW.country_code, ''), COALESCE(NEW.city, ''), '', '');
+                INSERT INTO heatmap_log (id, page_url_id, x_coord, y_coord, event_type, timestamp, city_id)
+                VALUES (CASE WHEN typeof(NEW.id) = 'integer' THEN NEW.id END,
+                        (SELECT id FROM urls WHERE url = NEW.page_url), NEW.x_coord, NEW.y_coord,
+                        NEW.event_type, NEW.timestamp,
+                        (SELECT id FROM cities WHERE country_code = COALESCE(NEW.country_code, '')
+                                                 AND city = COALESCE(NEW.city, '')));
+            END
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_pageview_log_visitors ON pageview_log (timestamp, session_id)',
+        'CREATE INDEX IF NOT EXISTS idx_pageview_log_url_visitors ON pageview_log (url_id, timestamp, session_id)',
+        'CREATE INDEX IF NOT EXISTS idx_pageview_log_city_visitors ON pageview_log (city_id, timestamp, session_id)',
+        'CREATE INDEX IF NOT EXISTS idx_event_log_timestamp ON event_log (timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_event_log_page ON event_log (page_url_id, event_type)',
+        'CREATE INDEX IF NOT EXISTS idx_event_log_session ON event_log (session_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_heatmap_log_page ON heatmap_log (page_url_id, event_type)'
+    ]),
+    (8, 'weekly partitions of the log tables', [
+        partition_log_tables
+    ]),
+    (9, 'conversion funnel state', [
+        # Filled in by FunnelTracker.sync() at startup, from the configured definitions
+        '''
+            CREATE TABLE IF NOT EXISTS funnel_definitions (
+                name TEXT PRIMARY KEY,
+                definition TEXT NOT NULL,
+                built_at DATETIME
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS funnel_progress (
+                funnel TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                opened_at DATETIME NOT NULL,
+                step INTEGER NOT NULL,
+                PRIMARY KEY (funnel, session_id)
+            ) WITHOUT ROWID
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS funnel_counts (
+                funnel TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                step INTEGER NOT NULL,
+                sessions INTEGER NOT NULL,
+                PRIMARY KEY (funnel, bucket, step)
+            ) WITHOUT ROWID
+        '''
+    ]),
+    (10, 'user agent classification', [
+        '''
+            CREATE TABLE IF NOT EXISTS devices (
+                id INTEGER PRIMARY KEY,
+                device_type TEXT NOT NULL,
+                browser TEXT NOT NULL,
+                os TEXT NOT NULL,
+                UNIQUE (device_type, browser, os)
+            )
+        ''',
+        'ALTER TABLE user_agents ADD COLUMN device_id INTEGER',
+        classify_user_agents,
+        add_rollup_device_type
+    ]),
+    # Filled by VisitorSketches.sync() at startup
+    (11, 'unique visitor sketches', [
+        '''
+            CREATE TABLE IF NOT EXISTS visitor_sketches_hour (
+                bucket TEXT NOT NULL,
+                url TEXT NOT NULL,
+                country_code TEXT NOT NULL,
+                city TEXT NOT NULL,
+                sketch BLOB NOT NULL,
+                PRIMARY KEY (bucket, url, country_code, city)
+            ) WITHOUT ROWID
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS visitor_sketches_day (
+                bucket TEXT NOT NULL,
+                url TEXT NOT NULL,
+                country_code TEXT NOT NULL,
+                city TEXT NOT NULL,
+                sketch BLOB NOT NULL,
+                PRIMARY KEY (bucket, url, country_code, city)
+            ) WITHOUT ROWID
+        '''
+    ]),
+    # Filled from the rollups by HeavyHitters.sync() at startup
+    (12, 'top pages, cities and countries', [
+        '''
+            CREATE TABLE IF NOT EXISTS top_k_hour (
+                bucket TEXT NOT NULL,
+                url TEXT NOT NULL,
+                country_code TEXT NOT NULL,
+                city TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                error INTEGER NOT NULL,
+                PRIMARY KEY (bucket, url, country_code, city)
+            ) WITHOUT ROWID
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS top_k_day (
+                bucket TEXT NOT NULL,
+                url TEXT NOT NULL,
+                country_code TEXT NOT NULL,
+                city TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                error INTEGER NOT NULL,
+                PRIMARY KEY (bucket, url, country_code, city)
+            ) WITHOUT ROWID
+        '''
+    ]),
+    # Filled by DurationSketches.sync() at startup
+    (13, 'time on page percentiles', [
+        '''
+            CREATE TABLE IF NOT EXISTS time_on_page_bins_hour (
+                bucket TEXT NOT NULL,
+                url TEXT NOT NULL,
+                country_code TEXT NOT NULL,
+                city TEXT NOT NULL,
+                bin INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (bucket, url, country_code, city, bin)
+            ) WITHOUT ROWID
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS time_on_page_bins_day (
+                bucket TEXT NOT NULL,
+                url TEXT NOT NULL,
+                country_code TEXT NOT NULL,
+                city TEXT NOT NULL,
+                bin INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (bucket, url, country_code, city, bin)
+            ) WITHOUT ROWID
+        '''
+    ])
+]
+
+# Process metrics, served on GET /metrics in the Prometheus text format.
+# Upper bounds, in seconds, of the latency histogram buckets
+METRICS_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                           1.0, 2.5, 5.0, 10.0)
+# Paths reported by name; any other path counts as 'other', so scanners
+# probing random URLs can't grow the label set
+METRICS_ENDPOINTS = frozenset((
+    '/track/pageview', '/track/event', '/track/heatmap', '/track/batch', '/seo/analyze',
+    '/analytics/summary', '/analytics/top', '/analytics/realtime', '/analytics/stream', '/analytics/funnel',
+    '/analytics/heatmap', '/analytics/regions', '/analytics/available-regions', '/analytics/cache-stats',
+    '/generate-sample-data', '/metrics', '/admin/slow-requests', '/admin/profiles'
+))
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class Metric:
+    """Values of one metric, keyed by a tuple of label values in the order of labels.
+    
+    Updates are plain dict operations without a lock, like the stats dicts of
+    the ingest queue and the response cache: they cost a few hundred
+    nanoseconds, and a thread switch in the middle of one can very rarely lose
+    an increment.
+    """
+    kind = 'untyped'
+    
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+    
+    def set(self, value: float, labels: Tuple = ()):
+        self.values[labels] = value
+    
+    def samples(self) -> Iterable[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        """(name, ((label, value), ...), value) exposition samples"""
+        for labels, value in list(self.values.items()):
+            yield self.name, tuple(zip(self.labels, labels)), value
+
+class CounterMetric(Metric):
+    kind = 'counter'
+    
+    def inc(self, labels: Tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+class GaugeMetric(Metric):
+    kind = 'gauge'
+
+class HistogramMetric(Metric):
+    """Counts of observations per bucket, then their sum, per label values"""
+    kind = 'histogram'
+    
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = METRICS_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+    
+    def observe(self, value: float, labels: Tuple = ()):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+    
+    def samples(self) -> Iterable[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        for labels, counts in list(self.values.items()):
+            pairs = tuple(zip(self.labels, labels))
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                total += count
+                yield self.name + '_bucket', pairs + (('le', bound),), total
+            yield self.name + '_sum', pairs, counts[-1]
+            yield self.name + '_count', pairs, total
+
+def format_metric_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class MetricsRegistry:
+    """The metrics of this process and the collectors that refresh the scraped ones.
+    
+    Hot paths update their metrics as they go; figures other objects already
+    keep (queue depth, cache stats, RSS) are copied in by collectors when
+    /metrics is rendered, so they cost nothing between scrapes. Prefork
+    workers each have their own registry.
+    """
+    def __init__(self):
+        self.metrics = []
+        self._collectors = []
+    
+    def _add(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+    
+    def counter(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> CounterMetric:
+        return self._add(CounterMetric(name, documentation, labels))
+    
+    def gauge(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> GaugeMetric:
+        return self._add(GaugeMetric(name, documentation, labels))
+    
+    def histogram(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = METRICS_LATENCY_BUCKETS) -> HistogramMetric:
+        return self._add(HistogramMetric(name, documentation, labels, buckets))
+    
+    def add_collector(self, collect):
+        """Call collect() before every render to refresh metrics from elsewhere"""
+        self._collectors.append(collect)
+    
+    def render(self) -> bytes:
+        """Every metric in the Prometheus text exposition format"""
+        for collect in self._collectors:
+            collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, pairs, value in metric.samples():
+                labels = ','.join(f'{label}="{escape_label_value(format_metric_value(label_value))}"'
+                                  for label, label_value in pairs)
+                lines.append(f"{name}{{{labels}}} {format_metric_value(value)}" if labels else
+                             f"{name} {format_metric_value(value)}")
+        lines.append('')
+        return '\n'.join(lines).encode()
+
+def process_rss() -> int:
+    """Resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        # Peak rather than current outside Linux; still shows unbounded growth
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+class RequestTrace:
+    """Timings of one HTTP request: its phases in order and the SQL statements it ran"""
+    def __init__(self):
+        self.started = self._lap = time.perf_counter()
+        self.phases = []
+        # (role, sql, parameters or None, seconds)
+        self.statements = []
+        # Seconds spent waiting for a pooled reader while all were busy
+        self.reader_wait = 0.0
+    
+    def mark(self, phase: str):
+        """End a phase: the time since the previous mark is charged to it"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._lap))
+        self._lap = now
+
+# The RequestTrace of the request the current thread is handling, if any
+request_traces = threading.local()
+
+class TimedConnection(sqlite3.Connection):
+    """SQLite connection that records how long each execute() and executemany() takes.
+    
+    A SELECT is timed to its first row: by then SQLite has done any sorting
+    and grouping, but rows fetched afterwards aren't counted. Statements run
+    while the thread handles a traced request are also added to its trace.
+    """
+    # Set by ConnectionManager; None records nothing
+    query_seconds: Optional[HistogramMetric] = None
+    role = 'write'
+    
+    def _observe(self, sql: str, parameters, started: float):
+        seconds = time.perf_counter() - started
+        words = sql.split(None, 1)
+        self.query_seconds.observe(seconds, (self.role, words[0].lower() if words else ''))
+        trace = getattr(request_traces, 'trace', None)
+        if trace is not None:
+            trace.statements.append((self.role, sql, parameters, seconds))
+    
+    def execute(self, sql: str, parameters=()):
+        if self.query_seconds is None:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._observe(sql, parameters, started)
+    
+    def executemany(self, sql: str, parameters):
+        if self.query_seconds is None:
+            return super().executemany(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            # The parameters may have been a generator, now used up
+            self._observe(sql, None, started)
+
+class ConnectionManager:
+    """Persistent SQLite connections: one writer plus a pool of read-only readers.
+    
+    The database runs in WAL mode so dashboard readers and the ingest writer
+    don't block each other. Connections keep their prepared-statement cache
+    for the life of the process. After a fork the pool is rebuilt, since
+    SQLite connections must not be shared across processes.
+    """
+    def __init__(self, db_path: str, read_connections: int = 4, synchronous: str = 'NORMAL',
+                 cache_size: int = -65536, mmap_size: int = 268435456,
+                 statement_cache_size: int = 256, busy_timeout: float = 30.0,
+                 metrics: Optional[MetricsRegistry] = None):
+        self.db_path = db_path
+        self.read_connections = max(1, read_connections)
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.statement_cache_size = statement_cache_size
+        self.busy_timeout = busy_timeout
+        self.query_seconds = self.reader_wait_seconds = None
+        if metrics is not None:
+            self.query_seconds = metrics.histogram(
+                'jadtrax_sqlite_query_seconds', 'SQLite time per statement, to the first row for a SELECT',
+                ('connection', 'statement'))
+            self.reader_wait_seconds = metrics.histogram(
+                'jadtrax_sqlite_reader_wait_seconds', 'Time a query waited for a pooled reader while all were busy')
+        self._write_lock = threading.Lock()
+        self._reset()
+    
+    def _reset(self):
+        self._pid = os.getpid()
+        self._writer = None
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_lock = threading.Lock()
+    
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # Forked: drop (without closing) the parent's connections
+            self._write_lock = threading.Lock()
+            self._reset()
+    
+    def _connect(self, read_only: bool) -> sqlite3.Connection:
+        if read_only:
+            target = 'file:' + urllib.request.pathname2url(os.path.abspath(self.db_path)) + '?mode=ro'
+        else:
+            target = self.db_path
+        conn = sqlite3.connect(target, uri=read_only, timeout=self.busy_timeout, factory=TimedConnection,
+                               check_same_thread=False, cached_statements=self.statement_cache_size)
+        conn.query_seconds = self.query_seconds
+        conn.role = 'read' if read_only else 'write'
+        if not read_only:
+            # Persistent in the database file, so readers see it too
+            conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        conn.execute(f'PRAGMA cache_size={int(self.cache_size)}')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        for name, (num_params, func) in SQL_FUNCTIONS.items():
+            conn.create_function(name, num_params, func, deterministic=True)
+        return conn
+    
+    @contextmanager
+    def writer(self):
+        """Exclusive use of the writer connection; commits on success, rolls back on error"""
+        self._check_pid()
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect(read_only=False)
+            with self._writer:
+                yield self._writer
+    
+    @contextmanager
+    def reader(self):
+        """Borrow a read-only connection from the pool, waiting if all are in use"""
+        self._check_pid()
+        conn = None
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._reader_lock:
+                if self._reader_count < self.read_connections:
+                    self._reader_count += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                try:
+                    conn = self._connect(read_only=True)
+                except Exception:
+                    with self._reader_lock:
+                        self._reader_count -= 1
+                    raise
+            else:
+                started = time.perf_counter()
+                conn = self._readers.get()
+                waited = time.perf_counter() - started
+                if self.reader_wait_seconds is not None:
+                    self.reader_wait_seconds.observe(waited)
+                trace = getattr(request_traces, 'trace', None)
+                if trace is not None:
+                    trace.reader_wait += waited
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+    
+    def close(self):
+        self._check_pid()
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._reader_lock:
+            self._reader_count = 0
+        # Writer goes last so it can checkpoint and remove the WAL file
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+# INSERT statements for every table fed by the ingest queue. Rows are queued
+# in the column order of the pageviews, events and heatmaps views (id left
+# None); RowEncoder turns them into *_log rows, and {table} is the time
+# partition PartitionRouter picks for them.
+INGEST_STATEMENTS = {
+    'pageviews': '''
+        INSERT INTO {table} (session_id, url_id, timestamp, user_agent_id, ip_address, referrer_id, time_on_page, bounce, city_id, latitude, longitude)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''',
+    'events': '''
+        INSERT INTO {table} (session_id, event_type, event_data, timestamp, page_url_id, city_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''',
+    'heatmaps': '''
+        INSERT INTO {table} (page_url_id, x_coord, y_coord, event_type, timestamp, city_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''',
+    # Session ids are per visitor and hour, so a visitor who comes back after
+    # expiring continues the same row
+    'sessions': '''
+        INSERT INTO sessions (id, start_time, end_time, duration, page_count, user_agent, ip_address, device_type, browser, os, country_code, country_name, city, region, latitude, longitude)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET
+            start_time = MIN(start_time, excluded.start_time),
+            end_time = MAX(end_time, excluded.end_time),
+            duration = CAST(ROUND((julianday(MAX(end_time, excluded.end_time)) -
+                                   julianday(MIN(start_time, excluded.start_time))) * 86400) AS INTEGER),
+            page_count = page_count + excluded.page_count
+    '''
+}
+
+class DimensionTable:
+    """Interns the values of one dimension table, caching key -> id in process.
+    
+    Rows are (key columns..., attribute columns...); a row whose first key is
+    None maps to a NULL id. Attributes are kept from the first row that has
+    them, so a city first seen on an event gets its country name later.
+    Dimension rows are never deleted, so cached ids stay valid.
+    """
+    def __init__(self, table: str, keys: Tuple[str, ...], attributes: Tuple[str, ...] = (),
+                 max_cached: int = 100000):
+        self.table = table
+        self.max_cached = max_cached
+        self._width = len(keys)
+        columns = ', '.join(keys + attributes)
+        placeholders = ', '.join('?' * (len(keys) + len(attributes)))
+        if attributes:
+            action = 'DO UPDATE SET ' + ', '.join(
+                f"{column} = CASE WHEN COALESCE({column}, '') = '' THEN excluded.{column} ELSE {column} END"
+                for column in attributes)
+        else:
+            action = 'DO NOTHING'
+        self._insert = (f"INSERT INTO {table} ({columns}) VALUES ({placeholders}) "
+                        f"ON CONFLICT ({', '.join(keys)}) {action}")
+        self._select = f"SELECT id FROM {table} WHERE {' AND '.join(key + ' = ?' for key in keys)}"
+        self._ids = {}
+        # Cached keys whose attributes may still be blank in the table
+        self._incomplete = set()
+    
+    def __len__(self) -> int:
+        return len(self._ids)
+    
+    def ids(self, conn: sqlite3.Connection, rows: List[Tuple]) -> List[Optional[int]]:
+        """Ids for rows, inserting unseen keys through conn"""
+        known, incomplete, width = self._ids, self._incomplete, self._width
+        result = []
+        for row in rows:
+            key = row[:width]
+            found = known.get(key)
+            if found is None or (key in incomplete and all(row[width:])):
+                if key[0] is None:
+                    result.append(None)
+                    continue
+                conn.execute(self._insert, row)
+                found = conn.execute(self._select, key).fetchone()[0]
+                if len(known) >= self.max_cached:
+                    known.clear()
+                    incomplete.clear()
+                known[key] = found
+                if all(row[width:]):
+                    incomplete.discard(key)
+                else:
+                    incomplete.add(key)
+            result.append(found)
+        return result
+    
+    def clear(self):
+        self._ids.clear()
+        self._incomplete.clear()
+
+class RowEncoder:
+    """Replaces the strings of queued rows with dimension ids (see INGEST_STATEMENTS).
+    
+    Only the ingest writer uses it. If a write transaction rolls back, call
+    clear(): ids handed out inside it were never committed and may be reused.
+    """
+    def __init__(self):
+        self.urls = DimensionTable('urls', ('url',))
+        self.devices = DimensionTable('devices', ('device_type', 'browser', 'os'))
+        self.user_agents = DimensionTable('user_agents', ('user_agent',), ('device_id',))
+        self.referrers = DimensionTable('referrers', ('referrer',))
+        self.cities = DimensionTable('cities', ('country_code', 'city'), ('country_name', 'region'))
+    
+    def encode(self, conn: sqlite3.Connection, table: str, rows: List[Tuple]) -> List[Tuple]:
+        if table == 'pageviews':
+            urls = self.urls.ids(conn, [(row[2],) for row in rows])
+            devices = self.devices.ids(conn, [classify_user_agent(row[4]) for row in rows])
+            user_agents = self.user_agents.ids(conn, [(row[4], device) for row, device in zip(rows, devices)])
+            referrers = self.referrers.ids(conn, [(row[6],) for row in rows])
+            cities = self.cities.ids(conn, [(row[9] or '', row[11] or '', row[10] or '', row[12] or '')
+                                            for row in rows])
+            return [(row[1], url, row[3], user_agent, row[5], referrer, row[7], row[8], city, row[13], row[14])
+                    for row, url, user_agent, referrer, city in zip(rows, urls, user_agents, referrers, cities)]
+        if table == 'events':
+            urls = self.urls.ids(conn, [(row[5],) for row in rows])
+            cities = self.cities.ids(conn, [(row[6] or '', row[7] or '', '', '') for row in rows])
+            return [(row[1], row[2], row[3], row[4], url, city) for row, url, city in zip(rows, urls, cities)]
+        if table == 'heatmaps':
+            urls = self.urls.ids(conn, [(row[1],) for row in rows])
+            cities = self.cities.ids(conn, [(row[6] or '', row[7] or '', '', '') for row in rows])
+            return [(url, row[2], row[3], row[4], row[5], city) for row, url, city in zip(rows, urls, cities)]
+        return rows
+    
+    def clear(self):
+        for dimension in (self.urls, self.devices, self.user_agents, self.referrers, self.cities):
+            dimension.clear()
+
+class PartitionRouter:
+    """Routes log rows to their time partitions and finds the partitions a time range needs.
+    
+    The partition list is cached and reloaded whenever SQLite's schema version
+    changes, so partitions created or dropped by another process are picked up.
+    """
+    def __init__(self):
+        self._state = (None, {})
+    
+    def _starts(self, conn: sqlite3.Connection) -> Dict[str, List[datetime]]:
+        version = conn.execute('PRAGMA schema_version').fetchone()[0]
+        cached_version, starts = self._state
+        if version != cached_version:
+            starts = {log: log_partitions(conn, log) for log in LOG_COLUMNS}
+            self._state = (version, starts)
+        return starts
+    
+    def tables(self, conn: sqlite3.Connection, log: str, start: Optional[datetime] = None,
+               end: Optional[datetime] = None) -> List[str]:
+        """Partitions of log overlapping [start, end), oldest first; None leaves that end open"""
+        return [f'{log}_{first:%Y%m%d}' for first in self._starts(conn)[log]
+                if (end is None or first < end) and (start is None or first + PARTITION_SPAN > start)]
+    
+    def split(self, conn: sqlite3.Connection, log: str, rows: List[Tuple], timestamp_index: int) -> Dict[str, List[Tuple]]:
+        """Group rows by partition, creating the missing ones; needs the writer connection"""
+        groups = {}
+        low = high = None
+        for row in rows:
+            timestamp = row[timestamp_index]
+            if low is None or not low <= timestamp < high:
+                low = partition_start(timestamp)
+                high = low + PARTITION_SPAN
+                group = groups.setdefault(low, [])
+            group.append(row)
+        existing = set(self._starts(conn)[log])
+        missing = [first for first in groups if first not in existing]
+        for first in missing:
+            create_log_partition(conn, log, first)
+        if missing:
+            create_log_view(conn, log)
+        return {f'{log}_{first:%Y%m%d}': group for first, group in groups.items()}
+    
+    def drop_before(self, conn: sqlite3.Connection, cutoff: datetime) -> int:
+        """Drop every partition that ends at or before cutoff; returns how many were dropped"""
+        dropped = 0
+        for log in LOG_COLUMNS:
+            expired = [first for first in log_partitions(conn, log) if first + PARTITION_SPAN <= cutoff]
+            if not expired:
+                continue
+            for first in expired:
+                conn.execute(f'DROP TABLE {log}_{first:%Y%m%d}')
+            # The view needs at least one partition
+            create_log_partition(conn, log, partition_start(datetime.now()))
+            create_log_view(conn, log)
+            dropped += len(expired)
+        return dropped
+
+# Queued tables stored in time partitions, as {table: (log table, position of
+# the timestamp in the encoded row)}
+QUEUED_LOGS = {
+    'pageviews': ('pageview_log', 2),
+    'events': ('event_log', 3),
+    'heatmaps': ('heatmap_log', 4)
+}
+
+# Limits for POST /track/batch
+MAX_BATCH_RECORDS = 5000
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+# Types a tracked record's fields must have when present; None is always allowed.
+# Anything else would only fail in the ingest writer, after the client was told
+# the record was accepted. Numbers must also fit a signed 64-bit SQLite INTEGER.
+RECORD_STRING_FIELDS = ('url', 'page_url', 'referrer', 'user_agent', 'ip_address', 'session_id', 'event_type',
+                        'country_code', 'country_name', 'city', 'region')
+RECORD_NUMBER_FIELDS = ('time_on_page', 'x_coord', 'y_coord', 'latitude', 'longitude')
+RECORD_NUMBER_RANGE = (-2 ** 63, 2 ** 63 - 1)
+
+def check_record(data: Dict):
+    """Raise ValueError if a tracked record isn't an object or a field has the wrong type"""
+    if not isinstance(data, dict):
+        raise ValueError('Record must be a JSON object')
+    for field in RECORD_STRING_FIELDS:
+        if data.get(field) is not None and not isinstance(data[field], str):
+            raise ValueError(f"{field} must be a string")
+    for field in RECORD_NUMBER_FIELDS:
+        value = data.get(field)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"{field} must be a number")
+        if not RECORD_NUMBER_RANGE[0] <= value <= RECORD_NUMBER_RANGE[1]:
+            raise ValueError(f"{field} is out of range")
+    if data.get('bounce') is not None and not isinstance(data['bounce'], bool):
+        raise ValueError('bounce must be true or false')
+    if data.get('event_data') is not None and not isinstance(data['event_data'], dict):
+        raise ValueError('event_data must be an object')
+
+# How long the ingest writer keeps retrying a batch while another connection
+# (e.g. a prefork worker) holds the database lock, before dropping it
+INGEST_LOCK_RETRY_SECONDS = 30
+
+def sqlite_busy(error: Exception) -> bool:
+    """Whether an error means the database was locked by another connection, so a retry may succeed"""
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return 'locked' in str(error) or 'busy' in str(error)
+
+class IngestQueueFull(Exception):
+    """Raised when the ingest queue stays full for longer than the backpressure timeout"""
+    def __init__(self, message: str, accepted: int = 0):
+        super().__init__(message)
+        # Items of a put_many() call that made it into the queue before it filled up
+        self.accepted = accepted
+
+class IngestQueue:
+    """Write-behind buffer for tracked rows.
+    
+    track_* calls enqueue a (table, row) pair and return immediately. A single
+    background writer drains the queue and inserts rows with executemany in one
+    transaction, once batch_size rows are waiting or flush_interval seconds after
+    the first row of a batch arrived, whichever comes first.
+    
+    A batch that fails is retried while the database is locked, then split in
+    halves until only the rows that fail on their own are dropped.
+    """
+    _STOP = object()
+    
+    def __init__(self, db: ConnectionManager, max_size: int = 50000, batch_size: int = 1000,
+                 flush_interval: float = 0.5, put_timeout: float = 0.1,
+                 partitions: Optional[PartitionRouter] = None):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._hooks = []
+        self._commit_hooks = []
+        self.encoder = RowEncoder()
+        self.partitions = partitions or PartitionRouter()
+        self.stats = {'enqueued': 0, 'rejected': 0, 'written': 0, 'dropped': 0, 'batches': 0}
+        # Committed rows per table
+        self.written_by_table = {}
+    
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+    
+    def add_hook(self, hook):
+        """Call hook(conn, rows_by_table) inside every batch's write transaction"""
+        self._hooks.append(hook)
+    
+    def add_commit_hook(self, hook):
+        """Call hook(rows_by_table) once a batch has committed, for state outside the database"""
+        self._commit_hooks.append(hook)
+    
+    def put(self, table: str, row: Tuple):
+        self.put_many([(table, row)])
+    
+    def put_many(self, items: List[Tuple[str, Tuple]]):
+        """Enqueue rows, blocking at most put_timeout per row while the queue is full"""
+        if self._thread is None:
+            self.start()
+        for accepted, item in enumerate(items):
+            try:
+                self._queue.put(item, timeout=self.put_timeout)
+            except queue.Full:
+                self.stats['rejected'] += len(items) - accepted
+                raise IngestQueueFull('Ingest queue is full, retry later', accepted)
+            self.stats['enqueued'] += 1
+    
+    def depth(self) -> int:
+        return self._queue.qsize()
+    
+    def flush(self):
+        """Block until everything enqueued so far has been written"""
+        if self._thread is not None:
+            self._queue.join()
+    
+    def close(self):
+        """Write out all pending rows and stop the writer"""
+        with self._lock:
+            thread = self._thread
+            if thread is None or not thread.is_alive():
+                return
+            self._queue.put(self._STOP)
+        thread.join()
+        self._thread = None
+    
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self._STOP:
+                self._queue.task_done()
+                stopping = True
+                batch = self._drain()
+            else:
+                batch = [item]
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is self._STOP:
+                        self._queue.task_done()
+                        stopping = True
+                        batch.extend(self._drain())
+                        break
+                    batch.append(item)
+            if batch:
+                self._write(batch)
+                for _ in batch:
+                    self._queue.task_done()
+    
+    def _drain(self) -> List[Tuple[str, Tuple]]:
+        items = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return items
+            if item is self._STOP:
+                self._queue.task_done()
+            else:
+                items.append(item)
+    
+    def insert(self, conn: sqlite3.Connection, table: str, rows: List[Tuple]):
+        """Encode queued rows and write them through the writer connection, each into its partition"""
+        rows = self.encoder.encode(conn, table, rows)
+        if table not in QUEUED_LOGS:
+            conn.executemany(INGEST_STATEMENTS[table], rows)
+            return
+        log, timestamp_index = QUEUED_LOGS[table]
+        for partition, partition_rows in self.partitions.split(conn, log, rows, timestamp_index).items():
+            conn.executemany(INGEST_STATEMENTS[table].format(table=partition), partition_rows)
+    
+    def _write(self, batch: List[Tuple[str, Tuple]]):
+        """Commit a batch, or as much of it as can be: a failing batch is retried in halves"""
+        error = self._commit_retrying(batch)
+        if error is None:
+            return
+        if len(batch) == 1 or sqlite_busy(error):
+            self.stats['dropped'] += len(batch)
+            print(f"Ingest writer error, dropped {len(batch)} rows: {error}")
+            return
+        middle = len(batch) // 2
+        self._write(batch[:middle])
+        self._write(batch[middle:])
+    
+    def _commit_retrying(self, batch: List[Tuple[str, Tuple]]) -> Optional[Exception]:
+        """Commit a batch, retrying while the database is locked; returns the error if it still failed"""
+        deadline = time.monotonic() + INGEST_LOCK_RETRY_SECONDS
+        delay = 0.05
+        while True:
+            try:
+                self._commit(batch)
+                return None
+            except Exception as e:
+                # Ids handed out inside the rolled back transaction were never stored
+                self.encoder.clear()
+                if not sqlite_busy(e) or time.monotonic() >= deadline:
+                    return e
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+    
+    def _commit(self, batch: List[Tuple[str, Tuple]]):
+        rows_by_table = {}
+        for table, row in batch:
+            rows_by_table.setdefault(table, []).append(row)
+        with self.db.writer() as conn:
+            for table, rows in rows_by_table.items():
+                self.insert(conn, table, rows)
+            for hook in self._hooks:
+                hook(conn, rows_by_table)
+        self.stats['written'] += len(batch)
+        self.stats['batches'] += 1
+        for table, rows in rows_by_table.items():
+            self.written_by_table[table] = self.written_by_table.get(table, 0) + len(rows)
+        for hook in self._commit_hooks:
+            try:
+                hook(rows_by_table)
+            except Exception as e:
+                print(f"Ingest commit hook error: {e}")
+
+class RealtimeCounters:
+    """Sliding-window pageview counts and active sessions, kept in memory.
+    
+    Pageviews land in a ring of per-second counters covering the last hour.
+    Running totals for the last minute and hour are adjusted as seconds fall
+    out of the window, so reading them is O(1). Active sessions are an ordered
+    session_id -> last-seen map trimmed from its oldest end.
+    """
+    
+    def __init__(self, horizon: int = 3600, minute: int = 60, session_window: int = 300):
+        self.horizon = horizon
+        self.minute = minute
+        self.session_window = session_window
+        self._counts = [0] * horizon
+        self._now = int(time.time())
+        self._hour_total = 0
+        self._minute_total = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _advance(self, second: int):
+        """Move the windows forward to `second`, expiring what falls out of them"""
+        gap = second - self._now
+        if gap <= 0:
+            return
+        if gap >= self.horizon:
+            self._counts = [0] * self.horizon
+            self._hour_total = 0
+            self._minute_total = 0
+        else:
+            counts = self._counts
+            for current in range(self._now + 1, second + 1):
+                self._minute_total -= counts[(current - self.minute) % self.horizon]
+                slot = current % self.horizon
+                self._hour_total -= counts[slot]
+                counts[slot] = 0
+        self._now = second
+        
+        cutoff = second - self.session_window
+        sessions = self._sessions
+        while sessions:
+            session_id, last_seen = next(iter(sessions.items()))
+            if last_seen > cutoff:
+                break
+            sessions.popitem(last=False)
+    
+    def add_many(self, pageviews):
+        """Count (session_id, unix_timestamp) pairs"""
+        with self._lock:
+            for session_id, timestamp in pageviews:
+                second = int(timestamp)
+                self._advance(second)
+                age = self._now - second
+                if age < self.horizon:
+                    self._counts[second % self.horizon] += 1
+                    self._hour_total += 1
+                    if age < self.minute:
+                        self._minute_total += 1
+                if age < self.session_window and self._sessions.get(session_id, -1) < second:
+                    self._sessions[session_id] = second
+                    self._sessions.move_to_end(session_id)
+    
+    def load(self, conn: sqlite3.Connection):
+        """Seed the windows from pageviews already in the database"""
+        since = datetime.now() - timedelta(seconds=self.horizon)
+        cursor = conn.execute('''
+            SELECT session_id, timestamp FROM pageviews
+            WHERE timestamp >= ? ORDER BY timestamp
+        ''', (since,))
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows:
+                break
+            pageviews = []
+            for session_id, timestamp in rows:
+                try:
+                    pageviews.append((session_id, datetime.fromisoformat(str(timestamp)).timestamp()))
+                except ValueError:
+                    continue
+            self.add_many(pageviews)
+    
+    def snapshot(self) -> Tuple[int, int, int]:
+        """(active sessions, pageviews in the last hour, pageviews in the last minute)"""
+        with self._lock:
+            self._advance(int(time.time()))
+            return len(self._sessions), self._hour_total, self._minute_total
+
+class SessionRecord:
+    """A live session: counters plus the first pageview's client and region fields"""
+    __slots__ = ('start', 'last_seen', 'page_count', 'due', 'user_agent', 'ip_address',
+                 'country_code', 'country_name', 'city', 'region', 'latitude', 'longitude')
+
+class SessionStore:
+    """Live sessions, expired after idle_timeout seconds without a pageview.
+    
+    Expiry runs on a timer wheel of `tick`-second slots, so touching a session
+    and reaping idle ones are both O(1) per session. Expired sessions are
+    handed to sink() as sessions-table rows; a background reaper drives the
+    wheel. Past max_sessions, the session closest to expiring is closed early.
+    """
+    
+    def __init__(self, sink, idle_timeout: float = 1800, max_sessions: int = 200000,
+                 tick: float = 5.0, clock=time.time):
+        self.sink = sink
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.tick = tick
+        self.clock = clock
+        self._slots = int(idle_timeout // tick) + 2
+        self._wheel = [set() for _ in range(self._slots)]
+        self._records = {}
+        self._current = int(clock() // tick)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = os.getpid()
+        self.stats = {'started': 0, 'expired': 0, 'evicted': 0}
+    
+    def __len__(self) -> int:
+        return len(self._records)
+    
+    def _schedule(self, session_id: str, record: SessionRecord):
+        due = int((record.last_seen + self.idle_timeout) // self.tick) + 1
+        if due != record.due:
+            if record.due is not None:
+                self._wheel[record.due % self._slots].discard(session_id)
+            self._wheel[due % self._slots].add(session_id)
+            record.due = due
+    
+    def _unschedule_soonest(self) -> Tuple[str, SessionRecord]:
+        for offset in range(1, self._slots + 1):
+            bucket = self._wheel[(self._current + offset) % self._slots]
+            if bucket:
+                session_id = bucket.pop()
+                return session_id, self._records.pop(session_id)
+        raise KeyError('no live sessions')
+    
+    def touch(self, session_id: str, pageview: Tuple):
+        """Count a pageview row as queued (pageviews view column order) towards its session"""
+        if self._thread is None or self._pid != os.getpid():
+            self.start()
+        now = self.clock()
+        with self._lock:
+            # Catch the wheel up first so the new deadline can't wrap onto a stale slot
+            closed = self._advance(int(now // self.tick))
+            record = self._records.get(session_id)
+            if record is None:
+                if len(self._records) >= self.max_sessions:
+                    closed.append(self._unschedule_soonest())
+                    self.stats['evicted'] += 1
+                record = self._records[session_id] = SessionRecord()
+                record.start = now
+                record.page_count = 0
+                record.due = None
+                # User agents repeat across sessions; keep one copy of each
+                record.user_agent = sys.intern(pageview[4] or '')
+                record.ip_address = pageview[5]
+                (record.country_code, record.country_name, record.city, record.region,
+                 record.latitude, record.longitude) = pageview[9:15]
+                self.stats['started'] += 1
+            record.last_seen = now
+            record.page_count += 1
+            self._schedule(session_id, record)
+        if closed:
+            self.sink([self._row(*item) for item in closed])
+    
+    @staticmethod
+    def _row(session_id: str, record: SessionRecord) -> Tuple:
+        device_type, browser, os = classify_user_agent(record.user_agent)
+        return (
+            session_id,
+            datetime.fromtimestamp(record.start),
+            datetime.fromtimestamp(record.last_seen),
+            int(record.last_seen - record.start),
+            record.page_count,
+            record.user_agent,
+            record.ip_address,
+            device_type,
+            browser,
+            os,
+            record.country_code,
+            record.country_name,
+            record.city,
+            record.region,
+            record.latitude,
+            record.longitude
+        )
+    
+    def _advance(self, target: int) -> List[Tuple[str, SessionRecord]]:
+        """Turn the wheel to tick `target`, returning the sessions that expired"""
+        expired = []
+        # Past a full turn of the wheel every slot is due anyway
+        self._current = max(self._current, target - self._slots)
+        while self._current < target:
+            self._current += 1
+            slot = self._current % self._slots
+            for session_id in self._wheel[slot]:
+                expired.append((session_id, self._records.pop(session_id)))
+            self._wheel[slot] = set()
+        self.stats['expired'] += len(expired)
+        return expired
+    
+    def expire(self, now: Optional[float] = None) -> int:
+        """Close sessions idle for longer than idle_timeout; returns how many"""
+        with self._lock:
+            expired = self._advance(int((self.clock() if now is None else now) // self.tick))
+        if expired:
+            self.sink([self._row(session_id, record) for session_id, record in expired])
+        return len(expired)
+    
+    def start(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: sessions belong to the parent
+                self._pid = os.getpid()
+                self._records = {}
+                self._wheel = [set() for _ in range(self._slots)]
+                self._thread = None
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run, name='session-reaper', daemon=True)
+                self._thread.start()
+    
+    def _run(self):
+        while not self._stopped.wait(self.tick):
+            try:
+                self.expire()
+            except Exception as e:
+                print(f"Session reaper error: {e}")
+    
+    def close(self):
+        """Stop the reaper and write out every live session"""
+        self._stopped.set()
+        with self._lock:
+            live = list(self._records.items())
+            self._records = {}
+            self._wheel = [set() for _ in range(self._slots)]
+        if live:
+            self.sink([self._row(session_id, record) for session_id, record in live])
+
+# Seconds a cached GET /analytics/* response stays fresh, by endpoint. Heatmap
+# entries are also evicted as soon as a point for their page is written, so
+# they can live longer than the aggregates, which only expire.
+RESPONSE_CACHE_TTLS = {
+    'summary': 10,
+    'top': 10,
+    'regions': 30,
+    'heatmap': 300,
+    'available-regions': 3600,
+    'funnel': 60,
+}
+
+class ResponseCache:
+    """Bounded LRU of encoded JSON responses keyed by (endpoint, *normalized params).
+    
+    Only successful results are stored. Concurrent misses on the same key wait
+    for the first one to finish instead of running the query again.
+    """
+    
+    def __init__(self, max_entries: int = 1024, ttls: Optional[Dict[str, float]] = None):
+        self.max_entries = max_entries
+        self.ttls = dict(RESPONSE_CACHE_TTLS if ttls is None else ttls)
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._stale = set()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+    
+    @staticmethod
+    def etag(body: bytes) -> str:
+        return '"%s"' % hashlib.blake2b(body, digest_size=12).hexdigest()
+    
+    def get(self, key: Tuple, compute) -> Tuple[bytes, Optional[str]]:
+        """Return (body, etag) for key, calling compute() for the result on a miss"""
+        ttl = self.ttls.get(key[0], 0)
+        if self.max_entries <= 0 or ttl <= 0:
+            body = json.dumps(compute()).encode()
+            return body, None
+        
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[2] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry[0], entry[1]
+                pending = self._pending.get(key)
+                if pending is None:
+                    pending = self._pending[key] = threading.Event()
+                    self.stats['misses'] += 1
+                    break
+            pending.wait(30)
+        
+        try:
+            result = compute()
+            body = json.dumps(result).encode()
+            if not result.get('success'):
+                return body, None
+            etag = self.etag(body)
+            with self._lock:
+                if key not in self._stale:
+                    self._entries[key] = (body, etag, time.monotonic() + ttl)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                        self.stats['evictions'] += 1
+            return body, etag
+        finally:
+            with self._lock:
+                self._stale.discard(key)
+                del self._pending[key]
+            pending.set()
+    
+    def invalidate(self, key: Tuple):
+        """Drop one entry, including a result that is being computed right now"""
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.stats['invalidations'] += 1
+            if key in self._pending:
+                self._stale.add(key)
+    
+    def invalidate_prefix(self, prefix: Tuple):
+        """Drop every entry whose key starts with prefix, e.g. all filters of one page"""
+        size = len(prefix)
+        with self._lock:
+            for key in [key for key in self._entries if key[:size] == prefix]:
+                del self._entries[key]
+                self.stats['invalidations'] += 1
+            self._stale.update(key for key in self._pending if key[:size] == prefix)
+    
+    def clear(self):
+        with self._lock:
+            self.stats['invalidations'] += len(self._entries)
+            self._entries.clear()
+            self._stale.update(self._pending)
+    
+    def snapshot(self) -> Dict:
+        with self._lock:
+            stats = dict(self.stats, entries=len(self._entries), max_entries=self.max_entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0
+        return stats
+
+# Offline IP geolocation. A CSV of network ranges is compiled once into a
+# binary index beside it, which is memory-mapped: opening it costs the same
+# however many ranges it holds, and prefork workers share its pages. CSV
+# columns: network, country_code, country_name, city, region, latitude,
+# longitude. A network is a CIDR block ("81.2.69.0/24"), a "first-last" range
+# or a single address; a header row is skipped.
+GEOIP_MAGIC = b'JADGEO1' + (b'L' if sys.byteorder == 'little' else b'B')
+# magic, IPv4 ranges, IPv6 ranges, locations, reserved
+GEOIP_HEADER = struct.Struct('=8s4I')
+IPV4_MAPPED_PREFIX = b'\0' * 10 + b'\xff\xff'
+# Region of a beacon nothing could place
+UNKNOWN_REGION = (None, 'Unknown', None, None, None, None)
+
+def parse_network(network: str) -> Tuple[int, int, int]:
+    """(IP version, first address, last address) of a CIDR block, range or single address"""
+    if '-' in network:
+        first, last = (ipaddress.ip_address(part.strip()) for part in network.split('-', 1))
+        if first.version != last.version or first > last:
+            raise ValueError(f"Invalid address range {network!r}")
+        return first.version, int(first), int(last)
+    block = ipaddress.ip_network(network.strip(), strict=False)
+    return block.version, int(block.network_address), int(block.broadcast_address)
+
+def compile_geoip(csv_path: str, index_path: str):
+    """Compile a CSV of network ranges into the index GeoIndex maps.
+    
+    IPv6 ranges are indexed by their /64 prefix, which is as fine as location
+    databases place addresses; a range inside a /64 already covered is dropped.
+    """
+    ranges = {4: [], 6: []}
+    locations = {}
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        for line_number, fields in enumerate(csv.reader(f), 1):
+            if not fields or fields[0].startswith('#'):
+                continue
+            try:
+                version, first, last = parse_network(fields[0])
+            except ValueError:
+                if line_number == 1:
+                    continue
+                raise ValueError(f"{csv_path}:{line_number}: invalid network {fields[0]!r}")
+            if version == 6:
+                first, last = first >> 64, last >> 64
+            location = tuple(field.replace('\t', ' ').strip() for field in (fields[1:7] + [''] * 6)[:6])
+            ranges[version].append((first, last, locations.setdefault(location, len(locations))))
+    
+    for version, entries in ranges.items():
+        entries.sort()
+        kept = []
+        for entry in entries:
+            if kept and entry[0] <= kept[-1][1]:
+                if version == 4:
+                    raise ValueError(f"{csv_path}: overlapping ranges at {ipaddress.IPv4Address(entry[0])}")
+                continue
+            kept.append(entry)
+        ranges[version] = kept
+    
+    encoded = [('\t'.join(location)).encode('utf-8') for location in locations]
+    offsets = array('I', [0])
+    for text in encoded:
+        offsets.append(offsets[-1] + len(text))
+    # Written beside the target and renamed, so a process that is opening the
+    # index never sees half of it
+    partial = f"{index_path}.{os.getpid()}.tmp"
+    with open(partial, 'wb') as f:
+        f.write(GEOIP_HEADER.pack(GEOIP_MAGIC, len(ranges[4]), len(ranges[6]), len(encoded), 0))
+        # 8-byte columns first so every column stays aligned
+        for version, typecode in ((6, 'Q'), (4, 'I')):
+            for column in range(3):
+                f.write(array('I' if column == 2 else typecode, [entry[column] for entry in ranges[version]]).tobytes())
+        f.write(offsets.tobytes())
+        f.write(b''.join(encoded))
+    os.replace(partial, index_path)
+
+class GeoIndex:
+    """Memory-mapped IP ranges, each pointing at a (country_code, country_name,
+    city, region, latitude, longitude) location.
+    
+    Range starts and ends are sorted arrays per address family, so a lookup is
+    a bisect; a location is only decoded when an address in its range is
+    looked up. lookup() memoizes the most recent addresses.
+    """
+    def __init__(self, index_path: str, cache_size: int = 65536):
+        self.path = index_path
+        with open(index_path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, v4_count, v6_count, location_count, _ = GEOIP_HEADER.unpack_from(self._mmap)
+        if magic != GEOIP_MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{index_path} is not a GeoIP index for this platform")
+        self._view = memoryview(self._mmap)
+        offset = GEOIP_HEADER.size
+        
+        def column(typecode: str, count: int) -> memoryview:
+            nonlocal offset
+            size = array(typecode).itemsize * count
+            view = self._view[offset:offset + size].cast(typecode)
+            offset += size
+            return view
+        
+        self._v6 = (column('Q', v6_count), column('Q', v6_count), column('I', v6_count))
+        self._v4 = (column('I', v4_count), column('I', v4_count), column('I', v4_count))
+        self._offsets = column('I', location_count + 1)
+        self._locations = self._view[offset:]
+        self.ranges = v4_count + v6_count
+        self.lookup = lru_cache(maxsize=cache_size)(self._lookup)
+    
+    @classmethod
+    def load(cls, path: str, cache_size: int = 65536) -> 'GeoIndex':
+        """Open a compiled index, or a CSV whose index is (re)compiled to <path>.idx when stale"""
+        with open(path, 'rb') as f:
+            if f.read(len(GEOIP_MAGIC)) == GEOIP_MAGIC:
+                return cls(path, cache_size)
+        index_path = path + '.idx'
+        try:
+            fresh = os.path.getmtime(index_path) >= os.path.getmtime(path)
+            with open(index_path, 'rb') as f:
+                fresh = fresh and f.read(len(GEOIP_MAGIC)) == GEOIP_MAGIC
+        except OSError:
+            fresh = False
+        if not fresh:
+            compile_geoip(path, index_path)
+        return cls(index_path, cache_size)
+    
+    def _lookup(self, ip: str) -> Optional[Tuple]:
+        try:
+            if ':' in ip:
+                packed = socket.inet_pton(socket.AF_INET6, ip)
+                if packed[:12] == IPV4_MAPPED_PREFIX:
+                    starts, ends, locations = self._v4
+                    key = int.from_bytes(packed[12:], 'big')
+                else:
+                    starts, ends, locations = self._v6
+                    key = int.from_bytes(packed[:8], 'big')
+            else:
+                starts, ends, locations = self._v4
+                key = int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+        except (OSError, TypeError):
+            return None
+        index = bisect_right(starts, key) - 1
+        if index < 0 or key > ends[index]:
+            return None
+        return self._location(locations[index])
+    
+    def _location(self, index: int) -> Tuple:
+        text = bytes(self._locations[self._offsets[index]:self._offsets[index + 1]]).decode('utf-8')
+        country_code, country_name, city, region, latitude, longitude = text.split('\t')
+        return (country_code or None, country_name or country_code or 'Unknown', city or None, region or None,
+                float(latitude) if latitude else None, float(longitude) if longitude else None)
+    
+    def close(self):
+        self.lookup.cache_clear()
+        for view in self._v6 + self._v4 + (self._offsets, self._locations, self._view):
+            view.release()
+        self._mmap.close()
+
+# Conversion funnels served by /analytics/funnel?name=, as {name: definition}.
+# Steps are matched in order; a step matches pageviews whose URL starts with
+# 'url' (the summary URL filter's rule, '' matches every page) or events whose
+# event_type is 'event'. 'window' is how many seconds a session has, from its
+# first step, to reach the later ones.
+FUNNELS = {
+    'default': {
+        'window': 3600,
+        'steps': [
+            {'step': 'Landing Page', 'url': ''},
+            {'step': 'Product View', 'url': 'https://example.com/products'},
+            {'step': 'Add to Cart', 'event': 'add_to_cart'},
+            {'step': 'Checkout', 'event': 'checkout'},
+            {'step': 'Purchase', 'event': 'purchase'}
+        ]
+    }
+}
+# Funnel counts are kept per hour of the attempt's first step
+FUNNEL_BUCKET_FORMAT = '%Y-%m-%d %H:00:00'
+# How much raw history a rebuild replays; the longest time_range served
+FUNNEL_HISTORY = timedelta(days=30)
+
+class Funnel:
+    """One funnel definition, compiled for matching tracked rows to its steps.
+    
+    A session's first row matching step 0 opens an attempt, and each later row
+    matching the next step moves it one step on, as long as it arrives within
+    window of the opening row. Once the window has passed, the next row
+    matching step 0 opens a new attempt.
+    """
+    def __init__(self, name: str, definition: Dict):
+        if not definition.get('steps'):
+            raise ValueError(f"Funnel {name!r} has no steps")
+        self.name = name
+        self.definition = json.dumps(definition, sort_keys=True)
+        self.window = timedelta(seconds=definition.get('window', 3600))
+        self.labels = [step['step'] for step in definition['steps']]
+        # (step, low, high) URL ranges; low None matches every page
+        self.url_steps = []
+        event_steps = {}
+        for index, step in enumerate(definition['steps']):
+            if 'event' in step:
+                event_steps.setdefault(step['event'], []).append(index)
+            elif step.get('url'):
+                self.url_steps.append((index,) + url_prefix_range(step['url']))
+            else:
+                self.url_steps.append((index, None, None))
+        self.event_steps = {event_type: tuple(steps) for event_type, steps in event_steps.items()}
+    
+    @property
+    def matches_every_page(self) -> bool:
+        return any(low is None for _, low, _ in self.url_steps)
+    
+    def pageview_steps(self, url: Optional[str]) -> Tuple[int, ...]:
+        url = url or ''
+        return tuple(index for index, low, high in self.url_steps if low is None or low <= url < high)
+    
+    def advance(self, state: Optional[Tuple[datetime, int]], moment: datetime,
+                steps: Tuple[int, ...]) -> Tuple[Optional[Tuple[datetime, int]], Optional[int]]:
+        """Apply one matching row to a session's (opened_at, step) state; returns (state, step reached or None)"""
+        if state is not None and moment - state[0] > self.window:
+            state = None
+        if state is None:
+            return ((moment, 0), 0) if 0 in steps else (None, None)
+        following = state[1] + 1
+        if following in steps:
+            return (state[0], following), following
+        return state, None
+
+class FunnelTracker:
+    """Conversion funnels, kept up to date by the ingest writer.
+    
+    funnel_counts holds how many attempts reached each step, per hour the
+    attempt opened in; funnel_progress holds the attempts still inside their
+    window. Both are advanced in the transaction that writes the rows, so every
+    process reads the same numbers. A funnel whose definition is new or changed
+    is rebuilt with one pass over the raw logs in time order.
+    """
+    def __init__(self, definitions: Dict[str, Dict], partitions: PartitionRouter):
+        self.funnels = {name: Funnel(name, definition) for name, definition in definitions.items()}
+        self.partitions = partitions
+        self._pruned_at = datetime.min
+    
+    def sync(self, conn: sqlite3.Connection) -> List[str]:
+        """Rebuild funnels whose stored definition differs and forget removed ones; returns the rebuilt names"""
+        stored = dict(conn.execute('SELECT name, definition FROM funnel_definitions'))
+        for name in stored.keys() - self.funnels.keys():
+            self._forget(conn, name)
+        rebuilt = [name for name, funnel in self.funnels.items() if stored.get(name) != funnel.definition]
+        for name in rebuilt:
+            self.rebuild(conn, name)
+        return rebuilt
+    
+    def _forget(self, conn: sqlite3.Connection, name: str):
+        conn.execute('DELETE FROM funnel_definitions WHERE name = ?', (name,))
+        conn.execute('DELETE FROM funnel_progress WHERE funnel = ?', (name,))
+        conn.execute('DELETE FROM funnel_counts WHERE funnel = ?', (name,))
+    
+    def _scan(self, conn: sqlite3.Connection, log: str, column: str, keys: Optional[List], start: datetime):
+        """(timestamp, session_id, column) rows of log since start, in time order; keys None reads every row"""
+        condition = f' AND {column} IN ({", ".join("?" * len(keys))})' if keys is not None else ''
+        for table in self.partitions.tables(conn, log, start):
+            yield from conn.execute(f'''
+                SELECT timestamp, session_id, {column} FROM {table}
+                WHERE timestamp >= ? AND session_id IS NOT NULL{condition}
+                ORDER BY timestamp
+            ''', [start] + (keys or []))
+    
+    def rebuild(self, conn: sqlite3.Connection, name: str):
+        """Recompute one funnel from the raw pageviews and events of the last FUNNEL_HISTORY"""
+        funnel = self.funnels[name]
+        self._forget(conn, name)
+        now = datetime.now()
+        start = now - FUNNEL_HISTORY - funnel.window
+    
+        url_steps = {None: funnel.pageview_steps(None)}
+        for url_id, url in conn.execute('SELECT id, url FROM urls'):
+            steps = funnel.pageview_steps(url)
+            if steps:
+                url_steps[url_id] = steps
+        url_keys = None
+        if not funnel.matches_every_page and len(url_steps) <= 500:
+            url_keys = [url_id for url_id in url_steps if url_id is not None]
+        pageviews = self._scan(conn, 'pageview_log', 'url_id', url_keys, start) if funnel.url_steps else iter(())
+        events = self._scan(conn, 'event_log', 'event_type', list(funnel.event_steps), start) \
+            if funnel.event_steps else iter(())
+    
+        # Open attempts, oldest first, so the expired ones come off the front
+        states = OrderedDict()
+        counts = {}
+        for timestamp, session_id, key in heapq.merge(pageviews, events, key=itemgetter(0)):
+            if type(key) is str:
+                steps = funnel.event_steps.get(key)
+            else:
+                steps = url_steps.get(key)
+            if not steps:
+                continue
+            moment = datetime.fromisoformat(timestamp)
+            while states:
+                opened_at = next(iter(states.values()))[0]
+                if moment - opened_at <= funnel.window:
+                    break
+                states.popitem(last=False)
+            state, reached = funnel.advance(states.get(session_id), moment, steps)
+            if reached is None:
+                continue
+            if reached == 0:
+                states.pop(session_id, None)
+            states[session_id] = state
+            key = (state[0].strftime(FUNNEL_BUCKET_FORMAT), reached)
+            counts[key] = counts.get(key, 0) + 1
+    
+        conn.executemany('INSERT INTO funnel_counts (funnel, bucket, step, sessions) VALUES (?, ?, ?, ?)',
+                         [(name, bucket, step, sessions) for (bucket, step), sessions in counts.items()])
+        conn.executemany('INSERT INTO funnel_progress (funnel, session_id, opened_at, step) VALUES (?, ?, ?, ?)',
+                         [(name, session_id, opened_at, step) for session_id, (opened_at, step) in states.items()])
+        conn.execute('INSERT INTO funnel_definitions (name, definition, built_at) VALUES (?, ?, ?)',
+                     (name, funnel.definition, now))
+    
+    def _load(self, conn: sqlite3.Connection, name: str, sessions: List[str]) -> Dict[str, Tuple[datetime, int]]:
+        states = {}
+        for offset in range(0, len(sessions), 500):
+            chunk = sessions[offset:offset + 500]
+            for session_id, opened_at, step in conn.execute(f'''
+                SELECT session_id, opened_at, step FROM funnel_progress
+                WHERE funnel = ? AND session_id IN ({", ".join("?" * len(chunk))})
+            ''', [name] + chunk):
+                states[session_id] = (datetime.fromisoformat(opened_at), step)
+        return states
+    
+    def update(self, conn: sqlite3.Connection, rows_by_table: Dict[str, List[Tuple]]) -> List[str]:
+        """Advance every funnel by a written batch of pageviews and events; returns the funnels whose counts changed"""
+        pageviews = [row for row in rows_by_table.get('pageviews', ()) if row[1]]
+        events = [row for row in rows_by_table.get('events', ()) if row[1]]
+        changed = []
+        newest = None
+        for name, funnel in self.funnels.items():
+            matches = []
+            if funnel.url_steps:
+                matches += [(row[3], row[1], funnel.pageview_steps(row[2])) for row in pageviews]
+            if funnel.event_steps:
+                matches += [(row[4], row[1], funnel.event_steps.get(row[2], ())) for row in events]
+            # Stable, so pageviews go first on equal timestamps, as in rebuild()
+            matches = sorted((match for match in matches if match[2]), key=itemgetter(0))
+            if not matches:
+                continue
+            newest = max(newest or matches[-1][0], matches[-1][0])
+    
+            states = self._load(conn, name, list({session_id for _, session_id, _ in matches}))
+            touched = set()
+            counts = {}
+            for moment, session_id, steps in matches:
+                state, reached = funnel.advance(states.get(session_id), moment, steps)
+                if state != states.get(session_id):
+                    states[session_id] = state
+                    touched.add(session_id)
+                if reached is not None:
+                    key = (state[0].strftime(FUNNEL_BUCKET_FORMAT), reached)
+                    counts[key] = counts.get(key, 0) + 1
+    
+            conn.executemany('DELETE FROM funnel_progress WHERE funnel = ? AND session_id = ?',
+                             [(name, session_id) for session_id in touched if states[session_id] is None])
+            conn.executemany('''
+                INSERT OR REPLACE INTO funnel_progress (funnel, session_id, opened_at, step) VALUES (?, ?, ?, ?)
+            ''', [(name, session_id) + states[session_id] for session_id in touched if states[session_id] is not None])
+            conn.executemany('''
+                INSERT INTO funnel_counts (funnel, bucket, step, sessions) VALUES (?, ?, ?, ?)
+                ON CONFLICT (funnel, bucket, step) DO UPDATE SET sessions = sessions + excluded.sessions
+            ''', [(name, bucket, step, sessions) for (bucket, step), sessions in counts.items()])
+            if counts:
+                changed.append(name)
+    
+        # Attempts expire by the time of the rows rather than the clock, so
+        # replayed history advances the same way as live traffic
+        now = datetime.now()
+        if newest is not None and now - self._pruned_at > timedelta(hours=1):
+            for name, funnel in self.funnels.items():
+                conn.execute('DELETE FROM funnel_progress WHERE funnel = ? AND opened_at < ?',
+                             (name, newest - funnel.window))
+            self._pruned_at = now
+        return changed
+    
+    def counts(self, conn: sqlite3.Connection, name: str, start: datetime) -> List[int]:
+        """Attempts that reached each step of a funnel, among those opened since start's hour"""
+        reached = dict(conn.execute('''
+            SELECT step, SUM(sessions) FROM funnel_counts
+            WHERE funnel = ? AND bucket >= ?
+            GROUP BY step
+        ''', (name, start.strftime(FUNNEL_BUCKET_FORMAT))))
+        return [reached.get(step, 0) for step in range(len(self.funnels[name].labels))]
+
+# Unique visitor sketches. Distinct counts can't be summed from rollups, so
+# every hour and day bucket keeps HyperLogLog sketches of its session ids:
+# one per URL, one per (country_code, city) and one for all traffic, with
+# SKETCH_ANY in the columns a sketch spans. A sketch of 2 ** precision
+# registers estimates with a relative standard error of 1.04 / sqrt(2 ** precision);
+# the default, 12, gives 1.6%.
+HLL_PRECISION = 12
+SKETCH_ANY = '*'
+SKETCH_GRANULARITIES = (
+    ('visitor_sketches_hour', '%Y-%m-%d %H:00:00', timedelta(hours=1)),
+    ('visitor_sketches_day', '%Y-%m-%d 00:00:00', timedelta(days=1))
+)
+# Hour sketches only need to reach the ends of the longest dashboard range
+SKETCH_HOUR_RETENTION = timedelta(days=31)
+
+def sketch_hour_cutoff() -> str:
+    """Oldest hour bucket still kept in visitor_sketches_hour"""
+    return (datetime.now() - SKETCH_HOUR_RETENTION).strftime(SKETCH_GRANULARITIES[0][1])
+
+def hour_day_spans(start_time: datetime, hour_table: str,
+                   day_table: str) -> Tuple[datetime, List[Tuple[str, datetime, Optional[datetime]]]]:
+    """(start of the first whole hour, [(table, low, high)]) tiling that hour to now with hour and day buckets"""
+    hour_start = start_time.replace(minute=0, second=0, microsecond=0)
+    if hour_start < start_time:
+        hour_start += timedelta(hours=1)
+    day_start = hour_start.replace(hour=0)
+    if day_start < hour_start:
+        day_start += timedelta(days=1)
+    day_end = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    if day_start <= day_end:
+        return hour_start, [(hour_table, hour_start, day_start), (day_table, day_start, day_end),
+                            (hour_table, day_end, None)]
+    return hour_start, [(hour_table, hour_start, None)]
+
+def hll_position(value: str, precision: int) -> Tuple[int, int]:
+    """(register, rank) a value sets in a sketch: the hash's top bits pick the register, the rest's leading zeros the rank"""
+    digest = int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+    width = 64 - precision
+    return digest >> width, width - (digest & ((1 << width) - 1)).bit_length() + 1
+
+def _sparse_entries(blob: bytes) -> array:
+    entries = array('I')
+    entries.frombytes(blob[1:])
+    if sys.byteorder == 'big':
+        entries.byteswap()
+    return entries
+
+def update_sketch(blob: Optional[bytes], precision: int, updates: Dict[int, int]) -> bytes:
+    """Apply {register: rank} updates to a stored sketch (None for a new one) and return it re-encoded.
+    
+    A sketch is a precision byte followed, while few registers are set, by
+    little-endian (register << 6 | rank) uint32s, and otherwise by every
+    register as one byte.
+    """
+    size = 1 << precision
+    if blob is not None and len(blob) == size + 1:
+        registers = bytearray(blob)
+        for index, rank in updates.items():
+            if rank > registers[index + 1]:
+                registers[index + 1] = rank
+        return bytes(registers)
+    # Sparse entries are kept sorted, so a batch's few updates are binary searches
+    entries = _sparse_entries(blob) if blob is not None else array('I')
+    for index, rank in updates.items():
+        position = bisect_left(entries, index << 6)
+        if position < len(entries) and entries[position] >> 6 == index:
+            if rank > entries[position] & 63:
+                entries[position] = index << 6 | rank
+        else:
+            entries.insert(position, index << 6 | rank)
+    if len(entries) * 4 < size:
+        if sys.byteorder == 'big':
+            entries.byteswap()
+        return bytes([precision]) + entries.tobytes()
+    dense = bytearray(size + 1)
+    dense[0] = precision
+    for entry in entries:
+        dense[(entry >> 6) + 1] = entry & 63
+    return bytes(dense)
+
+class HyperLogLog:
+    """Registers merged from stored sketches and raw session ids, for one distinct-count estimate.
+    
+    Dense sketches are merged as big integers with a bytewise max (registers
+    are below 128, so no byte ever borrows from its neighbour); sparse ones
+    and raw values are set in a bytearray, and the two are combined at the end.
+    """
+    def __init__(self, precision: int):
+        self.precision = precision
+        self.size = 1 << precision
+        self._dense = 0
+        self._sparse = bytearray(self.size)
+    
+    def add(self, value: str):
+        index, rank = hll_position(value, self.precision)
+        if rank > self._sparse[index]:
+            self._sparse[index] = rank
+    
+    def merge(self, blob: bytes):
+        if blob[0] != self.precision:
+            raise ValueError(f"Sketch precision {blob[0]} doesn't match {self.precision}")
+        if len(blob) == self.size + 1:
+            self._dense = self._bytewise_max(self._dense, int.from_bytes(blob[1:], 'big'))
+            return
+        registers = self._sparse
+        for entry in _sparse_entries(blob):
+            index, rank = entry >> 6, entry & 63
+            if rank > registers[index]:
+                registers[index] = rank
+    
+    def union(self, other: 'HyperLogLog'):
+        self._dense = self._bytewise_max(self._dense, int.from_bytes(other.registers(), 'big'))
+    
+    def _bytewise_max(self, a: int, b: int) -> int:
+        high = int.from_bytes(b'\x80' * self.size, 'big')
+        # 0x80 survives in the bytes where a >= b
+        keep_a = (((a | high) - b) & high) >> 7
+        return b ^ ((a ^ b) & (keep_a * 0xFF))
+    
+    def registers(self) -> bytes:
+        return self._bytewise_max(self._dense, int.from_bytes(self._sparse, 'big')).to_bytes(self.size, 'big')
+    
+    def estimate(self) -> int:
+        registers = self.registers()
+        size = self.size
+        # Ranks run up to 64 - precision + 1
+        total = sum(registers.count(rank) * 2.0 ** -rank for rank in range(66 - self.precision))
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(size, 0.7213 / (1 + 1.079 / size))
+        estimate = alpha * size * size / total
+        zeros = registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # Linear counting is more accurate while many registers are empty
+            estimate = size * math.log(size / zeros)
+        return int(round(estimate))
+
+class VisitorSketches:
+    """Unique visitor sketches per hour and day, kept up to date by the ingest writer.
+    
+    Estimates for a time range merge the day sketches in the middle of it, the
+    hour sketches at its ends, and the session ids of the part-hour at its
+    start read from the raw pageviews.
+    """
+    def __init__(self, partitions: PartitionRouter, precision: int = HLL_PRECISION):
+        if not 4 <= precision <= 16:
+            raise ValueError('HyperLogLog precision must be between 4 and 16')
+        self.partitions = partitions
+        self.precision = precision
+        self._pruned_at = datetime.min
+    
+    def sync(self, conn: sqlite3.Connection) -> bool:
+        """Rebuild the sketches if they were built at another precision or never built; returns whether it did"""
+        stored = conn.execute('SELECT sketch FROM visitor_sketches_day LIMIT 1').fetchone()
+        if stored is not None and stored[0][0] == self.precision:
+            return False
+        if stored is None and not any(conn.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone()
+                                      for table in self.partitions.tables(conn, 'pageview_log')):
+            return False
+        self.rebuild(conn)
+        return True
+    
+    def _positions(self, rows) -> Dict[Tuple, Dict[int, int]]:
+        """{(table, bucket, url, country_code, city): {register: rank}} for (timestamp, session_id, url, country_code, city) rows"""
+        updates = {}
+        hour_cutoff = sketch_hour_cutoff()
+        (hour_table, hour_format, _), (day_table, _, _) = SKETCH_GRANULARITIES
+        for timestamp, session_id, url, country_code, city in rows:
+            if not session_id:
+                continue
+            index, rank = hll_position(session_id, self.precision)
+            hour = timestamp.strftime(hour_format)
+            # The day bucket is the hour bucket's date at midnight
+            for table, bucket in ((hour_table, hour), (day_table, hour[:11] + '00:00:00')):
+                if table == hour_table and bucket < hour_cutoff:
+                    continue
+                for key in ((table, bucket, url or '', SKETCH_ANY, SKETCH_ANY),
+                            (table, bucket, SKETCH_ANY, country_code or '', city or ''),
+                            (table, bucket, SKETCH_ANY, SKETCH_ANY, SKETCH_ANY)):
+                    registers = updates.get(key)
+                    if registers is None:
+                        updates[key] = {index: rank}
+                    elif rank > registers.get(index, 0):
+                        registers[index] = rank
+        return updates
+    
+    def _write(self, conn: sqlite3.Connection, updates: Dict[Tuple, Dict[int, int]], merge: bool = True):
+        for table, _, _ in SKETCH_GRANULARITIES:
+            keys = [key[1:] for key in updates if key[0] == table]
+            stored = {}
+            # One primary key seek per sketch; a row-value IN list would scan the table
+            select = f'SELECT sketch FROM {table} WHERE bucket = ? AND url = ? AND country_code = ? AND city = ?'
+            for key in keys if merge else ():
+                row = conn.execute(select, key).fetchone()
+                if row is not None:
+                    stored[key] = row[0]
+            conn.executemany(f'INSERT OR REPLACE INTO {table} (bucket, url, country_code, city, sketch) VALUES (?, ?, ?, ?, ?)',
+                             [key + (update_sketch(stored.get(key), self.precision, updates[(table,) + key]),)
+                              for key in keys])
+    
+    def rebuild(self, conn: sqlite3.Connection):
+        """Recompute every sketch from the raw pageviews, one weekly partition at a time"""
+        for table, _, _ in SKETCH_GRANULARITIES:
+            conn.execute(f'DELETE FROM {table}')
+        for partition in self.partitions.tables(conn, 'pageview_log'):
+            rows = conn.execute(f'''
+                SELECT timestamp, session_id, url, country_code, city FROM {partition}
+                LEFT JOIN urls ON urls.id = url_id
+                LEFT JOIN cities ON cities.id = city_id
+            ''')
+            # Partitions start at midnight, so no hour or day bucket spans two of them
+            self._write(conn, self._positions((datetime.fromisoformat(row[0]),) + row[1:] for row in rows), merge=False)
+    
+    def update(self, conn: sqlite3.Connection, rows_by_table: Dict[str, List[Tuple]]):
+        """Add a written batch of pageviews to their buckets' sketches"""
+        rows = rows_by_table.get('pageviews')
+        if rows:
+            self._write(conn, self._positions((row[3], row[1], row[2], row[9], row[11]) for row in rows))
+        now = datetime.now()
+        if now - self._pruned_at > timedelta(hours=1):
+            conn.execute('DELETE FROM visitor_sketches_hour WHERE bucket < ?', (sketch_hour_cutoff(),))
+            self._pruned_at = now
+    
+    def _sketches(self, conn: sqlite3.Connection, start_time: datetime, condition: str, params: List):
+        """(url, country_code, city, sketch) rows matching condition across the range's spans"""
+        _, spans = hour_day_spans(start_time, 'visitor_sketches_hour', 'visitor_sketches_day')
+        for table, low, high in spans:
+            if high is not None and low >= high:
+                continue
+            yield from conn.execute(f'''
+                SELECT url, country_code, city, sketch FROM {table}
+                WHERE bucket >= ?{' AND bucket < ?' if high is not None else ''} AND {condition}
+            ''', [low] + ([high] if high is not None else []) + params)
+    
+    def _raw(self, conn: sqlite3.Connection, start_time: datetime, select: str, params: List):
+        """Rows of select run on the pageviews from start_time up to the first hour sketch"""
+        raw_end, _ = hour_day_spans(start_time, 'visitor_sketches_hour', 'visitor_sketches_day')
+        for table in self.partitions.tables(conn, 'pageview_log', start_time, raw_end):
+            yield from conn.execute(select.format(table=table), [start_time, raw_end] + params)
+    
+    def estimate(self, conn: sqlite3.Connection, start_time: datetime,
+                 url_low: Optional[str] = None, url_high: Optional[str] = None) -> int:
+        """Unique visitors since start_time, optionally only to URLs in [url_low, url_high)"""
+        sketch = HyperLogLog(self.precision)
+        if url_low is None:
+            condition, params = 'url = ? AND country_code = ? AND city = ?', [SKETCH_ANY] * 3
+            url_clause, url_params = '', []
+        else:
+            condition, params = 'url >= ? AND url < ? AND country_code = ? AND city = ?', \
+                [url_low, url_high, SKETCH_ANY, SKETCH_ANY]
+            url_clause, url_params = ' AND url_id IN (SELECT id FROM urls WHERE url >= ? AND url < ?)', [url_low, url_high]
+        for _, _, _, blob in self._sketches(conn, start_time, condition, params):
+            sketch.merge(blob)
+        for session_id, in self._raw(conn, start_time, f'''
+            SELECT session_id FROM {{table}} WHERE timestamp >= ? AND timestamp < ?{url_clause}
+        ''', url_params):
+            if session_id:
+                sketch.add(session_id)
+        return sketch.estimate()
+    
+    def estimate_regions(self, conn: sqlite3.Connection, start_time: datetime, country_code: Optional[str] = None,
+                         city: Optional[str] = None) -> Tuple[Dict[Tuple[str, str], int], Dict[str, int]]:
+        """Unique visitors since start_time per (country_code, city) and per country_code"""
+        condition, params = 'url = ? AND country_code != ?', [SKETCH_ANY, SKETCH_ANY]
+        region_clause, region_params = '', []
+        if country_code:
+            condition += ' AND country_code = ?'
+            region_clause += ' AND country_code = ?'
+            params.append(country_code)
+            region_params.append(country_code)
+        if city:
+            condition += ' AND city = ?'
+            region_clause += ' AND city = ?'
+            params.append(city)
+            region_params.append(city)
+        cities = {}
+        for _, row_country, row_city, blob in self._sketches(conn, start_time, condition, params):
+            sketch = cities.get((row_country, row_city))
+            if sketch is None:
+                sketch = cities[(row_country, row_city)] = HyperLogLog(self.precision)
+            sketch.merge(blob)
+        for row_country, row_city, session_id in self._raw(conn, start_time, f'''
+            SELECT country_code, city, session_id FROM {{table}}
+            JOIN cities ON cities.id = city_id
+            WHERE timestamp >= ? AND timestamp < ?{region_clause}
+        ''', region_params):
+            if session_id:
+                sketch = cities.get((row_country, row_city))
+                if sketch is None:
+                    sketch = cities[(row_country, row_city)] = HyperLogLog(self.precision)
+                sketch.add(session_id)
+        # A country's sketch is the union of its cities'
+        countries = {}
+        for (row_country, _), sketch in cities.items():
+            if row_country not in countries:
+                countries[row_country] = HyperLogLog(self.precision)
+            countries[row_country].union(sketch)
+        return ({key: sketch.estimate() for key, sketch in cities.items()},
+                {code: sketch.estimate() for code, sketch in countries.items()})
+
+# Heavy hitters. Every hour and day bucket keeps a Space-Saving summary of
+# its most viewed pages, cities and countries: at most TOP_K_CAPACITY
+# counters per dimension, with SKETCH_ANY in the columns a dimension spans, as
+# in the visitor sketches. A counter overstates its item's pageviews by at
+# most its error, and an item without one had no more than the bucket's
+# smallest counter, so any item with over 1/TOP_K_CAPACITY of a bucket's
+# pageviews holds a counter.
+TOP_K_CAPACITY = 256
+TOP_K_TABLES = ('top_k_hour', 'top_k_day')
+# Each dimension's (url, country_code, city) columns; None for the spanned ones
+TOP_K_DIMENSIONS = {
+    'page': ('url', None, None),
+    'city': (None, 'country_code', 'city'),
+    'country': (None, 'country_code', None)
+}
+
+def space_saving(counters: Dict[Tuple, List[int]], increments: Dict[Tuple, int], capacity: int):
+    """Count weighted items into a Space-Saving summary of {item: [count, error]}, in place"""
+    # Smallest counter first; entries go stale as counts grow and are skipped
+    heap = [(count, item) for item, (count, _) in counters.items()]
+    heapq.heapify(heap)
+    for item, weight in sorted(increments.items(), key=itemgetter(1), reverse=True):
+        counter = counters.get(item)
+        if counter is not None:
+            counter[0] += weight
+        elif len(counters) < capacity:
+            counter = counters[item] = [weight, 0]
+        else:
+            while True:
+                floor, evicted = heapq.heappop(heap)
+                if counters.get(evicted, (None,))[0] == floor:
+                    break
+            del counters[evicted]
+            counter = counters[item] = [floor + weight, floor]
+        heapq.heappush(heap, (counter[0], item))
+
+class HeavyHitters:
+    """Top pages, cities and countries per hour and day, kept up to date by the ingest writer.
+    
+    A top N query adds up the counters of the day buckets in the middle of the
+    range and the hour buckets at its ends, plus the minute rollups of the
+    part-hour at its start, so it costs the same however much traffic the
+    range saw.
+    """
+    def __init__(self, capacity: int = TOP_K_CAPACITY):
+        self.capacity = capacity
+        self._pruned_at = datetime.min
+    
+    def sync(self, conn: sqlite3.Connection) -> bool:
+        """Build the summaries from the rollups if they were never built; returns whether it did"""
+        if conn.execute('SELECT 1 FROM top_k_day LIMIT 1').fetchone() is not None or \
+                conn.execute('SELECT 1 FROM rollup_day LIMIT 1').fetchone() is None:
+            return False
+        self.rebuild(conn)
+        return True
+    
+    def rebuild(self, conn: sqlite3.Connection):
+        """Recompute every summary from the hour and day rollups, which hold each bucket's exact counts"""
+        hour_cutoff = sketch_hour_cutoff()
+        for table, (rollup, _, _) in zip(TOP_K_TABLES, ROLLUP_GRANULARITIES[1:]):
+            conn.execute(f'DELETE FROM {table}')
+            for columns in TOP_K_DIMENSIONS.values():
+                keys = [column or f"'{SKETCH_ANY}'" for column in columns]
+                conn.execute(f'''
+                    INSERT INTO {table} (bucket, url, country_code, city, count, error)
+                    SELECT bucket, url, country_code, city, pageviews, 0 FROM (
+                        SELECT bucket, {keys[0]} AS url, {keys[1]} AS country_code, {keys[2]} AS city,
+                               SUM(pageviews) AS pageviews,
+                               ROW_NUMBER() OVER (PARTITION BY bucket ORDER BY SUM(pageviews) DESC) AS position
+                        FROM {rollup}
+                        WHERE bucket >= ?
+                        GROUP BY 1, 2, 3, 4
+                    )
+                    WHERE position <= ?
+                ''', (hour_cutoff if table == 'top_k_hour' else '', self.capacity))
+    
+    def update(self, conn: sqlite3.Connection, rows_by_table: Dict[str, List[Tuple]]):
+        """Count a written batch of pageviews into their buckets' summaries"""
+        rows = rows_by_table.get('pageviews')
+        if rows:
+            totals = {}
+            hour_format = ROLLUP_GRANULARITIES[1][1]
+            for row in rows:
+                key = (row[3].strftime(hour_format), row[2] or '', row[9] or '', row[11] or '')
+                totals[key] = totals.get(key, 0) + 1
+            increments = {}
+            for (hour, *values), count in totals.items():
+                # The day bucket is the hour bucket's date at midnight
+                buckets = (('top_k_hour', hour), ('top_k_day', hour[:11] + '00:00:00'))
+                for dimension, columns in TOP_K_DIMENSIONS.items():
+                    item = tuple(value if column else SKETCH_ANY for value, column in zip(values, columns))
+                    for table, bucket in buckets:
+                        counts = increments.setdefault((table, bucket, dimension), {})
+                        counts[item] = counts.get(item, 0) + count
+            for (table, bucket, dimension), counts in increments.items():
+                counters = {tuple(row[:3]): list(row[3:]) for row in conn.execute(f'''
+                    SELECT url, country_code, city, count, error FROM {table}
+                    WHERE bucket = ? AND {self._condition(dimension)}
+                ''', (bucket,))}
+                stored = set(counters)
+                space_saving(counters, counts, self.capacity)
+                conn.executemany(f'DELETE FROM {table} WHERE bucket = ? AND url = ? AND country_code = ? AND city = ?',
+                                 [(bucket,) + item for item in stored - counters.keys()])
+                conn.executemany(f'''
+                    INSERT OR REPLACE INTO {table} (bucket, url, country_code, city, count, error)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', [(bucket,) + item + tuple(counters[item]) for item in counts if item in counters])
+        now = datetime.now()
+        if now - self._pruned_at > timedelta(hours=1):
+            conn.execute('DELETE FROM top_k_hour WHERE bucket < ?', (sketch_hour_cutoff(),))
+            self._pruned_at = now
+    
+    def _condition(self, dimension: str) -> str:
+        # Unary + keeps SQLite from skip-scanning the primary key on url instead of seeking the buckets
+        return ' AND '.join(f"+{name} {'!=' if column else '='} '{SKETCH_ANY}'"
+                            for name, column in zip(('url', 'country_code', 'city'), TOP_K_DIMENSIONS[dimension]))
+    
+    def top(self, conn: sqlite3.Connection, dimension: str, start_time: datetime,
+            limit: int) -> List[Tuple[str, str, str, int, int]]:
+        """The limit items of a dimension with the most pageviews since start_time, as (url, country_code, city, count, error)"""
+        condition = self._condition(dimension)
+        raw_end, spans = hour_day_spans(start_time, *TOP_K_TABLES)
+        keys = [column or f"'{SKETCH_ANY}'" for column in TOP_K_DIMENSIONS[dimension]]
+        # The part-hour before the first hour bucket comes from the minute rollups
+        parts = [f'''
+            SELECT {keys[0]} AS url, {keys[1]} AS country_code, {keys[2]} AS city, SUM(pageviews) AS count, 0 AS error
+            FROM rollup_minute WHERE bucket >= ? AND bucket < ?
+            GROUP BY 1, 2, 3
+        ''']
+        params = [start_time, raw_end]
+        for table, low, high in spans:
+            if high is not None and low >= high:
+                continue
+            parts.append(f'''
+                SELECT url, country_code, city, count, error FROM {table}
+                WHERE bucket >= ?{' AND bucket < ?' if high is not None else ''} AND {condition}
+            ''')
+            params += [low] + ([high] if high is not None else [])
+        return conn.execute(f'''
+            SELECT url, country_code, city, SUM(count), SUM(error) FROM ({' UNION ALL '.join(parts)})
+            GROUP BY url, country_code, city
+            ORDER BY 4 DESC
+            LIMIT ?
+        ''', params + [limit]).fetchall()
+
+# Duration percentiles. Every hour and day bucket stores its time on page
+# bin counts as rows (per URL, per city and for all traffic, with SKETCH_ANY
+# in the columns a row spans), and a query sums them in SQL.
+DURATION_PERCENTILES = (50, 75, 95, 99)
+DURATION_TABLES = ('time_on_page_bins_hour', 'time_on_page_bins_day')
+
+def duration_percentiles(bins: Iterable[Tuple[int, int]],
+                         percentiles: Tuple[int, ...] = DURATION_PERCENTILES) -> Dict[str, Optional[float]]:
+    """{'p50': value, ...} from (bin, count) pairs; None for every percentile when there are no values"""
+    bins = sorted(bins)
+    total = sum(count for _, count in bins)
+    result = {}
+    for percentile in percentiles:
+        value = None
+        if total:
+            rank = percentile / 100 * (total - 1)
+            seen = 0
+            for index, count in bins:
+                seen += count
+                if seen > rank:
+                    break
+            value = 0.0 if index == DURATION_ZERO_BIN else \
+                round(2 * DURATION_GAMMA ** index / (DURATION_GAMMA + 1), 2)
+        result[f'p{percentile}'] = value
+    return result
+
+class DurationSketches:
+    """Time on page bin counts per hour and day, kept up to date by the ingest writer.
+    
+    Percentiles for a time range sum the day buckets in the middle of it, the
+    hour buckets at its ends and the binned raw pageviews of the part-hour at
+    its start.
+    """
+    def __init__(self, partitions: PartitionRouter):
+        self.partitions = partitions
+        self._pruned_at = datetime.min
+    
+    def sync(self, conn: sqlite3.Connection) -> bool:
+        """Fill the bins from the raw pageviews if they were never built; returns whether it did"""
+        if conn.execute('SELECT 1 FROM time_on_page_bins_day LIMIT 1').fetchone() is not None or \
+                not any(conn.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone()
+                        for table in self.partitions.tables(conn, 'pageview_log')):
+            return False
+        self.rebuild(conn)
+        return True
+    
+    def rebuild(self, conn: sqlite3.Connection):
+        """Recount the bins of every bucket the raw pageviews still cover"""
+        partitions = log_partitions(conn, 'pageview_log')
+        if not partitions:
+            return
+        hour_cutoff = sketch_hour_cutoff()
+        for table, (_, bucket_format, _) in zip(DURATION_TABLES, SKETCH_GRANULARITIES):
+            start = max(partitions[0].strftime(bucket_format), hour_cutoff if table == DURATION_TABLES[0] else '')
+            conn.execute(f'DELETE FROM {table} WHERE bucket >= ?', (start,))
+            for partition in self.partitions.tables(conn, 'pageview_log'):
+                for columns in (f"COALESCE(url, ''), '{SKETCH_ANY}', '{SKETCH_ANY}'",
+                                f"'{SKETCH_ANY}', COALESCE(country_code, ''), COALESCE(city, '')",
+                                f"'{SKETCH_ANY}', '{SKETCH_ANY}', '{SKETCH_ANY}'"):
+                    conn.execute(f'''
+                        INSERT INTO {table} (bucket, url, country_code, city, bin, count)
+                        SELECT strftime('{bucket_format}', timestamp), {columns}, duration_bin(time_on_page), COUNT(*)
+                        FROM {partition}
+                        LEFT JOIN urls ON urls.id = url_id
+                        LEFT JOIN cities ON cities.id = city_id
+                        WHERE timestamp >= ? AND time_on_page IS NOT NULL
+                        GROUP BY 1, 2, 3, 4, 5
+                    ''', (start,))
+    
+    def update(self, conn: sqlite3.Connection, rows_by_table: Dict[str, List[Tuple]]):
+        """Count a written batch of pageviews into their buckets' bins"""
+        rows = rows_by_table.get('pageviews')
+        if rows:
+            counts = {}
+            hour_cutoff = sketch_hour_cutoff()
+            (_, hour_format, _), _ = SKETCH_GRANULARITIES
+            hour_table, day_table = DURATION_TABLES
+            for row in rows:
+                if row[7] is None:
+                    continue
+                index = duration_bin(row[7])
+                hour = row[3].strftime(hour_format)
+                # The day bucket is the hour bucket's date at midnight
+                for table, bucket in ((hour_table, hour), (day_table, hour[:11] + '00:00:00')):
+                    if table == hour_table and bucket < hour_cutoff:
+                        continue
+                    for key in ((table, bucket, row[2] or '', SKETCH_ANY, SKETCH_ANY, index),
+                                (table, bucket, SKETCH_ANY, row[9] or '', row[11] or '', index),
+                                (table, bucket, SKETCH_ANY, SKETCH_ANY, SKETCH_ANY, index)):
+                        counts[key] = counts.get(key, 0) + 1
+            for table in DURATION_TABLES:
+                conn.executemany(f'''
+                    INSERT INTO {table} (bucket, url, country_code, city, bin, count) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (bucket, url, country_code, city, bin) DO UPDATE SET count = count + excluded.count
+                ''', [key[1:] + (count,) for key, count in counts.items() if key[0] == table])
+        now = datetime.now()
+        if now - self._pruned_at > timedelta(hours=1):
+            conn.execute('DELETE FROM time_on_page_bins_hour WHERE bucket < ?', (sketch_hour_cutoff(),))
+            self._pruned_at = now
+    
+    def _percentiles(self, conn: sqlite3.Connection, start_time: datetime, condition: str, params: List,
+                     raw_clause: str, raw_params: List) -> Dict[str, Optional[float]]:
+        raw_end, spans = hour_day_spans(start_time, *DURATION_TABLES)
+        parts, all_params = [], []
+        for table in self.partitions.tables(conn, 'pageview_log', start_time, raw_end):
+            parts.append(f'''
+                SELECT duration_bin(time_on_page) AS bin, COUNT(*) AS count FROM {table}
+                WHERE timestamp >= ? AND timestamp < ? AND time_on_page IS NOT NULL{raw_clause}
+                GROUP BY 1
+            ''')
+            all_params += [start_time, raw_end] + raw_params
+        now = datetime.now()
+        for table, low, high in spans:
+            _, bucket_format, step = SKETCH_GRANULARITIES[DURATION_TABLES.index(table)]
+            # Listing the buckets lets SQLite seek each one's rows for the grouping instead of reading them all
+            buckets = []
+            while low < (high or now):
+                buckets.append(low.strftime(bucket_format))
+                low += step
+            if not buckets:
+                continue
+            parts.append(f'''
+                SELECT bin, count FROM {table}
+                WHERE bucket IN ({", ".join("?" * len(buckets))}) AND {condition}
+            ''')
+            all_params += buckets + params
+        return duration_percentiles(conn.execute(f'''
+            SELECT bin, SUM(count) FROM ({' UNION ALL '.join(parts)}) GROUP BY bin
+        ''', all_params).fetchall())
+    
+    def percentiles(self, conn: sqlite3.Connection, start_time: datetime,
+                    url_low: Optional[str] = None, url_high: Optional[str] = None) -> Dict[str, Optional[float]]:
+        """Time on page percentiles since start_time, optionally only on URLs in [url_low, url_high)"""
+        if url_low is None:
+            return self._percentiles(conn, start_time, 'url = ? AND country_code = ? AND city = ?', [SKETCH_ANY] * 3,
+                                     '', [])
+        return self._percentiles(conn, start_time, 'url >= ? AND url < ? AND country_code = ?',
+                                 [url_low, url_high, SKETCH_ANY],
+                                 ' AND url_id IN (SELECT id FROM urls WHERE url >= ? AND url < ?)', [url_low, url_high])
+    
+    def region_percentiles(self, conn: sqlite3.Connection, start_time: datetime, country_code: Optional[str] = None,
+                           city: Optional[str] = None) -> Dict[str, Optional[float]]:
+        """Time on page percentiles since start_time in a country, a city or everywhere"""
+        if not country_code and not city:
+            return self.percentiles(conn, start_time)
+        condition, params = 'url = ? AND country_code != ?', [SKETCH_ANY, SKETCH_ANY]
+        region_conditions, region_params = [], []
+        if country_code:
+            region_conditions.append('country_code = ?')
+            region_params.append(country_code)
+        if city:
+            region_conditions.append('city = ?')
+            region_params.append(city)
+        condition += ''.join(' AND ' + clause for clause in region_conditions)
+        raw_clause = f" AND city_id IN (SELECT id FROM cities WHERE {' AND '.join(region_conditions)})"
+        return self._percentiles(conn, start_time, condition, params + region_params, raw_clause, region_params)
+
+# Major countries and cities for region-wise analytics
+MAJOR_COUNTRIES = {
+    'US': {'name': 'United States', 'cities': ['New York', 'Los Angeles', 'Chicago', 'Houston', 'Phoenix', 'Philadelphia', 'San Antonio', 'San Diego', 'Dallas', 'San Jose']},
+    'CN': {'name': 'China', 'cities': ['Shanghai', 'Beijing', 'Guangzhou', 'Shenzhen', 'Chengdu', 'Tianjin', 'Chongqing', 'Nanjing', 'Wuhan', 'Xi\'an']},
+    'IN': {'name': 'India', 'cities': ['Mumbai', 'Delhi', 'Bangalore', 'Hyderabad', 'Chennai', 'Kolkata', 'Pune', 'Ahmedabad', 'Surat', 'Jaipur']},
+    'GB': {'name': 'United Kingdom', 'cities': ['London', 'Birmingham', 'Manchester', 'Glasgow', 'Liverpool', 'Leeds', 'Sheffield', 'Edinburgh', 'Bristol', 'Cardiff']},
+    'DE': {'name': 'Germany', 'cities': ['Berlin', 'Hamburg', 'Munich', 'Cologne', 'Frankfurt', 'Stuttgart', 'Düsseldorf', 'Dortmund', 'Essen', 'Leipzig']},
+    'FR': {'name': 'France', 'cities': ['Paris', 'Marseille', 'Lyon', 'Toulouse', 'Nice', 'Nantes', 'Strasbourg', 'Montpellier', 'Bordeaux', 'Lille']},
+    'JP': {'name': 'Japan', 'cities': ['Tokyo', 'Yokohama', 'Osaka', 'Nagoya', 'Sapporo', 'Fukuoka', 'Kobe', 'Kyoto', 'Kawasaki', 'Saitama']},
+    'BR': {'name': 'Brazil', 'cities': ['São Paulo', 'Rio de Janeiro', 'Brasília', 'Salvador', 'Fortaleza', 'Belo Horizonte', 'Manaus', 'Curitiba', 'Recife', 'Porto Alegre']},
+    'CA': {'name': 'Canada', 'cities': ['Toronto', 'Montreal', 'Vancouver', 'Calgary', 'Edmonton', 'Ottawa', 'Winnipeg', 'Quebec City', 'Hamilton', 'Kitchener']},
+    'AU': {'name': 'Australia', 'cities': ['Sydney', 'Melbourne', 'Brisbane', 'Perth', 'Adelaide', 'Gold Coast', 'Newcastle', 'Canberra', 'Sunshine Coast', 'Wollongong']},
+    'RU': {'name': 'Russia', 'cities': ['Moscow', 'Saint Petersburg', 'Novosibirsk', 'Yekaterinburg', 'Kazan', 'Nizhny Novgorod', 'Chelyabinsk', 'Samara', 'Omsk', 'Rostov']},
+    'KR': {'name': 'South Korea', 'cities': ['Seoul', 'Busan', 'Incheon', 'Daegu', 'Daejeon', 'Gwangju', 'Suwon', 'Ulsan', 'Changwon', 'Seongnam']},
+    'IT': {'name': 'Italy', 'cities': ['Rome', 'Milan', 'Naples', 'Turin', 'Palermo', 'Genoa', 'Bologna', 'Florence', 'Bari', 'Catania']},
+    'ES': {'name': 'Spain', 'cities': ['Madrid', 'Barcelona', 'Valencia', 'Seville', 'Zaragoza', 'Málaga', 'Murcia', 'Palma', 'Las Palmas', 'Bilbao']},
+    'MX': {'name': 'Mexico', 'cities': ['Mexico City', 'Guadalajara', 'Monterrey', 'Puebla', 'Tijuana', 'Ciudad Juárez', 'León', 'Zapopan', 'Nezahualcóyotl', 'Guadalupe']}
+}
+
+class TrafficAnalytics:
+    def __init__(self, db_path: str = 'traffic_analytics.db', ingest_queue_size: int = 50000,
+                 ingest_batch_size: int = 1000, ingest_flush_interval: float = 0.5,
+                 read_connections: int = 4, sqlite_synchronous: str = 'NORMAL',
+                 sqlite_cache_size: int = -65536, sqlite_mmap_size: int = 268435456,
+                 realtime_counters: bool = True, response_cache_size: int = 1024,
+                 aggregation_backend: str = 'auto', session_idle_timeout: float = 1800,
+                 max_sessions: int = 200000, retention_days: int = 0,
+                 funnels: Optional[Dict[str, Dict]] = None, geoip_path: Optional[str] = None,
+                 hll_precision: int = HLL_PRECISION):
+        self.major_countries = MAJOR_COUNTRIES
+        self.db_path = db_path
+        # Places beacons that don't say where they come from; None leaves them unknown
+        self.geoip = GeoIndex.load(geoip_path) if geoip_path else None
+        self.aggregation_backend = resolve_aggregation_backend(aggregation_backend)
+        # Served on GET /metrics; RequestHandler records its requests here too
+        self.metrics = MetricsRegistry()
+        self.request_count = self.metrics.counter(
+            'jadtrax_http_requests_total', 'HTTP requests by method, endpoint and status', ('method', 'endpoint', 'status'))
+        self.request_seconds = self.metrics.histogram(
+            'jadtrax_http_request_seconds', 'Time to handle an HTTP request', ('method', 'endpoint'))
+        self.error_count = self.metrics.counter(
+            'jadtrax_errors_total', 'Responses that reported a failure, by endpoint', ('endpoint',))
+        self.db = ConnectionManager(db_path, read_connections=read_connections,
+                                    synchronous=sqlite_synchronous, cache_size=sqlite_cache_size,
+                                    mmap_size=sqlite_mmap_size, metrics=self.metrics)
+        self.init_database()
+        # Raw history older than this is dropped a partition at a time; None keeps everything
+        self.retention = timedelta(days=retention_days) if retention_days else None
+        self.partitions = PartitionRouter()
+        self._retention_applied_at = datetime.min
+        self.apply_retention()
+        self.funnels = FunnelTracker(FUNNELS if funnels is None else funnels, self.partitions)
+        self.sketches = VisitorSketches(self.partitions, hll_precision)
+        self.heavy_hitters = HeavyHitters()
+        self.durations = DurationSketches(self.partitions)
+        with self.db.writer() as conn:
+            self.funnels.sync(conn)
+            self.sketches.sync(conn)
+            self.heavy_hitters.sync(conn)
+            self.durations.sync(conn)
+        self.ingest = IngestQueue(self.db, max_size=ingest_queue_size, batch_size=ingest_batch_size,
+                                  flush_interval=ingest_flush_interval, partitions=self.partitions)
+        self.ingest.add_hook(self._update_rollups)
+        self.ingest.add_hook(self._update_heatmap_tiles)
+        self.ingest.add_hook(self._update_funnels)
+        self.ingest.add_hook(self.sketches.update)
+        self.ingest.add_hook(self.heavy_hitters.update)
+        self.ingest.add_hook(self.durations.update)
+        self.ingest.add_hook(self._apply_retention)
+        # Per-process, so prefork workers (which ingest independently) leave it off
+        self.realtime = None
+        if realtime_counters:
+            self.realtime = RealtimeCounters()
+            with self.db.reader() as conn:
+                self.realtime.load(conn)
+            self.ingest.add_commit_hook(self._update_realtime)
+        # Encoded GET /analytics/* responses; see RequestHandler.send_cached()
+        self.response_cache = ResponseCache(response_cache_size)
+        self.ingest.add_commit_hook(self._invalidate_responses)
+        self._rollups_pruned_at = datetime.min
+        self.sessions = SessionStore(self._write_sessions, idle_timeout=session_idle_timeout,
+                                     max_sessions=max_sessions)
+        self.sessions_dropped = 0
+        self.heatmap_data = {}
+        self.alerts = []
+        self._add_collected_metrics()
+        
+    def init_database(self):
+        """Create or upgrade the database in place; existing history is kept"""
+        with self.db.writer() as conn:
+            self.migrate(conn)
+            
+            # self.insert_sample_data(cursor)  # Disabled: Only real tracked data will be stored
+
+    def migrate(self, conn: sqlite3.Connection) -> int:
+        """Apply pending MIGRATIONS, one transaction per step; returns the schema version.
+        
+        A database already at the latest version costs a single query, so
+        startup time doesn't depend on how much history is stored. Steps only
+        add tables, columns and indexes unless they can't avoid a rewrite.
+        """
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at DATETIME
+            )
         ''')
+        conn.commit()
+        current = conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+        if current >= MIGRATIONS[-1][0]:
+            return current
+        
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            # IMMEDIATE takes the write lock up front, so a second process
+            # starting against the same file waits and then sees our version
+            conn.execute('BEGIN IMMEDIATE')
+            applied = conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+            if version > applied:
+                if version == 1:
+                    self._adopt_unversioned_tables(conn)
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(statement)
+                conn.execute('INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                             (version, description, datetime.now()))
+            conn.commit()
+            current = max(version, applied)
+        
+        return current
+
+    def _adopt_unversioned_tables(self, conn: sqlite3.Connection):
+        """Bring tables created before schema_version existed up to the version 1 columns.
+        
+        Older releases dropped the database on every start and created the tables
+        with fewer columns. Missing columns are added with ALTER TABLE ADD COLUMN,
+        which only touches the schema, never the stored rows.
+        """
+        existing_tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        
+        reference = sqlite3.connect(':memory:')
+        try:
+            for statement in MIGRATIONS[0][2]:
+                reference.execute(statement)
+            for table in existing_tables:
+                expected = reference.execute(f'PRAGMA table_info({table})').fetchall()
+                if not expected:
+                    continue
+                present = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+                for _, column, column_type, _, _, _ in expected:
+                    if column not in present:
+                        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+        finally:
+            reference.close()
+
+    def close(self):
+        """Flush buffered writes; call before the process exits"""
+        self.sessions.close()
+        self.ingest.close()
+        self.db.close()
+        if self.geoip is not None:
+            self.geoip.close()
+
+    def _add_collected_metrics(self):
+        """Metrics copied from the ingest queue, caches and session store whenever /metrics is rendered"""
+        metrics = self.metrics
+        queue_depth = metrics.gauge('jadtrax_ingest_queue_depth', 'Tracked rows waiting for the ingest writer')
+        rows_written = metrics.counter('jadtrax_ingest_rows_written_total', 'Rows committed by the ingest writer',
+                                       ('table',))
+        batches = metrics.counter('jadtrax_ingest_batches_total', 'Write transactions committed by the ingest writer')
+        rows_rejected = metrics.counter('jadtrax_ingest_rows_rejected_total',
+                                        'Tracked rows refused because the ingest queue was full')
+        rows_dropped = metrics.counter('jadtrax_ingest_rows_dropped_total',
+                                       'Rows lost to ingest writer errors')
+        cache_lookups = metrics.counter('jadtrax_cache_lookups_total', 'Cache lookups by cache and result',
+                                        ('cache', 'result'))
+        cache_entries = metrics.gauge('jadtrax_cache_entries', 'Entries held per cache', ('cache',))
+        live_sessions = metrics.gauge('jadtrax_sessions_live', 'Sessions kept in memory')
+        closed_sessions = metrics.counter('jadtrax_sessions_closed_total', 'Sessions written out, by why they closed',
+                                          ('reason',))
+        rss = metrics.gauge('process_resident_memory_bytes', 'Resident memory size in bytes')
+        
+        def collect():
+            queue_depth.set(self.ingest.depth())
+            for table, rows in list(self.ingest.written_by_table.items()):
+                rows_written.set(rows, (table,))
+            batches.set(self.ingest.stats['batches'])
+            rows_rejected.set(self.ingest.stats['rejected'])
+            rows_dropped.set(self.ingest.stats['dropped'])
+            responses = self.response_cache.snapshot()
+            caches = [('response', responses['hits'], responses['misses'], responses['entries']),
+                      ('user_agent',) + itemgetter(0, 1, 3)(classify_user_agent.cache_info()),
+                      ('referrer',) + itemgetter(0, 1, 3)(classify_source.cache_info())]
+            if self.geoip is not None:
+                caches.append(('geoip',) + itemgetter(0, 1, 3)(self.geoip.lookup.cache_info()))
+            for cache, hits, misses, entries in caches:
+                cache_lookups.set(hits, (cache, 'hit'))
+                cache_lookups.set(misses, (cache, 'miss'))
+                cache_entries.set(entries, (cache,))
+            live_sessions.set(len(self.sessions))
+            for reason in ('expired', 'evicted'):
+                closed_sessions.set(self.sessions.stats[reason], (reason,))
+            rss.set(process_rss())
+        
+        metrics.add_collector(collect)
+    
+    def record_request(self, method: str, path: str, status: Optional[int], failed: bool, seconds: float):
+        """Count one handled HTTP request; RequestHandler calls this after every GET and POST"""
+        endpoint = path.split('?', 1)[0]
+        if endpoint not in METRICS_ENDPOINTS:
+            endpoint = 'other'
+        self.request_count.inc((method, endpoint, status))
+        # A stream lasts as long as its client stays, which says nothing about latency
+        if endpoint != '/analytics/stream':
+            self.request_seconds.observe(seconds, (method, endpoint))
+        if failed:
+            self.error_count.inc((endpoint,))
+
+    def _write_sessions(self, rows: List[Tuple]):
+        """SessionStore sink: queue closed sessions for the sessions table"""
+        try:
+            self.ingest.put_many([('sessions', row) for row in rows])
+        except IngestQueueFull as e:
+            self.sessions_dropped += len(rows) - e.accepted
+
+    def _update_rollups(self, conn: sqlite3.Connection, rows_by_table: Dict[str, List[Tuple]]):
+        """Ingest hook: fold a batch of pageviews into the rollup tables"""
+        rows = rows_by_table.get('pageviews')
+        if not rows:
+            return
+        
+        for table, bucket_format, _ in ROLLUP_GRANULARITIES:
+            totals = {}
+            for row in rows:
+                key = (row[3].strftime(bucket_format), row[2] or '', row[9] or '', row[11] or '',
+                       classify_source(row[6]), classify_user_agent(row[4])[0])
+                total = totals.get(key)
+                if total is None:
+                    total = totals[key] = [row[10] or '', 0, 0, 0]
+                total[1] += 1
+                total[2] += 1 if row[8] else 0
+                total[3] += row[7] or 0
+            conn.executemany(f'''
+                INSERT INTO {table} ({ROLLUP_COLUMNS})
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (bucket, url, country_code, city, source_type, device_type) DO UPDATE SET
+                    pageviews = pageviews + excluded.pageviews,
+                    bounces = bounces + excluded.bounces,
+                    time_on_page_sum = time_on_page_sum + excluded.time_on_page_sum
+            ''', [(bucket, url, country_code, total[0], city, source_type, device_type, total[1], total[2], total[3])
+                  for (bucket, url, country_code, city, source_type, device_type), total in totals.items()])
+        
+        now = datetime.now()
+        if now - self._rollups_pruned_at > timedelta(hours=1):
+            conn.execute('DELETE FROM rollup_minute WHERE bucket < ?', (now - ROLLUP_MINUTE_RETENTION,))
+            self._rollups_pruned_at = now
+
+    def _apply_retention(self, conn: sqlite3.Connection, rows_by_table: Dict[str, List[Tuple]]):
+        """Ingest hook: drop expired partitions, at most once an hour"""
+        now = datetime.now()
+        if self.retention is not None and now - self._retention_applied_at > timedelta(hours=1):
+            self.partitions.drop_before(conn, now - self.retention)
+            self._retention_applied_at = now
+
+    def apply_retention(self) -> int:
+        """Drop raw partitions that ended before the retention period; returns how many were dropped"""
+        if self.retention is None:
+            return 0
+        now = datetime.now()
+        with self.db.writer() as conn:
+            dropped = self.partitions.drop_before(conn, now - self.retention)
+        self._retention_applied_at = now
+        return dropped
+
+    def _update_realtime(self, rows_by_table: Dict[str, List[Tuple]]):
+        """Ingest commit hook: count written pageviews in the realtime windows"""
+        rows = rows_by_table.get('pageviews')
+        if rows:
+            self.realtime.add_many((row[1], row[3].timestamp()) for row in rows)
+
+    def _invalidate_responses(self, rows_by_table: Dict[str, List[Tuple]]):
+        """Ingest commit hook: evict cached heatmaps of pages that just got new points"""
+        for page_url in {row[1] for row in rows_by_table.get('heatmaps', ())}:
+            self.response_cache.invalidate_prefix(('heatmap', page_url))
+
+    def _update_heatmap_tiles(self, conn: sqlite3.Connection, rows_by_table: Dict[str, List[Tuple]]):
+        """Ingest hook: count a batch of heatmap points into every pyramid level"""
+        rows = rows_by_table.get('heatmaps')
+        if not rows:
+            return
+        
+        counts = {}
+        for row in rows:
+            page_url, bucket = row[1] or '', row[5].strftime(HEATMAP_BUCKET_FORMAT)
+            rest = (row[4] or '', row[6] or '', row[7] or '')
+            x, y = max(row[2], 0), max(row[3], 0)
+            for level, cell_size in enumerate(HEATMAP_CELL_SIZES):
+                key = (page_url, level, bucket) + rest + (x // cell_size, y // cell_size)
+                counts[key] = counts.get(key, 0) + 1
+        conn.executemany(f'''
+            INSERT INTO heatmap_tiles ({HEATMAP_TILE_COLUMNS})
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (page_url, level, bucket, event_type, country_code, city, cell_x, cell_y)
+            DO UPDATE SET count = count + excluded.count
+        ''', [key + (count,) for key, count in counts.items()])
+
+    def _update_funnels(self, conn: sqlite3.Connection, rows_by_table: Dict[str, List[Tuple]]):
+        """Ingest hook: advance the conversion funnels and evict their cached responses"""
+        for name in self.funnels.update(conn, rows_by_table):
+            self.response_cache.invalidate_prefix(('funnel', name))
+
+    def rebuild_rollups(self):
+        """Recompute rollups, funnels, sketches, top lists, duration bins and realtime counters from raw history, e.g. after a bulk import that bypassed ingest"""
+        with self.db.writer() as conn:
+            backfill_rollups(conn)
+            backfill_heatmap_tiles(conn)
+            for name in self.funnels.funnels:
+                self.funnels.rebuild(conn, name)
+            self.sketches.rebuild(conn)
+            self.heavy_hitters.rebuild(conn)
+            self.durations.rebuild(conn)
+        if self.realtime is not None:
+            realtime = RealtimeCounters()
+            with self.db.reader() as conn:
+                realtime.load(conn)
+            self.realtime = realtime
+        self.response_cache.clear()
+
+    def _time_range_start(self, time_range: str) -> datetime:
+        now = datetime.now()
+        if time_range == '7d':
+            return now - timedelta(days=7)
+        elif time_range == '30d':
+            return now - timedelta(days=30)
+        return now - timedelta(hours=24)
+
+    def _log_union(self, conn: sqlite3.Connection, log: str, select: str, params: List,
+                   start: datetime, end: Optional[datetime] = None) -> Tuple[str, List]:
+        """UNION ALL of select, run against each partition of log that overlaps [start, end).
+        
+        select names the partition as {table} and binds params. With no
+        overlapping partition it runs against the newest one, whose rows the
+        caller's own time filter then leaves out.
+        """
+        tables = self.partitions.tables(conn, log, start, end) or self.partitions.tables(conn, log)[-1:]
+        return ' UNION ALL '.join(select.format(table=table) for table in tables), list(params) * len(tables)
+
+    def _pageview_facts(self, conn: sqlite3.Connection, start_time: datetime) -> Tuple[str, List]:
+        """SQL source for pageview totals since start_time, read mostly from rollups.
+        
+        The range is tiled with whole day buckets in the middle, hour buckets
+        next to them and minute buckets at both ends. Only the sub-minute sliver
+        at the start comes from raw pageviews. Rollups are updated in the same
+        transaction as the raw rows, so the open buckets at the end are current.
+        Columns: url, country_code, country_name, city, source_type, device_type,
+        pageviews, bounces, time_on_page_sum.
+        """
+        def ceil(moment: datetime, width: timedelta) -> datetime:
+            floored = floor(moment, width)
+            return floored if floored == moment else floored + width
+        
+        def floor(moment: datetime, width: timedelta) -> datetime:
+            if width >= timedelta(days=1):
+                return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+            if width >= timedelta(hours=1):
+                return moment.replace(minute=0, second=0, microsecond=0)
+            return moment.replace(second=0, microsecond=0)
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS heatmaps (
-                id TEXT PRIMARY KEY,
-                page_url TEXT,
-                x_coord INTEGER,
-                y_coord INTEGER,
-                event_type TEXT,
-                timestamp DATETIME,
-                country_code TEXT,
-                city TEXT
-            )
-        ''')
+        (minute_table, _, minute), (hour_table, _, hour), (day_table, _, day) = ROLLUP_GRANULARITIES
+        now = datetime.now()
+        minute_start, hour_start, day_start = ceil(start_time, minute), ceil(start_time, hour), ceil(start_time, day)
+        hour_end, day_end = floor(now, hour), floor(now, day)
+        
+        if day_start <= day_end:
+            spans = [(minute_table, minute_start, hour_start), (hour_table, hour_start, day_start),
+                     (day_table, day_start, day_end), (hour_table, day_end, hour_end),
+                     (minute_table, hour_end, None)]
+        elif hour_start <= hour_end:
+            spans = [(minute_table, minute_start, hour_start), (hour_table, hour_start, hour_end),
+                     (minute_table, hour_end, None)]
+        else:
+            spans = [(minute_table, minute_start, None)]
         
-        # self.insert_sample_data(cursor)  # Disabled: Only real tracked data will be stored
+        raw_sql, params = self._log_union(conn, 'pageview_log', '''
+            SELECT url, country_code, country_name, city, source_type(referrer) AS source_type,
+                   COALESCE(devices.device_type, 'Other') AS device_type,
+                   1 AS pageviews, CASE WHEN bounce = 1 THEN 1 ELSE 0 END AS bounces,
+                   COALESCE(time_on_page, 0) AS time_on_page_sum
+            FROM {table}
+            LEFT JOIN urls ON urls.id = url_id
+            LEFT JOIN referrers ON referrers.id = referrer_id
+            LEFT JOIN cities ON cities.id = city_id
+            LEFT JOIN user_agents ON user_agents.id = user_agent_id
+            LEFT JOIN devices ON devices.id = user_agents.device_id
+            WHERE timestamp >= ? AND timestamp < ?
+        ''', [start_time, minute_start], start_time, minute_start)
+        parts = [raw_sql]
+        for table, low, high in spans:
+            if high is not None and low >= high:
+                continue
+            parts.append(f'''
+                SELECT url, country_code, country_name, city, source_type, device_type,
+                       pageviews, bounces, time_on_page_sum
+                FROM {table} WHERE bucket >= ?{' AND bucket < ?' if high is not None else ''}
+            ''')
+            params.append(low)
+            if high is not None:
+                params.append(high)
         
-        conn.commit()
-        conn.close()
+        return ' UNION ALL '.join(parts), params
 
     def insert_sample_data(self, cursor):
         """Insert sample data for testing with regional information"""
+        queued = []
+        
         # Sample pageviews with regional data
         sample_urls = [
             'https://example.com',
@@ -181,11 +3535,9 @@ class TrafficAnalytics:
             country_info = self.major_countries[country_code]
             city = random.choice(country_info['cities'])
             
-            cursor.execute('''
-                INSERT INTO pageviews (id, session_id, url, timestamp, user_agent, ip_address, referrer, time_on_page, bounce, country_code, country_name, city, region, latitude, longitude)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                str(uuid.uuid4()),
+            # Partitioned tables are written through the ingest queue
+            queued.append(('pageviews', (
+                None,
                 session_id,
                 url,
                 timestamp,
@@ -200,7 +3552,7 @@ class TrafficAnalytics:
                 country_info['name'],
                 random.uniform(-90, 90),  # Latitude
                 random.uniform(-180, 180)  # Longitude
-            ))
+            )))
         
         # Sample traffic sources with regional data
         sources = ['Direct', 'Organic', 'Referral', 'Social', 'Paid']
@@ -243,11 +3595,8 @@ class TrafficAnalytics:
             else:  # 75% older
                 timestamp = datetime.now() - timedelta(hours=random.randint(1, 24))
             
-            cursor.execute('''
-                INSERT INTO heatmaps (id, page_url, x_coord, y_coord, event_type, timestamp, country_code, city)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                str(uuid.uuid4()),
+            queued.append(('heatmaps', (
+                None,
                 random.choice(sample_urls),
                 random.randint(100, 800),
                 random.randint(100, 600),
@@ -255,7 +3604,7 @@ class TrafficAnalytics:
                 timestamp,
                 country_code,
                 city
-            ))
+            )))
         
         # Sample SEO metrics with regional data
         for url in sample_urls:
@@ -277,125 +3626,91 @@ class TrafficAnalytics:
                     datetime.now(),
                     country_code
                 ))
+        
+        self.ingest.put_many(queued)
 
     def get_region_wise_analytics(self, time_range: str = '24h', country_code: str = None, city: str = None) -> Dict:
         """Get region-wise analytics data"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Calculate time range
-            now = datetime.now()
-            if time_range == '24h':
-                start_time = now - timedelta(hours=24)
-            elif time_range == '7d':
-                start_time = now - timedelta(days=7)
-            elif time_range == '30d':
-                start_time = now - timedelta(days=30)
-            else:
-                start_time = now - timedelta(hours=24)
-            
-            # Build query conditions
-            conditions = ['timestamp >= ?']
-            params = [start_time]
-            
-            if country_code:
-                conditions.append('country_code = ?')
-                params.append(country_code)
-            
-            if city:
-                conditions.append('city = ?')
-                params.append(city)
-            
-            where_clause = ' AND '.join(conditions)
-            
-            # Get regional pageviews
-            cursor.execute(f'''
-                SELECT country_code, country_name, city, COUNT(*) as pageviews, 
-                       COUNT(DISTINCT session_id) as unique_visitors,
-                       AVG(time_on_page) as avg_duration,
-                       SUM(CASE WHEN bounce = 1 THEN 1 ELSE 0 END) as bounces
-                FROM pageviews 
-                WHERE {where_clause}
-                GROUP BY country_code, country_name, city
-                ORDER BY pageviews DESC
-            ''', params)
-            
-            regional_data = []
-            for row in cursor.fetchall():
-                country_code, country_name, city, pageviews, unique_visitors, avg_duration, bounces = row
-                bounce_rate = (bounces / pageviews * 100) if pageviews > 0 else 0
+            with self.db.reader() as conn:
+                cursor = conn.cursor()
                 
-                regional_data.append({
-                    'country_code': country_code,
-                    'country_name': country_name,
-                    'city': city,
-                    'pageviews': pageviews,
-                    'unique_visitors': unique_visitors,
-                    'avg_duration': round(avg_duration or 0, 2),
-                    'bounce_rate': round(bounce_rate, 2)
-                })
-            
-            # Get top countries
-            cursor.execute(f'''
-                SELECT country_code, country_name, COUNT(*) as pageviews,
-                       COUNT(DISTINCT session_id) as unique_visitors
-                FROM pageviews 
-                WHERE {where_clause}
-                GROUP BY country_code, country_name
-                ORDER BY pageviews DESC
-                LIMIT 10
-            ''', params)
-            
-            top_countries = []
-            for row in cursor.fetchall():
-                country_code, country_name, pageviews, unique_visitors = row
-                top_countries.append({
-                    'country_code': country_code,
-                    'country_name': country_name,
-                    'pageviews': pageviews,
-                    'unique_visitors': unique_visitors
-                })
-            
-            # Get top cities
-            cursor.execute(f'''
-                SELECT city, country_name, COUNT(*) as pageviews,
-                       COUNT(DISTINCT session_id) as unique_visitors
-                FROM pageviews 
-                WHERE {where_clause}
-                GROUP BY city, country_name
-                ORDER BY pageviews DESC
-                LIMIT 15
-            ''', params)
-            
-            top_cities = []
-            for row in cursor.fetchall():
-                city, country_name, pageviews, unique_visitors = row
-                top_cities.append({
-                    'city': city,
-                    'country_name': country_name,
-                    'pageviews': pageviews,
-                    'unique_visitors': unique_visitors
-                })
-            
-            # Get regional traffic sources
-            cursor.execute(f'''
-                SELECT source_type, COUNT(*) as count
-                FROM traffic_sources 
-                WHERE {where_clause}
-                GROUP BY source_type
-            ''', params)
-            
-            regional_traffic_sources = dict(cursor.fetchall())
-            
-            # Get regional device breakdown (simulated)
-            regional_device_breakdown = {
-                'Desktop': 0,
-                'Mobile': 0,
-                'Tablet': 0
-            }
-            
-            conn.close()
+                start_time = self._time_range_start(time_range)
+                facts_sql, facts_params = self._pageview_facts(conn, start_time)
+                
+                # Build query conditions
+                conditions = []
+                filter_params = []
+                
+                if country_code:
+                    conditions.append('country_code = ?')
+                    filter_params.append(country_code)
+                
+                if city:
+                    conditions.append('city = ?')
+                    filter_params.append(city)
+                
+                filter_clause = ''.join(' AND ' + condition for condition in conditions)
+                
+                # Regional pageviews, bounces, durations and sources from the rollups
+                cursor.execute(f'''
+                    SELECT country_code, country_name, city, source_type, device_type,
+                           SUM(pageviews), SUM(bounces), SUM(time_on_page_sum)
+                    FROM ({facts_sql})
+                    WHERE 1 = 1{filter_clause}
+                    GROUP BY country_code, city, source_type, device_type
+                ''', facts_params + filter_params)
+                
+                cities, countries, regional_traffic_sources, devices = group_region_rows(cursor.fetchall(),
+                                                                                         self.aggregation_backend)
+                
+                # Unique visitors can't be summed from rollups; merge the visitor sketches
+                city_visitors, country_visitors = self.sketches.estimate_regions(conn, start_time, country_code, city)
+                percentiles = self.durations.region_percentiles(conn, start_time, country_code, city)
+                
+                regional_data = []
+                for (row_country, row_city), (row_country_name, pageviews, bounces, time_sum) in cities.items():
+                    bounce_rate = (bounces / pageviews * 100) if pageviews > 0 else 0
+                    
+                    regional_data.append({
+                        'country_code': row_country,
+                        'country_name': row_country_name,
+                        'city': row_city,
+                        'pageviews': pageviews,
+                        'unique_visitors': city_visitors.get((row_country, row_city), 0),
+                        'avg_duration': round(time_sum / pageviews if pageviews else 0, 2),
+                        'bounce_rate': round(bounce_rate, 2)
+                    })
+                regional_data.sort(key=lambda entry: entry['pageviews'], reverse=True)
+                
+                # Get top countries
+                top_countries = [
+                    {
+                        'country_code': row_country,
+                        'country_name': row_country_name,
+                        'pageviews': pageviews,
+                        'unique_visitors': country_visitors.get(row_country, 0)
+                    }
+                    for row_country, (row_country_name, pageviews) in
+                    sorted(countries.items(), key=lambda item: item[1][1], reverse=True)[:10]
+                ]
+                
+                # Get top cities
+                top_cities = [
+                    {
+                        'city': entry['city'],
+                        'country_name': entry['country_name'],
+                        'pageviews': entry['pageviews'],
+                        'unique_visitors': entry['unique_visitors']
+                    }
+                    for entry in regional_data[:15]
+                ]
+                
+                # Share of the region's pageviews per device type, in percent
+                regional_device_breakdown = dict.fromkeys(DEVICE_TYPES, 0)
+                total_pageviews = sum(devices.values())
+                for device_type, pageviews in devices.items():
+                    regional_device_breakdown[device_type] = round(pageviews / total_pageviews * 100, 1)
             
             return {
                 "success": True,
@@ -405,6 +3720,7 @@ class TrafficAnalytics:
                     "top_cities": top_cities,
                     "traffic_sources": regional_traffic_sources,
                     "device_breakdown": regional_device_breakdown,
+                    "duration_percentiles": percentiles,
                     "time_range": time_range,
                     "filter": {
                         "country_code": country_code,
@@ -440,198 +3756,226 @@ class TrafficAnalytics:
         combined = f"{ip_address}:{user_agent}:{int(time.time() / 3600)}"
         return hashlib.md5(combined.encode()).hexdigest()
 
+    def resolve_region(self, data: Dict) -> Tuple:
+        """(country_code, country_name, city, region, latitude, longitude) of a tracked record.
+        
+        A country sent by the client wins; otherwise the record's ip_address is
+        looked up in the GeoIP index.
+        """
+        country_code = data.get('country_code')
+        if country_code:
+            country_name = data.get('country_name') or self.major_countries.get(country_code, {}).get('name', country_code)
+            return (country_code, country_name, data.get('city'), data.get('region', country_name),
+                    data.get('latitude'), data.get('longitude'))
+        ip_address = data.get('ip_address')
+        if self.geoip is not None and isinstance(ip_address, str):
+            return self.geoip.lookup(ip_address) or UNKNOWN_REGION
+        return UNKNOWN_REGION
+
+    def _prepare_pageview(self, data: Dict) -> Tuple[str, Tuple]:
+        """Build the pageviews row; it counts towards its session once queued (see _touch_sessions)"""
+        check_record(data)
+        session_id = self.generate_session_id(data.get('ip_address', ''), data.get('user_agent', ''))
+        country_code, country_name, city, region, latitude, longitude = self.resolve_region(data)
+        
+        row = (
+            None,
+            session_id,
+            data['url'],
+            datetime.now(),
+            data.get('user_agent', ''),
+            data.get('ip_address', ''),
+            data.get('referrer', ''),
+            int(data.get('time_on_page') or 0),
+            bool(data.get('bounce', True)),
+            country_code,
+            country_name,
+            city,
+            region,
+            latitude,
+            longitude
+        )
+        return session_id, row
+
+    def _prepare_event(self, data: Dict) -> Tuple:
+        """Build the events row"""
+        check_record(data)
+        country_code, _, city, _, _, _ = self.resolve_region(data)
+        
+        return (
+            None,
+            data.get('session_id', ''),
+            data['event_type'],
+            json.dumps(data.get('event_data', {})),
+            datetime.now(),
+            data.get('page_url', ''),
+            country_code,
+            city
+        )
+
+    def _prepare_heatmap(self, data: Dict) -> Tuple:
+        """Build the heatmaps row"""
+        check_record(data)
+        country_code, _, city, _, _, _ = self.resolve_region(data)
+        
+        return (
+            None,
+            data['page_url'],
+            int(data['x_coord']),
+            int(data['y_coord']),
+            data['event_type'],
+            datetime.now(),
+            country_code,
+            city
+        )
+
+    def _touch_sessions(self, items: List[Tuple[str, Tuple]]):
+        """Count queued pageview rows towards their live sessions"""
+        for table, row in items:
+            if table == 'pageviews':
+                self.sessions.touch(row[1], row)
+
     def track_pageview(self, data: Dict) -> Dict:
         """Track a pageview with comprehensive analytics"""
         try:
-            session_id = self.generate_session_id(data.get('ip_address', ''), data.get('user_agent', ''))
-            
-            # Create or update session
-            if session_id not in self.sessions:
-                self.sessions[session_id] = {
-                    'start_time': datetime.now(),
-                    'page_count': 0,
-                    'pages': []
-                }
-            
-            self.sessions[session_id]['page_count'] += 1
-            self.sessions[session_id]['pages'].append({
-                'url': data['url'],
-                'timestamp': datetime.now(),
-                'time_on_page': data.get('time_on_page', 0)
-            })
-            
-            # Get regional data (simulated for demo)
-            country_code = data.get('country_code', random.choice(list(self.major_countries.keys())))
-            country_info = self.major_countries.get(country_code, self.major_countries['US'])
-            city = data.get('city', random.choice(country_info['cities']))
-            
-            # Store in database
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT INTO pageviews (id, session_id, url, timestamp, user_agent, ip_address, referrer, time_on_page, bounce, country_code, country_name, city, region, latitude, longitude)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                str(uuid.uuid4()),
-                session_id,
-                data['url'],
-                datetime.now(),
-                data.get('user_agent', ''),
-                data.get('ip_address', ''),
-                data.get('referrer', ''),
-                data.get('time_on_page', 0),
-                data.get('bounce', True),
-                country_code,
-                country_info['name'],
-                city,
-                country_info['name'],
-                data.get('latitude', random.uniform(-90, 90)),
-                data.get('longitude', random.uniform(-180, 180))
-            ))
-            
-            conn.commit()
-            conn.close()
+            session_id, row = self._prepare_pageview(data)
+            self.ingest.put('pageviews', row)
+            self.sessions.touch(session_id, row)
             
             return {"success": True, "session_id": session_id}
             
+        except IngestQueueFull as e:
+            return {"success": False, "error": str(e), "retry_after": 1}
         except Exception as e:
             return {"success": False, "error": str(e)}
 
     def track_event(self, data: Dict) -> Dict:
         """Track custom events (clicks, form submissions, etc.)"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Get regional data
-            country_code = data.get('country_code', random.choice(list(self.major_countries.keys())))
-            country_info = self.major_countries.get(country_code, self.major_countries['US'])
-            city = data.get('city', random.choice(country_info['cities']))
-            
-            cursor.execute('''
-                INSERT INTO events (id, session_id, event_type, event_data, timestamp, page_url, country_code, city)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                str(uuid.uuid4()),
-                data.get('session_id', ''),
-                data['event_type'],
-                json.dumps(data.get('event_data', {})),
-                datetime.now(),
-                data.get('page_url', ''),
-                country_code,
-                city
-            ))
-            
-            conn.commit()
-            conn.close()
+            self.ingest.put('events', self._prepare_event(data))
             
             return {"success": True}
             
+        except IngestQueueFull as e:
+            return {"success": False, "error": str(e), "retry_after": 1}
         except Exception as e:
             return {"success": False, "error": str(e)}
 
     def track_heatmap(self, data: Dict) -> Dict:
         """Track heatmap data (clicks, scrolls, mouse movements)"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Get regional data
-            country_code = data.get('country_code', random.choice(list(self.major_countries.keys())))
-            country_info = self.major_countries.get(country_code, self.major_countries['US'])
-            city = data.get('city', random.choice(country_info['cities']))
-            
-            cursor.execute('''
-                INSERT INTO heatmaps (id, page_url, x_coord, y_coord, event_type, timestamp, country_code, city)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                str(uuid.uuid4()),
-                data['page_url'],
-                data['x_coord'],
-                data['y_coord'],
-                data['event_type'],
-                datetime.now(),
-                country_code,
-                city
-            ))
-            
-            conn.commit()
-            conn.close()
+            self.ingest.put('heatmaps', self._prepare_heatmap(data))
             
             return {"success": True}
             
+        except IngestQueueFull as e:
+            return {"success": False, "error": str(e), "retry_after": 1}
         except Exception as e:
             return {"success": False, "error": str(e)}
 
-    def get_analytics_summary(self, url: str = None, time_range: str = '24h') -> Dict:
-        """Get comprehensive analytics summary"""
+    def track_batch(self, records: List[Dict]) -> Dict:
+        """Track a mixed list of pageview, event and heatmap records in one pass.
+        
+        Each record carries a "type" of pageview, event or heatmap plus the same
+        fields the single-record endpoints take. Invalid records are reported by
+        index and skipped; the rest are enqueued together. next_index is the
+        index of the first record that wasn't queued, so a client can resend
+        records[next_index:] (less the invalid ones) after a 503.
+        """
+        items = []
+        # Index in records of each queued item
+        indexes = []
+        errors = []
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Calculate time range
-            now = datetime.now()
-            if time_range == '24h':
-                start_time = now - timedelta(hours=24)
-            elif time_range == '7d':
-                start_time = now - timedelta(days=7)
-            elif time_range == '30d':
-                start_time = now - timedelta(days=30)
-            else:
-                start_time = now - timedelta(hours=24)
+            if len(records) > MAX_BATCH_RECORDS:
+                raise ValueError(f"Batch holds more than {MAX_BATCH_RECORDS} records")
             
-            # Pageviews
-            cursor.execute('''
-                SELECT COUNT(*) FROM pageviews 
-                WHERE timestamp >= ? AND (? IS NULL OR url LIKE ?)
-            ''', (start_time, url, f'%{url}%' if url else None))
-            pageviews = cursor.fetchone()[0]
-            
-            # Unique visitors (sessions)
-            cursor.execute('''
-                SELECT COUNT(DISTINCT session_id) FROM pageviews 
-                WHERE timestamp >= ? AND (? IS NULL OR url LIKE ?)
-            ''', (start_time, url, f'%{url}%' if url else None))
-            unique_visitors = cursor.fetchone()[0]
-            
-            # Bounce rate
-            cursor.execute('''
-                SELECT COUNT(*) FROM pageviews 
-                WHERE timestamp >= ? AND bounce = 1 AND (? IS NULL OR url LIKE ?)
-            ''', (start_time, url, f'%{url}%' if url else None))
-            bounces = cursor.fetchone()[0]
-            bounce_rate = (bounces / pageviews * 100) if pageviews > 0 else 0
-            
-            # Average session duration
-            cursor.execute('''
-                SELECT AVG(time_on_page) FROM pageviews 
-                WHERE timestamp >= ? AND (? IS NULL OR url LIKE ?)
-            ''', (start_time, url, f'%{url}%' if url else None))
-            avg_duration = cursor.fetchone()[0] or 0
+            for index, record in enumerate(records):
+                try:
+                    if not isinstance(record, dict):
+                        raise ValueError('Record must be a JSON object')
+                    record_type = record.get('type')
+                    if record_type == 'pageview':
+                        items.append(('pageviews', self._prepare_pageview(record)[1]))
+                    elif record_type == 'event':
+                        items.append(('events', self._prepare_event(record)))
+                    elif record_type == 'heatmap':
+                        items.append(('heatmaps', self._prepare_heatmap(record)))
+                    else:
+                        errors.append({"index": index, "error": f"Unknown record type: {record_type}"})
+                        continue
+                    indexes.append(index)
+                except Exception as e:
+                    errors.append({"index": index, "error": f"Invalid record: {e}"})
             
-            # Traffic sources
-            cursor.execute('''
-                SELECT source_type, COUNT(*) FROM traffic_sources 
-                WHERE timestamp >= ? GROUP BY source_type
-            ''', (start_time,))
-            traffic_sources = dict(cursor.fetchall())
+            self.ingest.put_many(items)
+            self._touch_sessions(items)
             
-            # Top pages
-            cursor.execute('''
-                SELECT url, COUNT(*) as count FROM pageviews 
-                WHERE timestamp >= ? GROUP BY url ORDER BY count DESC LIMIT 10
-            ''', (start_time,))
-            top_pages = [{'url': row[0], 'count': row[1]} for row in cursor.fetchall()]
-            
-            # Device breakdown (simulated)
-            device_breakdown = {
-                'Desktop': 0,
-                'Mobile': 0,
-                'Tablet': 0
-            }
+            return {"success": True, "accepted": len(items), "next_index": len(records), "errors": errors}
             
-            conn.close()
+        except IngestQueueFull as e:
+            self._touch_sessions(items[:e.accepted])
+            # Records are enqueued in order, so the client can resend the tail
+            next_index = indexes[e.accepted] if e.accepted < len(indexes) else len(records)
+            return {"success": False, "error": str(e), "retry_after": 1,
+                    "accepted": e.accepted, "next_index": next_index, "errors": errors}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def get_analytics_summary(self, url: str = None, time_range: str = '24h', exact: bool = False) -> Dict:
+        """Get comprehensive analytics summary; top pages are exact counts only if exact is set"""
+        try:
+            with self.db.reader() as conn:
+                cursor = conn.cursor()
+                
+                start_time = self._time_range_start(time_range)
+                facts_sql, facts_params = self._pageview_facts(conn, start_time)
+                # A url filter matches that exact URL and every URL under it
+                url_low, url_high = url_prefix_range(url) if url else (None, None)
+                
+                # One pass over the rollups: pageviews, bounces, time on page, sources, devices
+                # and, when they are counted exactly, top pages. Otherwise rows are only told
+                # apart by whether they match the url filter.
+                if exact:
+                    key, key_params = 'url', []
+                elif url_low is None:
+                    key, key_params = '1', []
+                else:
+                    key, key_params = 'url >= ? AND url < ?', [url_low, url_high]
+                cursor.execute(f'''
+                    SELECT {key} AS page, source_type, device_type, SUM(pageviews), SUM(bounces), SUM(time_on_page_sum)
+                    FROM ({facts_sql})
+                    GROUP BY page, source_type, device_type
+                ''', key_params + facts_params)
+                
+                pageviews = bounces = time_on_page_sum = 0
+                traffic_sources = {}
+                page_counts = {}
+                device_breakdown = dict.fromkeys(DEVICE_TYPES, 0)
+                for page, source_type, device_type, row_pageviews, row_bounces, row_time in cursor.fetchall():
+                    traffic_sources[source_type] = traffic_sources.get(source_type, 0) + row_pageviews
+                    if exact:
+                        page_counts[page] = page_counts.get(page, 0) + row_pageviews
+                        matches = url_low is None or url_low <= page < url_high
+                    else:
+                        matches = page
+                    if matches:
+                        pageviews += row_pageviews
+                        bounces += row_bounces
+                        time_on_page_sum += row_time
+                        device_breakdown[device_type] = device_breakdown.get(device_type, 0) + row_pageviews
+                bounce_rate = (bounces / pageviews * 100) if pageviews > 0 else 0
+                avg_duration = (time_on_page_sum / pageviews) if pageviews > 0 else 0
+                if exact:
+                    top_pages = [{'url': page, 'count': count} for page, count in
+                                 sorted(page_counts.items(), key=lambda item: item[1], reverse=True)[:10]]
+                else:
+                    top_pages = [{'url': page, 'count': count} for page, _, _, count, _ in
+                                 self.heavy_hitters.top(conn, 'page', start_time, 10)]
+                
+                # Unique visitors can't be summed from rollups; merge the visitor sketches
+                unique_visitors = self.sketches.estimate(conn, start_time, url_low, url_high)
+                percentiles = self.durations.percentiles(conn, start_time, url_low, url_high)
             
             return {
                 "success": True,
@@ -640,6 +3984,7 @@ class TrafficAnalytics:
                     "unique_visitors": unique_visitors,
                     "bounce_rate": round(bounce_rate, 2),
                     "avg_session_duration": round(avg_duration, 2),
+                    "duration_percentiles": percentiles,
                     "traffic_sources": traffic_sources,
                     "top_pages": top_pages,
                     "device_breakdown": device_breakdown,
@@ -650,35 +3995,94 @@ class TrafficAnalytics:
         except Exception as e:
             return {"success": False, "error": str(e)}
 
-    def get_real_time_data(self) -> Dict:
-        """Get real-time analytics data"""
+    def get_top_items(self, dimension: str = 'page', time_range: str = '24h', limit: int = 10,
+                      exact: bool = False) -> Dict:
+        """Most viewed pages, cities or countries; counts are estimates unless exact is set"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Active sessions in last 5 minutes
-            five_minutes_ago = datetime.now() - timedelta(minutes=5)
-            cursor.execute('''
-                SELECT COUNT(DISTINCT session_id) FROM pageviews 
-                WHERE timestamp >= ?
-            ''', (five_minutes_ago,))
-            active_sessions = cursor.fetchone()[0]
+            if dimension not in TOP_K_DIMENSIONS:
+                raise ValueError(f"Unknown dimension {dimension!r}; expected one of {', '.join(TOP_K_DIMENSIONS)}")
+            if not 1 <= limit <= TOP_K_CAPACITY:
+                raise ValueError(f"limit must be between 1 and {TOP_K_CAPACITY}")
+            with self.db.reader() as conn:
+                start_time = self._time_range_start(time_range)
+                if exact:
+                    facts_sql, facts_params = self._pageview_facts(conn, start_time)
+                    keys = [column or f"'{SKETCH_ANY}'" for column in TOP_K_DIMENSIONS[dimension]]
+                    rows = conn.execute(f'''
+                        SELECT {keys[0]}, {keys[1]}, {keys[2]}, SUM(pageviews), 0 FROM ({facts_sql})
+                        GROUP BY 1, 2, 3
+                        ORDER BY 4 DESC
+                        LIMIT ?
+                    ''', facts_params + [limit]).fetchall()
+                else:
+                    rows = self.heavy_hitters.top(conn, dimension, start_time, limit)
             
-            # Pageviews in last hour
-            one_hour_ago = datetime.now() - timedelta(hours=1)
-            cursor.execute('''
-                SELECT COUNT(*) FROM pageviews WHERE timestamp >= ?
-            ''', (one_hour_ago,))
-            hourly_pageviews = cursor.fetchone()[0]
+            items = []
+            for row_url, row_country, row_city, pageviews, error in rows:
+                if dimension == 'page':
+                    item = {'url': row_url}
+                else:
+                    item = {'country_code': row_country,
+                            'country_name': self.major_countries.get(row_country, {}).get('name', row_country)}
+                    if dimension == 'city':
+                        item['city'] = row_city
+                item['pageviews'] = pageviews
+                item['error'] = error
+                items.append(item)
+            return {
+                "success": True,
+                "data": {
+                    "dimension": dimension,
+                    "items": items,
+                    "exact": exact,
+                    "time_range": time_range
+                }
+            }
             
-            # Current pageviews per minute
-            one_minute_ago = datetime.now() - timedelta(minutes=1)
-            cursor.execute('''
-                SELECT COUNT(*) FROM pageviews WHERE timestamp >= ?
-            ''', (one_minute_ago,))
-            pageviews_per_minute = cursor.fetchone()[0]
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def get_real_time_data(self) -> Dict:
+        """Get real-time analytics data"""
+        try:
+            if self.realtime is not None:
+                active_sessions, hourly_pageviews, pageviews_per_minute = self.realtime.snapshot()
+                return {
+                    "success": True,
+                    "data": {
+                        "active_sessions": active_sessions,
+                        "hourly_pageviews": hourly_pageviews,
+                        "pageviews_per_minute": pageviews_per_minute,
+                        "timestamp": datetime.now().isoformat()
+                    }
+                }
             
-            conn.close()
+            with self.db.reader() as conn:
+                cursor = conn.cursor()
+                
+                # Active sessions in last 5 minutes
+                five_minutes_ago = datetime.now() - timedelta(minutes=5)
+                active_sql, active_params = self._log_union(conn, 'pageview_log', '''
+                    SELECT session_id FROM {table} WHERE timestamp >= ?
+                ''', [five_minutes_ago], five_minutes_ago)
+                cursor.execute(f'SELECT COUNT(DISTINCT session_id) FROM ({active_sql})', active_params)
+                active_sessions = cursor.fetchone()[0]
+                
+                # Pageviews in last hour
+                one_hour_ago = datetime.now() - timedelta(hours=1)
+                hourly_sql, hourly_params = self._log_union(conn, 'pageview_log', '''
+                    SELECT COUNT(*) AS pageviews FROM {table} WHERE timestamp >= ?
+                ''', [one_hour_ago], one_hour_ago)
+                cursor.execute(f'SELECT SUM(pageviews) FROM ({hourly_sql})', hourly_params)
+                hourly_pageviews = cursor.fetchone()[0]
+                
+                # Current pageviews per minute
+                one_minute_ago = datetime.now() - timedelta(minutes=1)
+                minute_sql, minute_params = self._log_union(conn, 'pageview_log', '''
+                    SELECT COUNT(*) AS pageviews FROM {table} WHERE timestamp >= ?
+                ''', [one_minute_ago], one_minute_ago)
+                cursor.execute(f'SELECT SUM(pageviews) FROM ({minute_sql})', minute_params)
+                pageviews_per_minute = cursor.fetchone()[0]
             
             return {
                 "success": True,
@@ -715,61 +4119,108 @@ class TrafficAnalytics:
         except Exception as e:
             return {"success": False, "error": str(e)}
 
-    def get_conversion_funnel(self, funnel_name: str) -> Dict:
-        """Get conversion funnel data"""
+    def get_conversion_funnel(self, funnel_name: str, time_range: str = '24h') -> Dict:
+        """Sessions reaching each step of a configured funnel, for attempts opened in time_range.
+        
+        Reads the per-hour counts FunnelTracker keeps, so the cost doesn't grow
+        with traffic. conversion_rate is relative to the first step.
+        """
         try:
-            # Simulate funnel data
+            funnel = self.funnels.funnels.get(funnel_name)
+            if funnel is None:
+                return {"success": False, "error": f"Unknown funnel: {funnel_name}"}
+            
+            with self.db.reader() as conn:
+                visitors = self.funnels.counts(conn, funnel_name, self._time_range_start(time_range))
+            entered = visitors[0]
             funnel_steps = [
-                {"step": "Landing Page", "visitors": 1000, "conversion_rate": 100},
-                {"step": "Product View", "visitors": 800, "conversion_rate": 80},
-                {"step": "Add to Cart", "visitors": 400, "conversion_rate": 40},
-                {"step": "Checkout", "visitors": 200, "conversion_rate": 20},
-                {"step": "Purchase", "visitors": 100, "conversion_rate": 10}
+                {"step": label, "visitors": count,
+                 "conversion_rate": round(count / entered * 100, 1) if entered else 0}
+                for label, count in zip(funnel.labels, visitors)
             ]
             
             return {
                 "success": True,
                 "data": {
                     "funnel_name": funnel_name,
+                    "time_range": time_range,
+                    "window": int(funnel.window.total_seconds()),
                     "steps": funnel_steps,
-                    "total_conversion_rate": 10
+                    "total_conversion_rate": funnel_steps[-1]["conversion_rate"]
                 }
             }
             
         except Exception as e:
             return {"success": False, "error": str(e)}
 
-    def get_heatmap_data(self, page_url: str) -> Dict:
-        """Get heatmap data for a specific page"""
+    def get_heatmap_data(self, page_url: str, time_range: Optional[str] = None,
+                         country_code: Optional[str] = None, city: Optional[str] = None,
+                         event_type: Optional[str] = None, level: Optional[int] = None) -> Dict:
+        """Binned heatmap density grids for a page, one per event type.
+        
+        Without a level the finest pyramid level whose grid fits in
+        HEATMAP_MAX_CELLS is used. time_range works at hour granularity.
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            if level is not None and not 0 <= level < len(HEATMAP_CELL_SIZES):
+                raise ValueError(f"level must be between 0 and {len(HEATMAP_CELL_SIZES) - 1}")
             
-            cursor.execute('''
-                SELECT x_coord, y_coord, event_type, COUNT(*) as count 
-                FROM heatmaps 
-                WHERE page_url = ? 
-                GROUP BY x_coord, y_coord, event_type
-            ''', (page_url,))
-            
-            heatmap_data = []
-            for row in cursor.fetchall():
-                heatmap_data.append({
-                    "x": row[0],
-                    "y": row[1],
-                    "event_type": row[2],
-                    "intensity": row[3]
-                })
-            
-            # If no data for specific URL, return empty data
-            if not heatmap_data:
-                heatmap_data = []
-            
-            conn.close()
+            filters, params = [], []
+            if time_range:
+                filters.append('bucket >= ?')
+                params.append(self._time_range_start(time_range).strftime(HEATMAP_BUCKET_FORMAT))
+            for column, value in (('event_type', event_type), ('country_code', country_code), ('city', city)):
+                if value:
+                    filters.append(f'{column} = ?')
+                    params.append(value)
+            where = ''.join(f' AND {condition}' for condition in filters)
+            
+            with self.db.reader() as conn:
+                if level is None:
+                    # Page extent from the coarsest level, then the finest level that fits
+                    coarsest = len(HEATMAP_CELL_SIZES) - 1
+                    max_x, max_y = conn.execute(f'''
+                        SELECT MAX(cell_x), MAX(cell_y) FROM heatmap_tiles
+                        WHERE page_url = ? AND level = ?{where}
+                    ''', [page_url, coarsest] + params).fetchone()
+                    level = coarsest
+                    if max_x is not None:
+                        width = (max_x + 1) * HEATMAP_CELL_SIZES[coarsest]
+                        height = (max_y + 1) * HEATMAP_CELL_SIZES[coarsest]
+                        for candidate, cell_size in enumerate(HEATMAP_CELL_SIZES):
+                            if -(-width // cell_size) * -(-height // cell_size) <= HEATMAP_MAX_CELLS:
+                                level = candidate
+                                break
+                
+                rows = conn.execute(f'''
+                    SELECT event_type, cell_x, cell_y, SUM(count) FROM heatmap_tiles
+                    WHERE page_url = ? AND level = ?{where}
+                    GROUP BY event_type, cell_x, cell_y
+                ''', [page_url, level] + params).fetchall()
+            
+            columns = max((row[1] for row in rows), default=-1) + 1
+            grid_rows = max((row[2] for row in rows), default=-1) + 1
+            if columns:
+                # Crop very long pages rather than return an unbounded grid
+                grid_rows = min(grid_rows, max(1, HEATMAP_MAX_CELLS // columns))
+            
+            event_types = {}
+            for name, (total, grid) in bin_heatmap_cells(rows, columns, grid_rows, self.aggregation_backend).items():
+                dtype, encoded, peak = encode_grid(grid)
+                event_types[name] = {"total": total, "max": peak, "dtype": dtype, "grid": encoded}
             
             return {
                 "success": True,
-                "data": heatmap_data
+                "data": {
+                    "page_url": page_url,
+                    "level": level,
+                    "cell_size": HEATMAP_CELL_SIZES[level],
+                    "levels": list(HEATMAP_CELL_SIZES),
+                    "columns": columns,
+                    "rows": grid_rows,
+                    "total": sum(layer["total"] for layer in event_types.values()),
+                    "event_types": event_types
+                }
             }
             
         except Exception as e:
@@ -778,9 +4229,6 @@ class TrafficAnalytics:
     def generate_fresh_sample_data(self):
         """Generate fresh sample data for real-time testing"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
             # Add some very recent pageviews (last few minutes)
             sample_urls = [
                 'https://example.com',
@@ -791,6 +4239,7 @@ class TrafficAnalytics:
             ]
             
             # Generate 20-50 recent pageviews
+            rows = []
             for i in range(random.randint(20, 50)):
                 session_id = f"recent_session_{i}"
                 url = random.choice(sample_urls)
@@ -800,11 +4249,8 @@ class TrafficAnalytics:
                 country_info = self.major_countries[country_code]
                 city = random.choice(country_info['cities'])
                 
-                cursor.execute('''
-                    INSERT INTO pageviews (id, session_id, url, timestamp, user_agent, ip_address, referrer, time_on_page, bounce, country_code, country_name, city, region, latitude, longitude)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    str(uuid.uuid4()),
+                rows.append(('pageviews', (
+                    None,
                     session_id,
                     url,
                     timestamp,
@@ -819,34 +4265,441 @@ class TrafficAnalytics:
                     country_info['name'],
                     random.uniform(-90, 90),
                     random.uniform(-180, 180)
-                ))
+                )))
             
-            conn.commit()
-            conn.close()
+            # Goes through the ingest queue so the rollups stay in step
+            self.ingest.put_many(rows)
             
             return {"success": True, "message": "Fresh sample data generated"}
             
         except Exception as e:
             return {"success": False, "error": str(e)}
 
+class AnalyticsBroadcaster:
+    """Fans realtime and summary updates out to /analytics/stream subscribers.
+    
+    One background thread computes the realtime payload every tick and each
+    subscribed (url, time_range) summary every summary_interval, then hands the
+    encoded Server-Sent Event to every subscriber whose payload changed. Slow
+    subscribers skip updates instead of queueing them; the next one replaces it.
+    """
+    
+    def __init__(self, analytics: TrafficAnalytics, tick_interval: float = 2.0,
+                 summary_interval: float = 10.0, heartbeat_interval: float = 15.0,
+                 max_subscribers: int = 256):
+        self.analytics = analytics
+        self.tick_interval = tick_interval
+        self.summary_interval = summary_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.max_subscribers = max_subscribers
+        self._subscribers = {}
+        self._latest = {}
+        self._signatures = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = os.getpid()
+    
+    @staticmethod
+    def encode(event: str, payload) -> bytes:
+        return f"event: {event}\ndata: {json.dumps(payload)}\n\n".encode()
+    
+    def subscribe(self, url: Optional[str], time_range: str) -> Optional[queue.Queue]:
+        """Register a subscriber; returns None when max_subscribers are already connected"""
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None or not self._thread.is_alive():
+                # First subscriber, or first one in this forked worker
+                self._pid = os.getpid()
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run, name='stream-broadcaster', daemon=True)
+                self._thread.start()
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            subscriber = queue.Queue(maxsize=16)
+            key = ('summary', url, time_range)
+            self._subscribers[subscriber] = key
+            # Replay the latest state so new dashboards don't wait a full tick
+            for channel in ('realtime', key):
+                if channel in self._latest:
+                    subscriber.put_nowait(self._latest[channel])
+            return subscriber
+    
+    def unsubscribe(self, subscriber: queue.Queue):
+        with self._lock:
+            key = self._subscribers.pop(subscriber, None)
+            if key is not None and key not in self._subscribers.values():
+                self._latest.pop(key, None)
+                self._signatures.pop(key, None)
+    
+    def _publish(self, channel, event: str, result: Dict):
+        """Send result to the channel's subscribers unless only its timestamp changed"""
+        data = result.get('data')
+        if isinstance(data, dict):
+            signature = json.dumps({k: v for k, v in data.items() if k != 'timestamp'}, sort_keys=True)
+        else:
+            signature = json.dumps(result, sort_keys=True)
+        message = self.encode(event, result)
+        with self._lock:
+            if self._signatures.get(channel) == signature:
+                return
+            self._signatures[channel] = signature
+            self._latest[channel] = message
+            for subscriber, key in self._subscribers.items():
+                if channel == 'realtime' or channel == key:
+                    try:
+                        subscriber.put_nowait(message)
+                    except queue.Full:
+                        pass
+    
+    def _run(self):
+        summaries_due = 0.0
+        while not self._stopped.wait(self.tick_interval):
+            with self._lock:
+                if not self._subscribers:
+                    continue
+                keys = set(self._subscribers.values())
+                fresh = [key for key in keys if key not in self._latest]
+            
+            self._publish('realtime', 'realtime', self.analytics.get_real_time_data())
+            if time.monotonic() >= summaries_due:
+                summaries_due = time.monotonic() + self.summary_interval
+            else:
+                # Between refreshes, only answer subscribers that have no summary yet
+                keys = fresh
+            for key in keys:
+                _, url, time_range = key
+                self._publish(key, 'summary', self.analytics.get_analytics_summary(url, time_range))
+    
+    def close(self):
+        """Stop the ticker and end every open stream"""
+        self._stopped.set()
+        with self._lock:
+            for subscriber in self._subscribers:
+                try:
+                    subscriber.put_nowait(None)
+                except queue.Full:
+                    # Drop a pending update to make room for the sentinel
+                    subscriber.get_nowait()
+                    subscriber.put_nowait(None)
+
+# Slow request log: statements kept per logged request, and the size at which
+# the log file is moved to <path>.1 and started afresh
+SLOW_LOG_MAX_STATEMENTS = 100
+SLOW_LOG_MAX_BYTES = 10 * 1024 * 1024
+
+class SlowRequestLog:
+    """Requests slower than a threshold, with their phase timings and SQL statements.
+    
+    Each entry is one JSON line, appended to a file (or printed to stderr),
+    and the latest ones are kept in memory for GET /admin/slow-requests.
+    SELECTs get their EXPLAIN QUERY PLAN, taken after the response has been
+    sent so it doesn't add to the time being logged.
+    """
+    def __init__(self, db: ConnectionManager, threshold_ms: float, path: Optional[str] = None, keep: int = 100):
+        self.db = db
+        self.threshold = threshold_ms / 1000
+        self.path = path
+        self.recent = deque(maxlen=keep)
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _plan(conn: sqlite3.Connection, sql: str, parameters) -> Optional[List[str]]:
+        if parameters is None or sql.split(None, 1)[0].lower() not in ('select', 'with'):
+            return None
+        try:
+            return [detail for _, _, _, detail in conn.execute('EXPLAIN QUERY PLAN ' + sql, parameters)]
+        except sqlite3.Error:
+            return None
+    
+    def entries(self) -> List[Dict]:
+        """The latest logged requests, oldest first"""
+        with self._lock:
+            return list(self.recent)
+    
+    def record(self, method: str, path: str, status: Optional[int], trace: RequestTrace,
+               seconds: float) -> Optional[Dict]:
+        """Log a request if it took at least the threshold; returns its entry"""
+        if seconds < self.threshold:
+            return None
+        kept = trace.statements[:SLOW_LOG_MAX_STATEMENTS]
+        plans = [None] * len(kept)
+        if any(parameters is not None for _, _, parameters, _ in kept):
+            with self.db.reader() as conn:
+                plans = [self._plan(conn, sql, parameters) for _, sql, parameters, _ in kept]
+        entry = {
+            'time': datetime.now().isoformat(timespec='milliseconds'),
+            'pid': os.getpid(),
+            'method': method,
+            'path': path,
+            'status': status,
+            'ms': round(seconds * 1000, 3),
+            'phases': [[phase, round(phase_seconds * 1000, 3)] for phase, phase_seconds in trace.phases],
+            'sql_ms': round(sum(statement[3] for statement in trace.statements) * 1000, 3),
+            'reader_wait_ms': round(trace.reader_wait * 1000, 3),
+            'statements': [{'connection': role, 'sql': ' '.join(sql.split()), 'ms': round(statement_seconds * 1000, 3),
+                            'plan': plan}
+                           for (role, sql, _, statement_seconds), plan in zip(kept, plans)]
+        }
+        if len(trace.statements) > len(kept):
+            entry['statements_omitted'] = len(trace.statements) - len(kept)
+        line = json.dumps(entry)
+        with self._lock:
+            self.recent.append(entry)
+            if self.path is None:
+                print(line, file=sys.stderr)
+                return entry
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) >= SLOW_LOG_MAX_BYTES:
+                    os.replace(self.path, self.path + '.1')
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(line + '\n')
+            except OSError as e:
+                print(f"Slow request log error: {e}")
+        return entry
+
+# <time>-<pid>-<method>-<path>-<duration>ms.prof, so names sort oldest first
+PROFILE_NAME = re.compile(r'\d{8}-\d{6}-\d{6}-\d+-[A-Z]+-[A-Za-z0-9-]*-\d+ms\.prof')
+
+class RequestProfiler:
+    """Runs one in sample_every requests under cProfile and keeps the newest dumps.
+    
+    Dumps are pstats files in directory, named after the request; past keep
+    of them the oldest are deleted. cProfile only sees the thread that enabled
+    it, and one request is profiled at a time: a sampled request that finds
+    another one being profiled runs unprofiled.
+    """
+    def __init__(self, directory: str, sample_every: int, keep: int = 20):
+        self.directory = directory
+        self.sample_every = max(1, sample_every)
+        self.keep = max(1, keep)
+        os.makedirs(directory, exist_ok=True)
+        self._requests = itertools.count(1)
+        self._busy = threading.Lock()
+    
+    def start(self) -> Optional[cProfile.Profile]:
+        """A running profile if this request is sampled, else None"""
+        if next(self._requests) % self.sample_every or not self._busy.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active in this process
+            self._busy.release()
+            return None
+        return profile
+    
+    def finish(self, profile: cProfile.Profile, method: str, path: str, seconds: float):
+        """Stop a profile from start(), dump it and drop the oldest dumps beyond keep"""
+        profile.disable()
+        self._busy.release()
+        endpoint = re.sub(r'[^A-Za-z0-9]+', '-', path.split('?', 1)[0]).strip('-')[:60]
+        name = f"{datetime.now():%Y%m%d-%H%M%S-%f}-{os.getpid()}-{method}-{endpoint}-{seconds * 1000:.0f}ms.prof"
+        try:
+            profile.dump_stats(os.path.join(self.directory, name))
+            for stale in self.names()[:-self.keep]:
+                try:
+                    os.remove(os.path.join(self.directory, stale))
+                except FileNotFoundError:
+                    # Another prefork worker got there first
+                    pass
+        except OSError as e:
+            print(f"Profiler error: {e}")
+    
+    def names(self) -> List[str]:
+        """Stored dumps, oldest first"""
+        return sorted(name for name in os.listdir(self.directory) if PROFILE_NAME.fullmatch(name))
+    
+    def path(self, name: str) -> Optional[str]:
+        """Path of a stored dump, or None if there is no such dump"""
+        if not PROFILE_NAME.fullmatch(name) or not os.path.exists(os.path.join(self.directory, name)):
+            return None
+        return os.path.join(self.directory, name)
+    
+    def listing(self) -> List[Dict]:
+        profiles = []
+        for name in reversed(self.names()):
+            try:
+                profiles.append({'name': name, 'bytes': os.path.getsize(os.path.join(self.directory, name))})
+            except OSError:
+                pass
+        return profiles
+    
+    def report(self, name: str, limit: int = 40) -> Optional[str]:
+        """A stored dump as pstats text, the limit functions with the most cumulative time first"""
+        path = self.path(name)
+        if path is None:
+            return None
+        stream = io.StringIO()
+        pstats.Stats(path, stream=stream).sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+
 class RequestHandler(http.server.SimpleHTTPRequestHandler):
-    analytics = TrafficAnalytics()
+    # Assigned by run_server() once the database is ready
+    analytics: Optional[TrafficAnalytics] = None
+    # None in single-threaded mode, where a stream would block every other client
+    broadcaster: Optional[AnalyticsBroadcaster] = None
+    # Set by run_server() when --slow-request-ms, --profile-sample or --admin-token is given
+    slow_requests: Optional[SlowRequestLog] = None
+    profiler: Optional[RequestProfiler] = None
+    admin_token: Optional[str] = None
+    # HTTP/1.1 keeps connections alive between beacons; run_server() falls
+    # back to HTTP/1.0 in single-threaded mode so one idle client can't
+    # hold the only serving thread
+    protocol_version = 'HTTP/1.1'
+    # Close idle keep-alive connections so they don't pin worker threads
+    timeout = 30
+    # Headers and body go out as separate writes; without TCP_NODELAY every
+    # keep-alive response waits on the client's delayed ACK
+    disable_nagle_algorithm = True
+    
+    def send_response(self, code, message=None):
+        # Remembered for the request metrics
+        self.status_code = code
+        super().send_response(code, message)
+    
+    def timed(self, handle):
+        """Run a request handler and record it in the metrics; trace or profile it when enabled"""
+        self.status_code = None
+        self.failed = False
+        self.request_trace = profile = None
+        # A stream lasts as long as its client, and would hold the profiler all that time
+        if not self.path.startswith('/analytics/stream'):
+            if self.slow_requests is not None:
+                self.request_trace = request_traces.trace = RequestTrace()
+            if self.profiler is not None:
+                profile = self.profiler.start()
+        started = time.perf_counter()
+        try:
+            handle()
+        finally:
+            seconds = time.perf_counter() - started
+            request_traces.trace = None
+            if profile is not None:
+                self.profiler.finish(profile, self.command, self.path, seconds)
+            self.analytics.record_request(self.command, self.path, self.status_code, self.failed, seconds)
+            if self.request_trace is not None:
+                self.slow_requests.record(self.command, self.path, self.status_code, self.request_trace, seconds)
+    
+    def mark(self, phase: str):
+        """End a phase of the traced request, if it is traced"""
+        if self.request_trace is not None:
+            self.request_trace.mark(phase)
+    
+    def do_GET(self):
+        self.timed(self.handle_get)
+    
+    def do_POST(self):
+        self.timed(self.handle_post)
     
     def send_cors_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Content-Encoding')
+    
+    def send_json(self, result: Dict, status: int = 200):
+        """Send a JSON response with an explicit length so keep-alive works"""
+        self.mark('handle')
+        body = json.dumps(result).encode()
+        self.mark('serialize')
+        if 'retry_after' in result and status == 200:
+            # Ingest queue is full: ask the client to back off
+            status = 503
+        elif not result.get('success'):
+            self.failed = True
+        self.send_response(status)
+        self.send_cors_headers()
+        if status == 503:
+            self.send_header('Retry-After', str(result.get('retry_after', 1)))
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.mark('write')
     
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_cors_headers()
+        self.send_header('Content-Length', '0')
         self.end_headers()
     
-    def do_POST(self):
+    def stream_events(self, params: Dict[str, List[str]]):
+        """Hold the connection open and relay broadcaster updates as Server-Sent Events"""
+        subscriber = None
+        if self.broadcaster is not None:
+            subscriber = self.broadcaster.subscribe(params.get('url', [None])[0],
+                                                    params.get('time_range', ['24h'])[0])
+        if subscriber is None:
+            self.send_json({"success": False, "error": "Streaming unavailable, poll instead"}, 503)
+            return
+        
+        try:
+            self.send_response(200)
+            self.send_cors_headers()
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+            # EventSource reconnects after this many milliseconds if we drop
+            self.wfile.write(b'retry: 5000\n\n')
+            while True:
+                try:
+                    message = subscriber.get(timeout=self.broadcaster.heartbeat_interval)
+                except queue.Empty:
+                    message = self.broadcaster.encode('heartbeat', int(time.time()))
+                if message is None:
+                    break
+                self.wfile.write(message)
+        except OSError:
+            # Client went away
+            pass
+        finally:
+            self.broadcaster.unsubscribe(subscriber)
+    
+    def read_batch_records(self, post_data: bytes) -> List[Dict]:
+        """Decode a /track/batch body: JSON array, {"records": [...]} or NDJSON, optionally gzipped"""
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            post_data = decompressor.decompress(post_data, MAX_BATCH_BYTES)
+            if decompressor.unconsumed_tail:
+                raise ValueError('Decompressed batch is too large')
+        
+        text = post_data.decode('utf-8')
+        if 'ndjson' in self.headers.get('Content-Type', ''):
+            return [json.loads(line) for line in text.splitlines() if line.strip()]
+        
+        payload = json.loads(text)
+        if isinstance(payload, dict):
+            payload = payload.get('records', [])
+        if not isinstance(payload, list):
+            raise ValueError('Batch body must be a JSON array of records')
+        return payload
+    
+    def handle_post(self):
         try:
-            content_length = int(self.headers['Content-Length'])
+            content_length = int(self.headers.get('Content-Length', 0))
+            if content_length > MAX_BATCH_BYTES:
+                # The unread body would corrupt the next request on this connection
+                self.close_connection = True
+                self.send_json({"success": False, "error": "Request body too large"}, 413)
+                return
             post_data = self.rfile.read(content_length)
+            
+            if self.path == '/track/batch':
+                records = self.read_batch_records(post_data)
+                for record in records:
+                    if isinstance(record, dict):
+                        record.setdefault('ip_address', self.client_address[0])
+                self.mark('parse')
+                self.send_json(self.analytics.track_batch(records))
+                return
+            
             data = json.loads(post_data.decode('utf-8'))
+            if self.path.startswith('/track/') and isinstance(data, dict):
+                # Beacons rarely know their public address; the connection's is what GeoIP places
+                data.setdefault('ip_address', self.client_address[0])
+            self.mark('parse')
             
             if self.path == '/track/pageview':
                 result = self.analytics.track_pageview(data)
@@ -858,24 +4711,101 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
                 result = self.analytics.get_seo_metrics(data['url'])
             else:
                 result = {"success": False, "error": "Invalid endpoint"}
-                
-                self.send_response(200)
-                self.send_cors_headers()
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(result).encode())
+            
+            self.send_json(result)
             
         except Exception as e:
-            self.send_response(500)
-            self.send_cors_headers()
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({
+            self.send_json({
                 "success": False,
                 "error": str(e)
-            }).encode())
+            }, 500)
     
-    def do_GET(self):
+    def send_cached(self, key: Tuple, compute):
+        """Send a response from the analytics response cache, honouring If-None-Match"""
+        computed = False
+        
+        def compute_result() -> Dict:
+            nonlocal computed
+            self.mark('parse')
+            result = compute()
+            computed = True
+            self.mark('handle')
+            if not result.get('success'):
+                self.failed = True
+            return result
+        
+        body, etag = self.analytics.response_cache.get(key, compute_result)
+        # A hit's time is the lookup, including any wait for a concurrent miss on the same key
+        self.mark('serialize' if computed else 'cache')
+        if etag is not None and etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_cors_headers()
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.mark('write')
+            return
+        self.send_response(200)
+        self.send_cors_headers()
+        if etag is not None:
+            self.send_header('ETag', etag)
+            # Let browsers keep the body but revalidate it every time
+            self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.mark('write')
+    
+    def send_body(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.mark('write')
+    
+    def send_metrics(self):
+        body = self.analytics.metrics.render()
+        self.mark('handle')
+        self.send_body(body, METRICS_CONTENT_TYPE)
+    
+    def handle_admin(self):
+        """GET /admin/*: the slow request log and stored profiles, for callers with the --admin-token"""
+        if self.admin_token is None:
+            self.send_json({"success": False, "error": "Admin endpoints are off; start the server with --admin-token"},
+                           404)
+            return
+        if not hmac.compare_digest(self.headers.get('Authorization', '').encode(),
+                                   f"Bearer {self.admin_token}".encode()):
+            self.send_json({"success": False, "error": "Unauthorized"}, 401)
+            return
+        parsed_url = urlparse(self.path)
+        if parsed_url.path == '/admin/slow-requests':
+            if self.slow_requests is None:
+                self.send_json({"success": False, "error": "Slow request log is off; start the server with --slow-request-ms"})
+            else:
+                self.send_json({"success": True, "data": {"threshold_ms": self.slow_requests.threshold * 1000,
+                                                          "requests": self.slow_requests.entries()}})
+        elif parsed_url.path == '/admin/profiles':
+            if self.profiler is None:
+                self.send_json({"success": False, "error": "Profiler is off; start the server with --profile-sample"})
+            else:
+                self.send_json({"success": True, "data": {"sample_every": self.profiler.sample_every,
+                                                          "profiles": self.profiler.listing()}})
+        elif parsed_url.path.startswith('/admin/profiles/'):
+            name = parsed_url.path[len('/admin/profiles/'):]
+            path = self.profiler.path(name) if self.profiler is not None else None
+            if path is None:
+                self.send_json({"success": False, "error": "No such profile"}, 404)
+            elif parse_qs(parsed_url.query).get('format', [''])[0] == 'text':
+                self.send_body(self.profiler.report(name).encode(), 'text/plain; charset=utf-8')
+            else:
+                with open(path, 'rb') as f:
+                    self.send_body(f.read(), 'application/octet-stream')
+        else:
+            self.send_json({"success": False, "error": "Invalid endpoint"}, 404)
+    
+    def handle_get(self):
         try:
             if self.path.startswith('/analytics/summary'):
                 # Parse query parameters
@@ -884,23 +4814,53 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
                 
                 url = params.get('url', [None])[0]
                 time_range = params.get('time_range', ['24h'])[0]
+                exact = params.get('exact', [''])[0].lower() in ('1', 'true')
+                
+                self.send_cached(('summary', url, time_range, exact),
+                                 lambda: self.analytics.get_analytics_summary(url, time_range, exact))
+                return
                 
-                result = self.analytics.get_analytics_summary(url, time_range)
+            elif self.path.startswith('/analytics/top'):
+                parsed_url = urlparse(self.path)
+                params = parse_qs(parsed_url.query)
+                dimension = params.get('dimension', ['page'])[0]
+                time_range = params.get('time_range', ['24h'])[0]
+                limit = int(params.get('limit', ['10'])[0])
+                exact = params.get('exact', [''])[0].lower() in ('1', 'true')
+                self.send_cached(('top', dimension, time_range, limit, exact),
+                                 lambda: self.analytics.get_top_items(dimension, time_range, limit, exact))
+                return
                 
             elif self.path == '/analytics/realtime':
                 result = self.analytics.get_real_time_data()
                 
+            elif self.path.startswith('/analytics/stream'):
+                self.stream_events(parse_qs(urlparse(self.path).query))
+                return
+                
             elif self.path.startswith('/analytics/funnel'):
                 parsed_url = urlparse(self.path)
                 params = parse_qs(parsed_url.query)
                 funnel_name = params.get('name', ['default'])[0]
-                result = self.analytics.get_conversion_funnel(funnel_name)
+                time_range = params.get('time_range', ['24h'])[0]
+                self.send_cached(('funnel', funnel_name, time_range),
+                                 lambda: self.analytics.get_conversion_funnel(funnel_name, time_range))
+                return
                 
             elif self.path.startswith('/analytics/heatmap'):
                 parsed_url = urlparse(self.path)
                 params = parse_qs(parsed_url.query)
                 page_url = params.get('page_url', [''])[0]
-                result = self.analytics.get_heatmap_data(page_url)
+                time_range = params.get('time_range', [None])[0]
+                country_code = params.get('country_code', [None])[0]
+                city = params.get('city', [None])[0]
+                event_type = params.get('event_type', [None])[0]
+                level = params.get('level', [None])[0]
+                level = int(level) if level else None
+                self.send_cached(('heatmap', page_url, time_range, country_code, city, event_type, level),
+                                 lambda: self.analytics.get_heatmap_data(page_url, time_range, country_code,
+                                                                         city, event_type, level))
+                return
                 
             elif self.path.startswith('/analytics/regions'):
                 parsed_url = urlparse(self.path)
@@ -908,10 +4868,24 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
                 time_range = params.get('time_range', ['24h'])[0]
                 country_code = params.get('country_code', [None])[0]
                 city = params.get('city', [None])[0]
-                result = self.analytics.get_region_wise_analytics(time_range, country_code, city)
+                self.send_cached(('regions', time_range, country_code, city),
+                                 lambda: self.analytics.get_region_wise_analytics(time_range, country_code, city))
+                return
                 
             elif self.path == '/analytics/available-regions':
-                result = self.analytics.get_available_regions()
+                self.send_cached(('available-regions',), self.analytics.get_available_regions)
+                return
+                
+            elif self.path == '/analytics/cache-stats':
+                result = {"success": True, "data": self.analytics.response_cache.snapshot()}
+                
+            elif self.path == '/metrics':
+                self.send_metrics()
+                return
+                
+            elif self.path.startswith('/admin/'):
+                self.handle_admin()
+                return
                 
             elif self.path == '/generate-sample-data':
                 result = self.analytics.generate_fresh_sample_data()
@@ -919,42 +4893,211 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
             else:
                 result = {"success": False, "error": "Invalid endpoint"}
             
-            self.send_response(200)
-            self.send_cors_headers()
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(result).encode())
+            self.send_json(result)
             
         except Exception as e:
-            self.send_response(500)
-            self.send_cors_headers()
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({
+            self.send_json({
                 "success": False,
                 "error": str(e)
-            }).encode())
+            }, 500)
+
+class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """One thread per connection, so slow analytics queries don't stall beacons"""
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
 
-def run_server():
-    port = 8001
-    server_address = ('', port)
+class ReusePortHTTPServer(ThreadedHTTPServer):
+    """Threaded server whose socket can be shared by pre-forked workers"""
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+SERVER_MODES = ('single', 'threaded', 'prefork')
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='JADTrax traffic analytics server')
+    parser.add_argument('--host', default='', help='Interface to bind (default: all)')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('API_PORT', 8001)))
+    parser.add_argument('--db-path', default=os.environ.get('DATABASE_PATH', 'traffic_analytics.db'))
+    parser.add_argument('--mode', choices=SERVER_MODES, default='threaded',
+                        help='single: one request at a time; threaded: thread per connection; '
+                             'prefork: --workers processes sharing the port via SO_REUSEPORT')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Worker processes in prefork mode')
+    parser.add_argument('--ingest-queue-size', type=int, default=50000,
+                        help='Tracked rows buffered in memory before beacons get 503')
+    parser.add_argument('--ingest-batch-size', type=int, default=1000,
+                        help='Rows written per transaction by the ingest writer')
+    parser.add_argument('--ingest-flush-interval', type=float, default=0.5,
+                        help='Seconds a buffered row may wait before it is written')
+    parser.add_argument('--read-connections', type=int, default=4,
+                        help='Read-only SQLite connections pooled for analytics queries')
+    parser.add_argument('--sqlite-synchronous', default='NORMAL', choices=['OFF', 'NORMAL', 'FULL', 'EXTRA'],
+                        help='PRAGMA synchronous; NORMAL can lose the last commits on power loss but never corrupts in WAL mode')
+    parser.add_argument('--sqlite-cache-size', type=int, default=-65536,
+                        help='PRAGMA cache_size per connection (negative values are KiB)')
+    parser.add_argument('--sqlite-mmap-size', type=int, default=268435456,
+                        help='PRAGMA mmap_size in bytes (0 disables memory-mapped I/O)')
+    parser.add_argument('--aggregation-backend', default='auto', choices=AGGREGATION_BACKENDS,
+                        help='Region and heatmap result shaping; auto uses NumPy when it is installed')
+    parser.add_argument('--response-cache-size', type=int, default=1024,
+                        help='Cached GET /analytics/* responses per process (0 disables the cache)')
+    parser.add_argument('--session-idle-timeout', type=float, default=1800,
+                        help='Seconds without a pageview before a session is closed and written out')
+    parser.add_argument('--max-sessions', type=int, default=200000,
+                        help='Live sessions kept in memory; beyond this the oldest idle one is closed early')
+    parser.add_argument('--retention-days', type=int, default=0,
+                        help='Drop weekly pageview/event/heatmap partitions older than this (0 keeps everything)')
+    parser.add_argument('--funnels', metavar='FILE',
+                        help='JSON file of conversion funnel definitions replacing the built-in FUNNELS')
+    parser.add_argument('--geoip', metavar='FILE', default=os.environ.get('GEOIP_DATABASE'),
+                        help='CSV of IP ranges (or its compiled .idx) used to place beacons that send no country')
+    parser.add_argument('--hll-precision', type=int, default=HLL_PRECISION, choices=range(4, 17), metavar='{4..16}',
+                        help='Unique visitor sketch precision; error is about 1.04/sqrt(2**p), 1.6%% at 12')
+    parser.add_argument('--stream-interval', type=float, default=2.0,
+                        help='Seconds between realtime updates pushed on /analytics/stream')
+    parser.add_argument('--stream-max-subscribers', type=int, default=256,
+                        help='Open /analytics/stream connections per process; later ones are told to poll')
+    parser.add_argument('--slow-request-ms', type=float, default=0,
+                        help='Log requests that take at least this long, with their phases, SQL and plans (0 disables)')
+    parser.add_argument('--slow-request-log', metavar='FILE',
+                        help='Append slow requests to this file as JSON lines instead of printing them to stderr')
+    parser.add_argument('--profile-sample', type=int, default=0, metavar='N',
+                        help='Run 1 in N requests under cProfile (0 disables)')
+    parser.add_argument('--profile-dir', default='profiles', help='Directory the profiles are dumped to')
+    parser.add_argument('--profile-keep', type=int, default=20, help='Profiles kept; older ones are deleted')
+    parser.add_argument('--admin-token', default=os.environ.get('ADMIN_TOKEN'),
+                        help='Bearer token for GET /admin/slow-requests and /admin/profiles (unset disables them)')
+    return parser.parse_args(argv)
+
+def load_funnels(path: str) -> Dict[str, Dict]:
+    """Funnel definitions from a JSON file shaped like FUNNELS"""
+    with open(path) as f:
+        return json.load(f)
+
+def print_banner(port: int, mode: str, workers: int):
+    print(f"🚀 Traffic Analytics Server running on port {port} ({mode} mode" +
+          (f", {workers} workers)" if mode == 'prefork' else ")"))
+    print(f"📊 Available endpoints:")
+    print(f"   POST /track/pageview - Track pageviews")
+    print(f"   POST /track/event - Track custom events")
+    print(f"   POST /track/heatmap - Track heatmap data")
+    print(f"   POST /track/batch - Track many pageviews, events and heatmap points")
+    print(f"   POST /seo/analyze - Analyze SEO metrics")
+    print(f"   GET /analytics/summary - Get analytics summary")
+    print(f"   GET /analytics/realtime - Get real-time data")
+    print(f"   GET /analytics/stream - Stream real-time data and summary updates (SSE)")
+    print(f"   GET /analytics/funnel - Get conversion funnel")
+    print(f"   GET /analytics/heatmap - Get heatmap data")
+    print(f"   GET /analytics/regions - Get region-wise analytics")
+    print(f"   GET /analytics/available-regions - Get available regions")
+    print(f"   GET /analytics/cache-stats - Response cache hit/miss counters")
+    print(f"   GET /metrics - Request, SQLite, ingest and cache metrics (Prometheus)")
+    print(f"   GET /admin/slow-requests, /admin/profiles - Slow request log and profiles (--admin-token)")
+    print(f"   GET /generate-sample-data - Generate fresh sample data")
+
+def raise_system_exit(signum, frame):
+    """SIGTERM handler that unwinds serve_forever() so pending rows get flushed"""
+    raise SystemExit(0)
+
+def serve_prefork(server_address, workers: int):
+    """Fork workers that each accept on their own SO_REUSEPORT socket"""
+    if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        raise OSError('prefork mode needs os.fork and SO_REUSEPORT')
+    
+    children = []
+    for _ in range(max(1, workers)):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, raise_system_exit)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 0
+            try:
+                with ReusePortHTTPServer(server_address, RequestHandler) as httpd:
+                    httpd.serve_forever()
+            except (KeyboardInterrupt, SystemExit):
+                pass
+            except Exception as e:
+                print(f"Worker {os.getpid()} error: {e}")
+                status = 1
+            finally:
+                RequestHandler.broadcaster.close()
+                RequestHandler.analytics.close()
+                os._exit(status)
+        children.append(pid)
+    
+    def stop_children(signum=None, frame=None):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
     
+    signal.signal(signal.SIGTERM, stop_children)
     try:
-        with socketserver.TCPServer(server_address, RequestHandler) as httpd:
-            print(f"🚀 Traffic Analytics Server running on port {port}")
-            print(f"📊 Available endpoints:")
-            print(f"   POST /track/pageview - Track pageviews")
-            print(f"   POST /track/event - Track custom events")
-            print(f"   POST /track/heatmap - Track heatmap data")
-            print(f"   POST /seo/analyze - Analyze SEO metrics")
-            print(f"   GET /analytics/summary - Get analytics summary")
-            print(f"   GET /analytics/realtime - Get real-time data")
-            print(f"   GET /analytics/funnel - Get conversion funnel")
-            print(f"   GET /analytics/heatmap - Get heatmap data")
-            print(f"   GET /analytics/regions - Get region-wise analytics")
-            print(f"   GET /analytics/available-regions - Get available regions")
-            print(f"   POST /generate-sample-data - Generate fresh sample data")
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        stop_children()
+        for pid in children:
+            os.waitpid(pid, 0)
+
+def run_server(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    port = args.port
+    server_address = (args.host, port)
+    
+    try:
+        # Set up the database once, before any worker is forked
+        RequestHandler.analytics = TrafficAnalytics(
+            args.db_path,
+            ingest_queue_size=args.ingest_queue_size,
+            ingest_batch_size=args.ingest_batch_size,
+            ingest_flush_interval=args.ingest_flush_interval,
+            read_connections=args.read_connections,
+            sqlite_synchronous=args.sqlite_synchronous,
+            sqlite_cache_size=args.sqlite_cache_size,
+            sqlite_mmap_size=args.sqlite_mmap_size,
+            realtime_counters=args.mode != 'prefork',
+            response_cache_size=args.response_cache_size,
+            aggregation_backend=args.aggregation_backend,
+            session_idle_timeout=args.session_idle_timeout,
+            max_sessions=args.max_sessions,
+            retention_days=args.retention_days,
+            funnels=load_funnels(args.funnels) if args.funnels else None,
+            geoip_path=args.geoip,
+            hll_precision=args.hll_precision
+        )
+        if args.slow_request_ms > 0:
+            RequestHandler.slow_requests = SlowRequestLog(RequestHandler.analytics.db, args.slow_request_ms,
+                                                          args.slow_request_log)
+        if args.profile_sample > 0:
+            RequestHandler.profiler = RequestProfiler(args.profile_dir, args.profile_sample, args.profile_keep)
+        RequestHandler.admin_token = args.admin_token
+        if args.mode != 'single':
+            RequestHandler.broadcaster = AnalyticsBroadcaster(
+                RequestHandler.analytics,
+                tick_interval=args.stream_interval,
+                max_subscribers=args.stream_max_subscribers
+            )
+        print_banner(port, args.mode, args.workers)
+        
+        if args.mode == 'prefork':
+            serve_prefork(server_address, args.workers)
+            return
+        
+        if args.mode == 'single':
+            RequestHandler.protocol_version = 'HTTP/1.0'
+            server_class = socketserver.TCPServer
+        else:
+            server_class = ThreadedHTTPServer
+        
+        signal.signal(signal.SIGTERM, raise_system_exit)
+        with server_class(server_address, RequestHandler) as httpd:
             httpd.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
     except OSError as e:
         if e.errno == 98:  # Address already in use
             print(f"Error: Port {port} is already in use")
@@ -962,6 +5105,11 @@ def run_server():
             print(f"Server error: {e}")
     except Exception as e:
         print(f"Unexpected error: {e}")
+    finally:
+        if RequestHandler.broadcaster is not None:
+            RequestHandler.broadcaster.close()
+        if RequestHandler.analytics is not None:
+            RequestHandler.analytics.close()
 
 if __name__ == "__main__":
-    run_server()
\ No newline at end of file
+    run_server()
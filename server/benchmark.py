@@ -0,0 +1,1441 @@
+"""Benchmarks for the JADTrax analytics server.
+
+Usage:
+    python benchmark.py server --modes single threaded prefork --concurrency 16 --duration 10
+    python benchmark.py server --rows 1000000 --per-endpoint --mix track_pageview=9 analytics_summary=1
+    python benchmark.py plans --rows 1000000
+    python benchmark.py summary --rows 1000000 10000000
+    python benchmark.py backends --rows 1000000
+    python benchmark.py soak --pageviews 5000000
+    python benchmark.py storage --rows 10000000
+    python benchmark.py funnels --rows 10000000 --sessions 100000
+    python benchmark.py useragents --beacons 1000000 --distinct 20000
+    python benchmark.py geoip --ranges 3000000 --beacons 1000000
+    python benchmark.py sketches --rows 1000000 --precision 12 14
+    python benchmark.py topk --pageviews 1000000 --tail 0.2
+    python benchmark.py durations --pageviews 1000000
+    python benchmark.py metrics
+    python benchmark.py slowlog --rows 1000000
+    python benchmark.py --json new.json storage && python benchmark.py compare old.json new.json
+
+Each server mode is started as a subprocess against a throw-away database in a
+temporary directory, optionally seeded with a generated history, then driven
+over HTTP by client threads that reuse keep-alive connections where the server
+allows it. Generated data is reproducible for a given --seed: Zipf-distributed
+URLs, regions from MAJOR_COUNTRIES, and heatmap points in bursts.
+"""
+import argparse
+import csv
+import http.client
+import ipaddress
+import itertools
+import platform
+import json
+import os
+import random
+import re
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from analyzer import (DURATION_ACCURACY, DURATION_PERCENTILES, DURATION_TABLES, MAJOR_COUNTRIES, GeoIndex,
+                      MetricsRegistry, RequestProfiler, RequestTrace, SlowRequestLog, TrafficAnalytics,
+                      classify_user_agent, compile_geoip, numpy, process_rss, request_traces, url_prefix_range)
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+ANALYZER = os.path.join(SERVER_DIR, 'analyzer.py')
+
+SAMPLE_URLS = [
+    'https://example.com',
+    'https://example.com/products',
+    'https://example.com/about',
+    'https://example.com/contact',
+    'https://example.com/blog'
+]
+
+# Pages of the generated site, most popular first: the sample URLs, then a
+# long tail of product and blog pages. Page popularity follows Zipf's law.
+URL_CATALOG = SAMPLE_URLS + [f"https://example.com/{section}/{n}" for n in range(1, 498)
+                             for section in ('products', 'blog')]
+URL_CUM_WEIGHTS = list(itertools.accumulate(1 / rank ** 1.1 for rank in range(1, len(URL_CATALOG) + 1)))
+REGIONS = [(code, info['name'], city) for code, info in MAJOR_COUNTRIES.items() for city in info['cities']]
+
+SAMPLE_USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+    'Version/17.1 Safari/605.1.15',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+    'Version/17.1 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/120.0.0.0 Mobile Safari/537.36',
+    'Mozilla/5.0 (iPad; CPU OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+    'Version/17.1 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 13; SM-X710) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)'
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 15.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} did not start within {timeout}s")
+
+
+def start_server(workdir: str, mode: str, workers: int, extra_args: Optional[List[str]] = None):
+    """Start analyzer.py in its own process and return (process, port)"""
+    port = free_port()
+    cmd = [sys.executable, ANALYZER, '--mode', mode, '--port', str(port),
+           '--host', '127.0.0.1', '--workers', str(workers),
+           '--db-path', os.path.join(workdir, 'bench.db')] + (extra_args or [])
+    proc = subprocess.Popen(cmd, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+    except Exception:
+        proc.kill()
+        raise
+    return proc, port
+
+
+def stop_server(proc: subprocess.Popen):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def zipf_url(rng: random.Random) -> str:
+    return rng.choices(URL_CATALOG, cum_weights=URL_CUM_WEIGHTS)[0]
+
+
+def heatmap_burst(rng: random.Random, url: str, timestamp: datetime) -> List[Tuple]:
+    """Heatmap rows for one burst: a visitor clicking, scrolling or hovering around one spot"""
+    x, y = rng.randint(0, 1280), rng.randint(0, 2000)
+    event_type = rng.choice(['click', 'scroll', 'hover'])
+    return [(url, min(1280, max(0, int(rng.gauss(x, 40)))), min(2000, max(0, int(rng.gauss(y, 40)))),
+             event_type, timestamp + timedelta(milliseconds=250 * n))
+            for n in range(1 + int(rng.expovariate(1 / 7)))]
+
+
+def pageview_request(rng: random.Random):
+    code, name, city = rng.choice(REGIONS)
+    body = json.dumps({
+        'url': zipf_url(rng),
+        'user_agent': rng.choice(SAMPLE_USER_AGENTS),
+        'ip_address': f"10.0.{rng.randint(0, 255)}.{rng.randint(1, 254)}",
+        'referrer': rng.choice(['https://google.com', 'https://facebook.com', '']),
+        'time_on_page': rng.randint(5, 300),
+        'bounce': rng.random() < 0.4,
+        'country_code': code,
+        'city': city
+    })
+    return 'POST', '/track/pageview', body
+
+
+def event_request(rng: random.Random):
+    code, _, city = rng.choice(REGIONS)
+    body = json.dumps({
+        'session_id': f"session_{rng.randrange(100000)}",
+        'event_type': rng.choice(['click', 'signup', 'add_to_cart', 'checkout', 'purchase']),
+        'event_data': {'element': 'button'},
+        'page_url': zipf_url(rng),
+        'country_code': code,
+        'city': city
+    })
+    return 'POST', '/track/event', body
+
+
+def heatmap_request(rng: random.Random):
+    code, _, city = rng.choice(REGIONS)
+    body = json.dumps({
+        'page_url': zipf_url(rng),
+        'x_coord': rng.randint(0, 1280),
+        'y_coord': rng.randint(0, 2000),
+        'event_type': rng.choice(['click', 'scroll', 'hover']),
+        'country_code': code,
+        'city': city
+    })
+    return 'POST', '/track/heatmap', body
+
+
+def heatmap_batch_request(rng: random.Random):
+    """A tracker flushing one burst of heatmap points through /track/batch"""
+    code, _, city = rng.choice(REGIONS)
+    body = json.dumps([
+        {'type': 'heatmap', 'page_url': url, 'x_coord': x, 'y_coord': y, 'event_type': event_type,
+         'country_code': code, 'city': city}
+        for url, x, y, event_type, _ in heatmap_burst(rng, zipf_url(rng), datetime.now())
+    ])
+    return 'POST', '/track/batch', body
+
+
+def summary_request(rng: random.Random):
+    time_range = rng.choice(['24h', '7d', '30d'])
+    url = '&url=https%3A%2F%2Fexample.com%2Fproducts' if rng.random() < 0.2 else ''
+    return 'GET', f"/analytics/summary?time_range={time_range}{url}", None
+
+
+def realtime_request(rng: random.Random):
+    return 'GET', '/analytics/realtime', None
+
+
+def regions_request(rng: random.Random):
+    return 'GET', '/analytics/regions?time_range=7d', None
+
+
+def heatmap_query_request(rng: random.Random):
+    return 'GET', '/analytics/heatmap?page_url=https%3A%2F%2Fexample.com%2Fproducts&time_range=7d', None
+
+
+def top_request(rng: random.Random):
+    dimension = rng.choice(['page', 'city', 'country'])
+    return 'GET', f"/analytics/top?dimension={dimension}&time_range={rng.choice(['24h', '7d', '30d'])}", None
+
+
+def funnel_request(rng: random.Random):
+    return 'GET', f"/analytics/funnel?name=default&time_range={rng.choice(['24h', '7d', '30d'])}", None
+
+
+# Request builders by endpoint label
+ENDPOINTS = {
+    'track_pageview': pageview_request,
+    'track_event': event_request,
+    'track_heatmap': heatmap_request,
+    'track_batch': heatmap_batch_request,
+    'analytics_summary': summary_request,
+    'analytics_realtime': realtime_request,
+    'analytics_regions': regions_request,
+    'analytics_heatmap': heatmap_query_request,
+    'analytics_funnel': funnel_request,
+    'analytics_top': top_request,
+}
+
+# (endpoint label, request builder, share of the traffic mix): mostly beacons,
+# with a few dashboards polling
+DEFAULT_MIX = [
+    ('track_pageview', pageview_request, 0.6),
+    ('track_event', event_request, 0.15),
+    ('track_batch', heatmap_batch_request, 0.1),
+    ('analytics_summary', summary_request, 0.05),
+    ('analytics_realtime', realtime_request, 0.04),
+    ('analytics_regions', regions_request, 0.03),
+    ('analytics_heatmap', heatmap_query_request, 0.02),
+    ('analytics_funnel', funnel_request, 0.01),
+]
+
+
+def parse_mix(entries: Optional[List[str]]) -> List[Tuple]:
+    """label=weight arguments as a traffic mix; None gives DEFAULT_MIX"""
+    if not entries:
+        return DEFAULT_MIX
+    mix = []
+    for entry in entries:
+        label, _, weight = entry.partition('=')
+        if label not in ENDPOINTS:
+            raise SystemExit(f"Unknown endpoint {label!r}; choose from {', '.join(ENDPOINTS)}")
+        mix.append((label, ENDPOINTS[label], float(weight or 1)))
+    return mix
+
+
+def process_tree_rss(pid: int) -> int:
+    """Resident set size in bytes of a process plus its children, e.g. prefork workers (Linux only)"""
+    pids = [pid]
+    try:
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as stat:
+                        # The command name may contain spaces; fields resume after its ')'
+                        if int(stat.read().rsplit(')', 1)[1].split()[1]) == pid:
+                            pids.append(int(entry))
+                except (OSError, ValueError, IndexError):
+                    continue
+    except OSError:
+        return 0
+    total = 0
+    for child in pids:
+        try:
+            with open(f"/proc/{child}/statm") as statm:
+                total += int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+def run_load(port: int, concurrency: int, duration: float, mix=DEFAULT_MIX, seed: int = 1,
+             server_pid: Optional[int] = None) -> Dict:
+    """Drive the server with `concurrency` client threads for `duration` seconds, sampling its RSS"""
+    latencies: Dict[str, List[float]] = {label: [] for label, _, _ in mix}
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+    labels = [label for label, _, _ in mix]
+    builders = {label: builder for label, builder, _ in mix}
+    weights = [weight for _, _, weight in mix]
+
+    def client(worker_id: int):
+        rng = random.Random(seed + worker_id)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local = {label: [] for label in labels}
+        local_errors = 0
+        while time.time() < deadline:
+            label = rng.choices(labels, weights)[0]
+            method, path, body = builders[label](rng)
+            headers = {'Content-Type': 'application/json'} if body else {}
+            started = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    local_errors += 1
+                    continue
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                continue
+            local[label].append(time.perf_counter() - started)
+        conn.close()
+        with lock:
+            for label, values in local.items():
+                latencies[label].extend(values)
+            errors[0] += local_errors
+
+    rss = []
+    done = threading.Event()
+
+    def sample_rss():
+        while not done.wait(0.25):
+            rss.append(process_tree_rss(server_pid))
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    started = time.time()
+    if server_pid is not None:
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    done.set()
+
+    result = summarize(latencies, errors[0], elapsed)
+    if server_pid is not None:
+        result['rss_peak_bytes'] = max(rss, default=0)
+        result['rss_end_bytes'] = process_tree_rss(server_pid)
+    return result
+
+
+def summarize(latencies: Dict[str, List[float]], errors: int, elapsed: float) -> Dict:
+    all_values = [value for values in latencies.values() for value in values]
+    endpoints = {}
+    for label, values in latencies.items():
+        endpoints[label] = {
+            'requests': len(values),
+            'requests_per_sec': round(len(values) / elapsed, 1) if elapsed else 0,
+            'p50_ms': round(percentile(values, 50) * 1000, 2),
+            'p95_ms': round(percentile(values, 95) * 1000, 2),
+            'p99_ms': round(percentile(values, 99) * 1000, 2)
+        }
+    return {
+        'requests': len(all_values),
+        'errors': errors,
+        'elapsed_sec': round(elapsed, 2),
+        'requests_per_sec': round(len(all_values) / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(percentile(all_values, 50) * 1000, 2),
+        'p95_ms': round(percentile(all_values, 95) * 1000, 2),
+        'p99_ms': round(percentile(all_values, 99) * 1000, 2),
+        'endpoints': endpoints
+    }
+
+
+def print_load(name: str, result: Dict, endpoints: bool = True):
+    rss = f"  rss {result['rss_peak_bytes'] / 1048576:.0f} MiB" if 'rss_peak_bytes' in result else ''
+    print(f"{name:>9}: {result['requests_per_sec']:>8} req/s  p50 {result['p50_ms']:>7} ms  "
+          f"p95 {result['p95_ms']:>7} ms  p99 {result['p99_ms']:>8} ms  errors {result['errors']}{rss}")
+    if not endpoints:
+        return
+    for label, stats in result['endpoints'].items():
+        print(f"{'':>11}{label:<20} {stats['requests_per_sec']:>8} req/s  p50 {stats['p50_ms']:>7} ms  "
+              f"p95 {stats['p95_ms']:>7} ms  p99 {stats['p99_ms']:>8} ms")
+
+
+def bench_server(args) -> Dict:
+    mix = parse_mix(args.mix)
+    results = {}
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as workdir:
+            if args.rows:
+                started = time.time()
+                analytics = TrafficAnalytics(os.path.join(workdir, 'bench.db'))
+                try:
+                    generate_dataset(analytics, args.rows, seed=args.seed)
+                finally:
+                    analytics.close()
+                print(f"{mode:>9}: {args.rows} pageviews generated in {time.time() - started:.1f}s")
+            proc, port = start_server(workdir, mode, args.workers)
+            try:
+                result = run_load(port, args.concurrency, args.duration, mix, args.seed, proc.pid)
+                print_load(mode, result)
+                if args.per_endpoint:
+                    # One endpoint at a time, so each gets its own throughput and RSS figures
+                    result['isolated'] = {}
+                    for label, builder, _ in mix:
+                        isolated = run_load(port, args.concurrency, args.duration, [(label, builder, 1)],
+                                            args.seed, proc.pid)
+                        print_load(label, isolated, endpoints=False)
+                        # Its only endpoint's figures are the run's own
+                        del isolated['endpoints']
+                        result['isolated'][label] = isolated
+            finally:
+                stop_server(proc)
+        results[mode] = result
+    return results
+
+
+def generate_dataset(analytics: TrafficAnalytics, pageviews: int, days: int = 60, seed: int = 1,
+                     chunk_size: int = 50000):
+    """Write synthetic history straight into the tables, bypassing the ingest queue"""
+    rng = random.Random(seed)
+    now = datetime.now()
+    span = days * 86400
+    sources = ['Direct', 'Organic', 'Referral', 'Social', 'Paid']
+
+    written = 0
+    while written < pageviews:
+        count = min(chunk_size, pageviews - written)
+        pageview_rows = []
+        source_rows = []
+        heatmap_rows = []
+        event_rows = []
+        for i in range(count):
+            timestamp = now - timedelta(seconds=rng.randrange(span))
+            code, name, city = rng.choice(REGIONS)
+            session_id = f"session_{rng.randrange(pageviews // 3 + 1)}"
+            url = zipf_url(rng)
+            pageview_rows.append((
+                None, session_id, url, timestamp, SAMPLE_USER_AGENTS[i % len(SAMPLE_USER_AGENTS)],
+                f"10.0.{rng.randint(0, 255)}.{rng.randint(1, 254)}",
+                rng.choice(['google.com', 'facebook.com', 'twitter.com', 'direct']),
+                rng.randint(5, 300), rng.random() < 0.4,
+                code, name, city, name, rng.uniform(-90, 90), rng.uniform(-180, 180)
+            ))
+            if i % 3 == 0:
+                source_rows.append((
+                    str(uuid.uuid4()), session_id, rng.choice(sources), 'Google', 'brand', 'organic',
+                    'web analytics', timestamp, code, city
+                ))
+            # About one pageview in 16 produces a burst, averaging half a point per pageview
+            if rng.random() < 1 / 16:
+                heatmap_rows.extend((None,) + point + (code, city) for point in heatmap_burst(rng, url, timestamp))
+            if i % 4 == 0:
+                event_rows.append((
+                    None, session_id, rng.choice(['click', 'signup', 'add_to_cart']), '{}',
+                    timestamp, url, code, city
+                ))
+        with analytics.db.writer() as conn:
+            for table, rows in (('pageviews', pageview_rows), ('heatmaps', heatmap_rows), ('events', event_rows)):
+                analytics.ingest.insert(conn, table, rows)
+            conn.executemany('''
+                INSERT INTO traffic_sources (id, session_id, source_type, source_name, campaign, medium, term, timestamp, country_code, city)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', source_rows)
+        written += count
+    analytics.rebuild_rollups()
+    with analytics.db.writer() as conn:
+        conn.execute('ANALYZE')
+
+
+# Every query the dashboard issues, as (label, call)
+DASHBOARD_CALLS = [
+    ('summary 24h', lambda a: a.get_analytics_summary(None, '24h')),
+    ('summary 30d', lambda a: a.get_analytics_summary(None, '30d')),
+    ('summary url 7d', lambda a: a.get_analytics_summary('https://example.com/products', '7d')),
+    ('realtime', lambda a: a.get_real_time_data()),
+    ('regions 24h', lambda a: a.get_region_wise_analytics('24h')),
+    ('regions country 7d', lambda a: a.get_region_wise_analytics('7d', 'US')),
+    ('regions city 30d', lambda a: a.get_region_wise_analytics('30d', 'US', 'New York')),
+    ('heatmap', lambda a: a.get_heatmap_data('https://example.com/products')),
+    ('heatmap filtered', lambda a: a.get_heatmap_data('https://example.com/products', '7d', 'US', None, 'click')),
+    ('funnel 30d', lambda a: a.get_conversion_funnel('default', '30d')),
+    ('top pages 30d', lambda a: a.get_top_items('page', '30d')),
+    ('top cities 7d', lambda a: a.get_top_items('city', '7d')),
+]
+
+# Tables whose full scans grow with traffic history; weekly log partitions
+# (pageview_log_20240101, ...) are checked under their log's name
+HISTORY_TABLES = ('pageview_log', 'event_log', 'traffic_sources', 'heatmap_log',
+                  'rollup_minute', 'rollup_hour', 'rollup_day', 'heatmap_tiles', 'funnel_counts',
+                  'funnel_progress', 'visitor_sketches_hour', 'visitor_sketches_day', 'top_k_hour', 'top_k_day',
+                  'time_on_page_bins_hour', 'time_on_page_bins_day')
+
+
+def capture_queries(analytics: TrafficAnalytics, call) -> List[str]:
+    """Run a get_* call and return the SELECT statements it sent to SQLite"""
+    statements = []
+    with analytics.db.reader() as conn:
+        # The pool holds a single reader, so the call below reuses this connection
+        conn.set_trace_callback(statements.append)
+    try:
+        result = call(analytics)
+    finally:
+        with analytics.db.reader() as conn:
+            conn.set_trace_callback(None)
+    if not result.get('success'):
+        raise RuntimeError(result.get('error'))
+    return [sql for sql in statements if sql.lstrip().upper().startswith('SELECT')]
+
+
+def check_plans(args) -> Dict:
+    """Fail when any dashboard query plans a full SCAN of a history table"""
+    results = {}
+    violations = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        analytics = TrafficAnalytics(os.path.join(workdir, 'plans.db'), read_connections=1)
+        started = time.time()
+        generate_dataset(analytics, args.rows, seed=args.seed)
+        print(f"Generated {args.rows} pageviews in {time.time() - started:.1f}s")
+        try:
+            for label, call in DASHBOARD_CALLS:
+                plans = []
+                for sql in capture_queries(analytics, call):
+                    with analytics.db.reader() as conn:
+                        details = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+                    scans = [detail for detail in details
+                             if detail.startswith('SCAN ')
+                             and re.sub(r'_\d{8}$', '', detail.split()[1]) in HISTORY_TABLES]
+                    violations += len(scans)
+                    plans.append({'sql': ' '.join(sql.split()), 'plan': details, 'scans': scans})
+                    status = 'FAIL' if scans else 'ok'
+                    print(f"{status:>4}  {label:<20} {'; '.join(details)}")
+                results[label] = plans
+        finally:
+            analytics.close()
+    print(f"{violations} full table scan(s)")
+    if violations:
+        raise SystemExit(1)
+    return results
+
+
+def legacy_summary(conn, url: Optional[str], start_time: datetime) -> Dict:
+    """get_analytics_summary as it was before the rollups: six raw-table queries"""
+    cursor = conn.cursor()
+    pattern = f'%{url}%' if url else None
+    cursor.execute('SELECT COUNT(*) FROM pageviews WHERE timestamp >= ? AND (? IS NULL OR url LIKE ?)',
+                   (start_time, url, pattern))
+    pageviews = cursor.fetchone()[0]
+    cursor.execute('SELECT COUNT(DISTINCT session_id) FROM pageviews WHERE timestamp >= ? AND (? IS NULL OR url LIKE ?)',
+                   (start_time, url, pattern))
+    unique_visitors = cursor.fetchone()[0]
+    cursor.execute('SELECT COUNT(*) FROM pageviews WHERE timestamp >= ? AND bounce = 1 AND (? IS NULL OR url LIKE ?)',
+                   (start_time, url, pattern))
+    bounces = cursor.fetchone()[0]
+    cursor.execute('SELECT AVG(time_on_page) FROM pageviews WHERE timestamp >= ? AND (? IS NULL OR url LIKE ?)',
+                   (start_time, url, pattern))
+    avg_duration = cursor.fetchone()[0] or 0
+    cursor.execute('SELECT source_type, COUNT(*) FROM traffic_sources WHERE timestamp >= ? GROUP BY source_type',
+                   (start_time,))
+    traffic_sources = dict(cursor.fetchall())
+    cursor.execute('SELECT url, COUNT(*) as count FROM pageviews WHERE timestamp >= ? GROUP BY url ORDER BY count DESC LIMIT 10',
+                   (start_time,))
+    top_pages = cursor.fetchall()
+    return {'pageviews': pageviews, 'unique_visitors': unique_visitors, 'bounces': bounces,
+            'avg_duration': avg_duration, 'traffic_sources': traffic_sources, 'top_pages': top_pages}
+
+
+def timed(call, repeat: int) -> float:
+    """Median wall time of `repeat` calls, in milliseconds"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        samples.append((time.perf_counter() - started) * 1000)
+    return round(percentile(samples, 50), 2)
+
+
+SUMMARY_CASES = [
+    ('24h', None),
+    ('7d', None),
+    ('30d', None),
+    ('7d', 'https://example.com/products'),
+]
+
+
+def bench_summary(args) -> Dict:
+    """Latency of get_analytics_summary against the pre-rollup six-query path"""
+    results = {}
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as workdir:
+            analytics = TrafficAnalytics(os.path.join(workdir, 'summary.db'))
+            try:
+                started = time.time()
+                generate_dataset(analytics, rows, seed=args.seed)
+                print(f"{rows} pageviews generated in {time.time() - started:.1f}s")
+                results[rows] = {}
+                for time_range, url in SUMMARY_CASES:
+                    start_time = analytics._time_range_start(time_range)
+
+                    def run_legacy():
+                        with analytics.db.reader() as conn:
+                            legacy_summary(conn, url, start_time)
+
+                    def run_current():
+                        result = analytics.get_analytics_summary(url, time_range)
+                        if not result['success']:
+                            raise RuntimeError(result['error'])
+
+                    label = time_range + (' url' if url else '')
+                    legacy_ms = timed(run_legacy, args.repeat)
+                    current_ms = timed(run_current, args.repeat)
+                    results[rows][label] = {'legacy_ms': legacy_ms, 'current_ms': current_ms}
+                    print(f"  {label:<8} legacy {legacy_ms:>10} ms   current {current_ms:>10} ms   "
+                          f"x{legacy_ms / current_ms if current_ms else 0:.1f}")
+            finally:
+                analytics.close()
+    return results
+
+
+# Region and heatmap calls whose result shaping depends on the aggregation backend
+BACKEND_CALLS = [
+    ('regions 30d', lambda a: a.get_region_wise_analytics('30d')),
+    ('regions country 30d', lambda a: a.get_region_wise_analytics('30d', 'US')),
+    ('heatmap', lambda a: a.get_heatmap_data('https://example.com/products')),
+    ('heatmap finest 30d', lambda a: a.get_heatmap_data('https://example.com/products', '30d', level=0)),
+]
+
+
+def bench_backends(args) -> Dict:
+    """Latency of region and heatmap analytics with each available aggregation backend"""
+    backends = ['python'] + (['numpy'] if numpy is not None else [])
+    if numpy is None:
+        print("NumPy is not installed; timing the python backend only")
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        analytics = TrafficAnalytics(os.path.join(workdir, 'backends.db'))
+        try:
+            started = time.time()
+            generate_dataset(analytics, args.rows, seed=args.seed)
+            print(f"{args.rows} pageviews generated in {time.time() - started:.1f}s")
+            for label, call in BACKEND_CALLS:
+                results[label] = {}
+                for backend in backends:
+                    analytics.aggregation_backend = backend
+                    results[label][backend] = timed(lambda: call(analytics), args.repeat)
+                print(f"  {label:<20} " + "   ".join(f"{backend} {ms:>9} ms" for backend, ms in results[label].items()))
+        finally:
+            analytics.close()
+    return results
+
+
+def bench_soak(args) -> Dict:
+    """Track pageviews from a stream of short-lived visitors and sample RSS as sessions expire.
+    
+    The session store runs on a simulated clock that advances --step seconds per
+    pageview, so hours of traffic pass in one run.
+    """
+    samples = []
+    with tempfile.TemporaryDirectory() as workdir:
+        analytics = TrafficAnalytics(os.path.join(workdir, 'soak.db'),
+                                     session_idle_timeout=args.idle_timeout, max_sessions=args.max_sessions,
+                                     sqlite_cache_size=args.sqlite_cache_size, sqlite_mmap_size=args.sqlite_mmap_size,
+                                     # Bounded by a five-minute wall-clock window, which a
+                                     # compressed run never gets past
+                                     realtime_counters=False)
+        simulated = [time.time()]
+        analytics.sessions.clock = lambda: simulated[0]
+        user_agents = [f"Mozilla/5.0 (soak {n})" for n in range(50)]
+        try:
+            started = time.time()
+            for i in range(args.pageviews):
+                visitor = i // args.pages_per_session
+                pageview = {
+                    'url': SAMPLE_URLS[i % len(SAMPLE_URLS)],
+                    'ip_address': f"10.{(visitor >> 16) & 255}.{(visitor >> 8) & 255}.{visitor & 255}",
+                    'user_agent': user_agents[visitor % len(user_agents)],
+                    'time_on_page': 30
+                }
+                while 'retry_after' in analytics.track_pageview(pageview):
+                    time.sleep(0.05)
+                simulated[0] += args.step
+                if (i + 1) % args.sample_every == 0:
+                    analytics.sessions.expire()
+                    sample = {
+                        'pageviews': i + 1,
+                        'rss_mb': round(process_rss() / 2 ** 20, 1),
+                        'live_sessions': len(analytics.sessions),
+                        'closed_sessions': analytics.sessions.stats['expired'] + analytics.sessions.stats['evicted'],
+                        'rate': round((i + 1) / (time.time() - started))
+                    }
+                    samples.append(sample)
+                    print(f"  {sample['pageviews']:>10} pageviews  rss {sample['rss_mb']:>7} MB  "
+                          f"live {sample['live_sessions']:>7}  closed {sample['closed_sessions']:>9}  "
+                          f"{sample['rate']}/s")
+            analytics.ingest.flush()
+        finally:
+            analytics.close()
+    
+    if len(samples) >= 4:
+        # Ignore warm-up (SQLite page cache, interned strings) before the first quarter
+        settled = samples[len(samples) // 4:]
+        growth = settled[-1]['rss_mb'] - settled[0]['rss_mb']
+        print(f"RSS change after warm-up: {growth:+.1f} MB over "
+              f"{settled[-1]['pageviews'] - settled[0]['pageviews']} pageviews")
+    return {'samples': samples}
+
+
+def database_size(analytics: TrafficAnalytics) -> Dict:
+    """Bytes used by the database file and, where SQLite has dbstat, by each table and index"""
+    with analytics.db.writer() as conn:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        used = page_size * (conn.execute('PRAGMA page_count').fetchone()[0] -
+                            conn.execute('PRAGMA freelist_count').fetchone()[0])
+        try:
+            objects = dict(conn.execute('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name ORDER BY 2 DESC'))
+        except sqlite3.OperationalError:
+            objects = {}
+    return {'bytes': used, 'objects': objects}
+
+
+def bench_storage(args) -> Dict:
+    """Database size per pageview and dashboard query latency for the current storage layout"""
+    results = {}
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as workdir:
+            analytics = TrafficAnalytics(os.path.join(workdir, 'storage.db'))
+            try:
+                started = time.time()
+                generate_dataset(analytics, rows, seed=args.seed)
+                print(f"{rows} pageviews generated in {time.time() - started:.1f}s")
+                size = database_size(analytics)
+                queries = {label: timed(lambda: call(analytics), args.repeat) for label, call in DASHBOARD_CALLS}
+            finally:
+                analytics.close()
+        results[rows] = {'bytes': size['bytes'], 'bytes_per_pageview': round(size['bytes'] / rows, 1),
+                         'objects': size['objects'], 'queries_ms': queries}
+        print(f"  database {size['bytes'] / 1048576:.1f} MiB, {size['bytes'] / rows:.0f} bytes per pageview")
+        for name, used in list(size['objects'].items())[:8]:
+            print(f"    {name:<34} {used / 1048576:>9.1f} MiB")
+        for label, ms in queries.items():
+            print(f"  {label:<20} {ms:>9} ms")
+    return results
+
+
+def tracked_journeys(sessions: int, seed: int = 1) -> List[Tuple[str, Tuple]]:
+    """Ingest queue items for sessions walking the default funnel with drop-off, in time order"""
+    rng = random.Random(seed)
+    now = datetime.now()
+    items = []
+    for i in range(sessions):
+        session_id = f"journey_{i}"
+        moment = now - timedelta(seconds=rng.randrange(6 * 86400))
+        path = [('pageviews', rng.choice(SAMPLE_URLS))]
+        for kind, value in (('pageviews', 'https://example.com/products'), ('events', 'add_to_cart'),
+                            ('events', 'checkout'), ('events', 'purchase')):
+            if rng.random() < 0.4:
+                break
+            path.append((kind, value))
+        for kind, value in path:
+            # Some sessions dawdle past the one hour window
+            moment += timedelta(seconds=rng.choice([5, 60, 600, 2400]))
+            if kind == 'pageviews':
+                row = (None, session_id, value, moment, 'Mozilla/5.0', '10.0.0.1', 'direct', 30, False,
+                       'US', 'United States', 'New York', 'United States', 0.0, 0.0)
+            else:
+                row = (None, session_id, value, '{}', moment, 'https://example.com/products', 'US', 'New York')
+            items.append((kind, row))
+    items.sort(key=lambda item: item[1][3] if item[0] == 'pageviews' else item[1][4])
+    return items
+
+
+def bench_funnels(args) -> Dict:
+    """Funnel rebuild throughput, query latency, and incremental counts checked against a rebuild"""
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        analytics = TrafficAnalytics(os.path.join(workdir, 'funnels.db'))
+        try:
+            started = time.time()
+            generate_dataset(analytics, args.rows, seed=args.seed)
+            print(f"{args.rows} pageviews generated in {time.time() - started:.1f}s")
+
+            items = tracked_journeys(args.sessions, seed=args.seed)
+            started = time.time()
+            for offset in range(0, len(items), 10000):
+                analytics.ingest.put_many(items[offset:offset + 10000])
+                analytics.ingest.flush()
+            results['tracked_rows_per_sec'] = round(len(items) / (time.time() - started))
+            incremental = {time_range: analytics.get_conversion_funnel('default', time_range)['data']['steps']
+                           for time_range in ('24h', '7d', '30d')}
+
+            started = time.time()
+            with analytics.db.writer() as conn:
+                analytics.funnels.rebuild(conn, 'default')
+            results['rebuild_s'] = round(time.time() - started, 2)
+            analytics.response_cache.clear()
+            rebuilt = {time_range: analytics.get_conversion_funnel('default', time_range)['data']['steps']
+                       for time_range in ('24h', '7d', '30d')}
+            results['matches_rebuild'] = incremental == rebuilt
+            results['queries_ms'] = {time_range: timed(lambda: analytics.get_conversion_funnel('default', time_range),
+                                                       args.repeat)
+                                     for time_range in ('24h', '7d', '30d')}
+        finally:
+            analytics.close()
+    print(f"  {len(items)} tracked rows at {results['tracked_rows_per_sec']} rows/s; "
+          f"incremental counts {'match' if results['matches_rebuild'] else 'DIFFER from'} a rebuild")
+    print(f"  rebuild {results['rebuild_s']} s")
+    for time_range, steps in rebuilt.items():
+        print(f"  {time_range:<4} {results['queries_ms'][time_range]:>7} ms  " +
+              ' > '.join(str(step['visitors']) for step in steps))
+    if not results['matches_rebuild']:
+        raise SystemExit(1)
+    return results
+
+
+def beacon_user_agents(beacons: int, distinct: int, seed: int = 1) -> List[str]:
+    """A beacon stream of `distinct` user agents with a long tail, like real traffic"""
+    rng = random.Random(seed)
+    agents = [f"{SAMPLE_USER_AGENTS[n % len(SAMPLE_USER_AGENTS)]} build/{n}" for n in range(distinct)]
+    # Pareto ranks: a few agents carry most beacons
+    return [agents[min(distinct - 1, int(rng.paretovariate(1.2)) - 1)] for _ in range(beacons)]
+
+
+def bench_useragents(args) -> Dict:
+    """Per-beacon user agent classification cost, uncached vs memoized"""
+    stream = beacon_user_agents(args.beacons, args.distinct, seed=args.seed)
+    uncached = classify_user_agent.__wrapped__
+    results = {}
+    for label, classify in (('uncached', uncached), ('memoized', classify_user_agent)):
+        classify_user_agent.cache_clear()
+        started = time.perf_counter()
+        for user_agent in stream:
+            classify(user_agent)
+        elapsed = time.perf_counter() - started
+        results[label] = {'ns_per_beacon': round(elapsed / len(stream) * 1e9)}
+    info = classify_user_agent.cache_info()
+    results['memoized']['hit_rate'] = round(info.hits / (info.hits + info.misses), 4)
+    results['memoized']['cached_agents'] = info.currsize
+    print(f"{len(stream)} beacons, {len(set(stream))} distinct user agents")
+    for label, stats in results.items():
+        extra = f"  hit rate {stats['hit_rate']:.1%}" if 'hit_rate' in stats else ''
+        print(f"  {label:<9} {stats['ns_per_beacon']:>7} ns/beacon{extra}")
+    return results
+
+
+GEOIP_LOCATIONS = [
+    ('US', 'United States', 'New York', 'New York', 40.7128, -74.006),
+    ('US', 'United States', 'Los Angeles', 'California', 34.0522, -118.2437),
+    ('GB', 'United Kingdom', 'London', 'England', 51.5074, -0.1278),
+    ('DE', 'Germany', 'Berlin', 'Berlin', 52.52, 13.405),
+    ('FR', 'France', 'Paris', 'Ile-de-France', 48.8566, 2.3522),
+    ('IN', 'India', 'Mumbai', 'Maharashtra', 19.076, 72.8777),
+    ('JP', 'Japan', 'Tokyo', 'Tokyo', 35.6762, 139.6503),
+    ('BR', 'Brazil', 'São Paulo', 'São Paulo', -23.5505, -46.6333),
+    ('AU', 'Australia', 'Sydney', 'New South Wales', -33.8688, 151.2093),
+    ('CA', 'Canada', 'Toronto', 'Ontario', 43.6532, -79.3832)
+]
+
+
+def write_geoip_csv(path: str, ranges: int, seed: int = 1) -> List[Tuple[int, int]]:
+    """Write a GeoIP CSV of `ranges` IPv4 ranges spread over the address space; returns their (first, last)"""
+    rng = random.Random(seed)
+    step = (1 << 32) // ranges
+    spans = []
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['network', 'country_code', 'country_name', 'city', 'region', 'latitude', 'longitude'])
+        for n in range(ranges):
+            first = n * step
+            last = first + rng.randrange(1, step)
+            spans.append((first, last))
+            writer.writerow([f"{ipaddress.IPv4Address(first)}-{ipaddress.IPv4Address(last)}"] +
+                            list(GEOIP_LOCATIONS[n % len(GEOIP_LOCATIONS)]))
+    return spans
+
+
+def bench_geoip(args) -> Dict:
+    """GeoIP index compile and open time, and per-beacon lookup cost uncached vs memoized"""
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        csv_path = os.path.join(workdir, 'geoip.csv')
+        spans = write_geoip_csv(csv_path, args.ranges, seed=args.seed)
+        started = time.perf_counter()
+        compile_geoip(csv_path, csv_path + '.idx')
+        results['compile_s'] = round(time.perf_counter() - started, 2)
+        results['index_bytes'] = os.path.getsize(csv_path + '.idx')
+        started = time.perf_counter()
+        geoip = GeoIndex.load(csv_path)
+        results['open_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        try:
+            rng = random.Random(args.seed)
+            # A long tail of visitors: a few addresses send most beacons
+            visitors = [str(ipaddress.IPv4Address(rng.randint(*spans[rng.randrange(len(spans))])))
+                        for _ in range(args.distinct)]
+            stream = [visitors[min(args.distinct - 1, int(rng.paretovariate(1.2)) - 1)] for _ in range(args.beacons)]
+            misses = sum(1 for ip in set(stream) if geoip.lookup(ip) is None)
+            geoip.lookup.cache_clear()
+            for label, lookup in (('uncached', geoip._lookup), ('memoized', geoip.lookup)):
+                started = time.perf_counter()
+                for ip in stream:
+                    lookup(ip)
+                results[label] = {'ns_per_beacon': round((time.perf_counter() - started) / len(stream) * 1e9)}
+            info = geoip.lookup.cache_info()
+            results['memoized']['hit_rate'] = round(info.hits / (info.hits + info.misses), 4)
+        finally:
+            geoip.close()
+    print(f"{args.ranges} ranges: compiled in {results['compile_s']} s to "
+          f"{results['index_bytes'] / 1048576:.1f} MiB, opened in {results['open_ms']} ms")
+    print(f"{len(stream)} beacons from {len(set(stream))} addresses, {misses} unplaced")
+    for label in ('uncached', 'memoized'):
+        stats = results[label]
+        extra = f"  hit rate {stats['hit_rate']:.1%}" if 'hit_rate' in stats else ''
+        print(f"  {label:<9} {stats['ns_per_beacon']:>7} ns/beacon{extra}")
+    if misses:
+        raise SystemExit(1)
+    return results
+
+
+# (label, time_range, URL prefix, country_code) unique visitor counts checked against COUNT(DISTINCT)
+SKETCH_CASES = [
+    ('24h', '24h', None, None),
+    ('7d', '7d', None, None),
+    ('30d', '30d', None, None),
+    ('30d url', '30d', 'https://example.com/products', None),
+    ('30d country', '30d', None, 'US'),
+]
+
+
+def bench_sketches(args) -> Dict:
+    """Unique visitor sketch accuracy and latency against COUNT(DISTINCT session_id), per precision"""
+    results = {}
+    worst = 0.0
+    for precision in args.precision:
+        with tempfile.TemporaryDirectory() as workdir:
+            analytics = TrafficAnalytics(os.path.join(workdir, 'sketches.db'), hll_precision=precision)
+            try:
+                started = time.time()
+                generate_dataset(analytics, args.rows, seed=args.seed)
+                print(f"{args.rows} pageviews generated in {time.time() - started:.1f}s, precision {precision}")
+                objects = database_size(analytics)['objects']
+                cases = {}
+                with analytics.db.reader() as conn:
+                    for label, time_range, url, country_code in SKETCH_CASES:
+                        start_time = analytics._time_range_start(time_range)
+                        sql = 'SELECT COUNT(DISTINCT session_id) FROM pageviews WHERE timestamp >= ?'
+                        params = [start_time]
+                        if url:
+                            sql += ' AND url >= ? AND url < ?'
+                            params += list(url_prefix_range(url))
+                        if country_code:
+                            sql += ' AND country_code = ?'
+                            params.append(country_code)
+                        if country_code:
+                            def estimate():
+                                return analytics.sketches.estimate_regions(conn, start_time, country_code)[1][country_code]
+                        else:
+                            def estimate():
+                                return analytics.sketches.estimate(conn, start_time, *(url_prefix_range(url) if url
+                                                                                        else (None, None)))
+                        exact = conn.execute(sql, params).fetchone()[0]
+                        estimated = estimate()
+                        error = (estimated - exact) / exact * 100 if exact else 0.0
+                        worst = max(worst, abs(error))
+                        cases[label] = {'exact': exact, 'estimate': estimated, 'error_pct': round(error, 2),
+                                        'sketch_ms': timed(estimate, args.repeat),
+                                        'count_distinct_ms': timed(lambda: conn.execute(sql, params).fetchone(),
+                                                                   args.repeat)}
+            finally:
+                analytics.close()
+        sketch_bytes = objects.get('visitor_sketches_hour', 0) + objects.get('visitor_sketches_day', 0)
+        results[precision] = {'sketch_bytes': sketch_bytes, 'cases': cases}
+        print(f"  sketches {sketch_bytes / 1048576:.1f} MiB; expected error {104 / 2 ** (precision / 2):.2f}%")
+        for label, case in cases.items():
+            print(f"  {label:<12} {case['estimate']:>9} vs {case['exact']:>9} ({case['error_pct']:+.2f}%)  "
+                  f"{case['sketch_ms']:>8} ms vs {case['count_distinct_ms']:>8} ms COUNT(DISTINCT)")
+    # Three standard errors of the least precise sketch
+    if worst > 3 * 104 / 2 ** (min(args.precision) / 2):
+        raise SystemExit(1)
+    return results
+
+
+def pageview_stream(pageviews: int, days: int, tail: float, seed: int = 1) -> List[Tuple[str, Tuple]]:
+    """Ingest queue items for pageviews over the last `days`, in time order; a `tail` share go to one-off URLs"""
+    rng = random.Random(seed)
+    now = datetime.now()
+    items = []
+    for _ in range(pageviews):
+        timestamp = now - timedelta(seconds=rng.randrange(days * 86400))
+        code, name, city = rng.choice(REGIONS)
+        url = f"https://example.com/search?q={rng.randrange(10 ** 9)}" if rng.random() < tail else zipf_url(rng)
+        items.append(('pageviews', (None, f"session_{rng.randrange(pageviews // 3 + 1)}", url, timestamp,
+                                    SAMPLE_USER_AGENTS[0], '10.0.0.1', 'direct', 30, False,
+                                    code, name, city, name, 0.0, 0.0)))
+    items.sort(key=lambda item: item[1][3])
+    return items
+
+
+def item_key(item: Dict) -> Tuple:
+    return item.get('url'), item.get('country_code'), item.get('city')
+
+
+def bench_topk(args) -> Dict:
+    """Top pages, cities and countries from the Space-Saving summaries against exact counts"""
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        analytics = TrafficAnalytics(os.path.join(workdir, 'topk.db'))
+        try:
+            items = pageview_stream(args.pageviews, args.days, args.tail, seed=args.seed)
+            started = time.time()
+            for offset in range(0, len(items), 10000):
+                analytics.ingest.put_many(items[offset:offset + 10000])
+                analytics.ingest.flush()
+            results['tracked_rows_per_sec'] = round(len(items) / (time.time() - started))
+            for dimension in ('page', 'city', 'country'):
+                for time_range in ('24h', '7d', '30d'):
+                    estimated = analytics.get_top_items(dimension, time_range, args.limit)['data']['items']
+                    exact = analytics.get_top_items(dimension, time_range, args.limit, True)['data']['items']
+                    counts = {item_key(item): item['pageviews'] for item in exact}
+                    found = [(item['pageviews'], counts[item_key(item)]) for item in estimated
+                             if item_key(item) in counts]
+                    results[f"{dimension} {time_range}"] = {
+                        'recall': round(len(found) / len(exact), 3) if exact else 1.0,
+                        'max_error_pct': round(max((abs(estimate - count) / count * 100 for estimate, count in found),
+                                                   default=0.0), 2),
+                        'top_k_ms': timed(lambda: analytics.get_top_items(dimension, time_range, args.limit),
+                                          args.repeat),
+                        'exact_ms': timed(lambda: analytics.get_top_items(dimension, time_range, args.limit, True),
+                                          args.repeat)
+                    }
+        finally:
+            analytics.close()
+    print(f"{len(items)} pageviews tracked at {results['tracked_rows_per_sec']} rows/s, "
+          f"{args.tail:.0%} to one-off URLs")
+    for label, stats in results.items():
+        if isinstance(stats, dict):
+            print(f"  {label:<13} recall {stats['recall']:>5.0%}  max error {stats['max_error_pct']:>5}%  "
+                  f"{stats['top_k_ms']:>7} ms vs {stats['exact_ms']:>7} ms exact")
+    return results
+
+
+# (label, time_range, URL prefix, country_code, city) time on page percentiles checked against sorted raw values
+DURATION_CASES = [
+    ('24h', '24h', None, None, None),
+    ('7d', '7d', None, None, None),
+    ('30d', '30d', None, None, None),
+    ('30d url', '30d', 'https://example.com/products', None, None),
+    ('30d country', '30d', None, 'US', None),
+    ('7d city', '7d', None, 'US', 'Chicago'),
+]
+
+
+def bench_durations(args) -> Dict:
+    """Time on page percentiles from the bin counts against sorted raw values, and incremental against rebuilt bins"""
+    rng = random.Random(args.seed)
+    items = []
+    # Skewed like real dwell times: mostly short, a long tail and some zeroes
+    for table, row in pageview_stream(args.pageviews, args.days, 0.0, seed=args.seed):
+        time_on_page = 0 if rng.random() < 0.05 else round(rng.lognormvariate(3.5, 1.0))
+        items.append((table, row[:7] + (time_on_page,) + row[8:]))
+    results = {}
+    worst = 0.0
+    with tempfile.TemporaryDirectory() as workdir:
+        analytics = TrafficAnalytics(os.path.join(workdir, 'durations.db'))
+        try:
+            started = time.time()
+            for offset in range(0, len(items), 10000):
+                analytics.ingest.put_many(items[offset:offset + 10000])
+                analytics.ingest.flush()
+            results['tracked_rows_per_sec'] = round(len(items) / (time.time() - started))
+            with analytics.db.reader() as conn:
+                for label, time_range, url, country_code, city in DURATION_CASES:
+                    start_time = analytics._time_range_start(time_range)
+                    sql = 'SELECT time_on_page FROM pageviews WHERE timestamp >= ? AND time_on_page IS NOT NULL'
+                    params = [start_time]
+                    if url:
+                        sql += ' AND url >= ? AND url < ?'
+                        params += list(url_prefix_range(url))
+                    if country_code:
+                        sql += ' AND country_code = ?'
+                        params.append(country_code)
+                    if city:
+                        sql += ' AND city = ?'
+                        params.append(city)
+                    if country_code:
+                        def estimate():
+                            return analytics.durations.region_percentiles(conn, start_time, country_code, city)
+                    else:
+                        def estimate():
+                            return analytics.durations.percentiles(conn, start_time, *(url_prefix_range(url) if url
+                                                                                      else (None, None)))
+                    values = sorted(value for value, in conn.execute(sql, params))
+                    estimated = estimate()
+                    case = {'values': len(values), 'sketch_ms': timed(estimate, args.repeat),
+                            'sort_ms': timed(lambda: conn.execute(sql + ' ORDER BY 1', params).fetchall(),
+                                             args.repeat)}
+                    for pct in DURATION_PERCENTILES:
+                        exact = values[int(pct / 100 * (len(values) - 1))]
+                        error = (estimated[f'p{pct}'] - exact) / exact * 100 if exact else estimated[f'p{pct}']
+                        worst = max(worst, abs(error))
+                        case[f'p{pct}'] = {'exact': exact, 'estimate': estimated[f'p{pct}'], 'error_pct': round(error, 2)}
+                    results[label] = case
+                before = [conn.execute(f'SELECT * FROM {table} ORDER BY 1, 2, 3, 4, 5').fetchall()
+                          for table in DURATION_TABLES]
+            analytics.rebuild_rollups()
+            with analytics.db.reader() as conn:
+                after = [conn.execute(f'SELECT * FROM {table} ORDER BY 1, 2, 3, 4, 5').fetchall()
+                         for table in DURATION_TABLES]
+            results['bin_rows'] = sum(len(rows) for rows in after)
+        finally:
+            analytics.close()
+    print(f"{len(items)} pageviews tracked at {results['tracked_rows_per_sec']} rows/s; "
+          f"{results['bin_rows']} bin rows, {'same as' if before == after else 'DIFFERENT from'} a rebuild")
+    for label, _, _, _, _ in DURATION_CASES:
+        case = results[label]
+        errors = '  '.join(f"p{pct} {case[f'p{pct}']['estimate']:>8} vs {case[f'p{pct}']['exact']:>5}"
+                           for pct in DURATION_PERCENTILES)
+        print(f"  {label:<12} {errors}  {case['sketch_ms']:>7} ms vs {case['sort_ms']:>7} ms sorted")
+    # Rounding the estimates to hundredths can add a little to the bins' bound
+    if before != after or worst > DURATION_ACCURACY * 100 + 0.1:
+        raise SystemExit(1)
+    return results
+
+
+def ns_per_call(call, calls: int, *call_args) -> int:
+    started = time.perf_counter()
+    for _ in range(calls):
+        call(*call_args)
+    return round((time.perf_counter() - started) / calls * 1e9)
+
+
+def bench_metrics(args) -> Dict:
+    """Cost of the /metrics instrumentation per update, per request, per SQLite statement and per scrape"""
+    registry = MetricsRegistry()
+    counter = registry.counter('bench_requests_total', 'Benchmark counter', ('method', 'endpoint', 'status'))
+    histogram = registry.histogram('bench_request_seconds', 'Benchmark histogram', ('method', 'endpoint'))
+    results = {
+        'counter_inc_ns': ns_per_call(counter.inc, args.calls, ('POST', '/track/pageview', 200)),
+        'histogram_observe_ns': ns_per_call(histogram.observe, args.calls, 0.0003, ('POST', '/track/pageview'))
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        analytics = TrafficAnalytics(os.path.join(workdir, 'metrics.db'))
+        try:
+            results['record_request_ns'] = ns_per_call(analytics.record_request, args.calls, 'POST',
+                                                       '/track/pageview', 200, False, 0.0003)
+            with analytics.db.reader() as conn:
+                # The cheapest statement shows the fixed cost of timing one
+                query_seconds = conn.query_seconds
+                results['sqlite_timed_ns'] = ns_per_call(conn.execute, args.calls, 'SELECT 1')
+                conn.query_seconds = None
+                results['sqlite_untimed_ns'] = ns_per_call(conn.execute, args.calls, 'SELECT 1')
+                conn.query_seconds = query_seconds
+            # Label sets like a server that has answered every endpoint with a few statuses
+            for endpoint in ('/track/pageview', '/track/batch', '/analytics/summary', '/analytics/regions',
+                             '/analytics/heatmap', '/analytics/top', '/analytics/funnel', 'other'):
+                for status in (200, 304, 500, 503):
+                    analytics.record_request('GET', endpoint, status, status >= 500, 0.002)
+            body = analytics.metrics.render()
+            results['render_bytes'] = len(body)
+            results['render_ms'] = timed(analytics.metrics.render, args.repeat)
+        finally:
+            analytics.close()
+    print(f"  counter inc        {results['counter_inc_ns']:>7} ns")
+    print(f"  histogram observe  {results['histogram_observe_ns']:>7} ns")
+    print(f"  record_request     {results['record_request_ns']:>7} ns per HTTP request")
+    print(f"  SQLite SELECT 1    {results['sqlite_timed_ns']:>7} ns timed vs {results['sqlite_untimed_ns']} ns untimed")
+    print(f"  render             {results['render_ms']:>7} ms for {results['render_bytes']} bytes")
+    # The budget for a counter on the /track path
+    if results['counter_inc_ns'] >= 1000:
+        raise SystemExit(1)
+    return results
+
+
+SLOWLOG_CASES = [
+    ('summary 24h', '/analytics/summary?time_range=24h', 'get_analytics_summary', {'time_range': '24h'}),
+    ('summary 30d', '/analytics/summary?time_range=30d', 'get_analytics_summary', {'time_range': '30d'}),
+    ('regions 7d', '/analytics/regions?time_range=7d', 'get_region_wise_analytics', {'time_range': '7d'}),
+    ('regions city 30d', '/analytics/regions?time_range=30d&country_code=US&city=New+York', 'get_region_wise_analytics',
+     {'time_range': '30d', 'country_code': 'US', 'city': 'New York'})
+]
+
+
+def bench_slowlog(args) -> Dict:
+    """Dashboard query latency untraced, traced for the slow request log and profiled, and the cost of logging"""
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        analytics = TrafficAnalytics(os.path.join(workdir, 'slowlog.db'))
+        try:
+            generate_dataset(analytics, args.rows, seed=args.seed)
+            slow_requests = SlowRequestLog(analytics.db, 0, os.path.join(workdir, 'slow.log'))
+            profiler = RequestProfiler(os.path.join(workdir, 'profiles'), 1)
+            for label, path, method, kwargs in SLOWLOG_CASES:
+                query = getattr(analytics, method)
+                query(**kwargs)
+                traces = []
+                
+                def traced():
+                    request_traces.trace = trace = RequestTrace()
+                    try:
+                        query(**kwargs)
+                    finally:
+                        request_traces.trace = None
+                    trace.mark('handle')
+                    traces.append(trace)
+                
+                def profiled():
+                    profile = profiler.start()
+                    try:
+                        query(**kwargs)
+                    finally:
+                        profiler.finish(profile, 'GET', path, 0)
+                
+                case = {
+                    'plain_ms': timed(lambda: query(**kwargs), args.repeat),
+                    'traced_ms': timed(traced, args.repeat),
+                    'profiled_ms': timed(profiled, args.repeat),
+                    'record_ms': timed(lambda: slow_requests.record('GET', path, 200, traces[-1], 1),
+                                     args.repeat)
+                }
+                entry = slow_requests.record('GET', path, 200, traces[-1], 1)
+                case['statements'] = len(entry['statements'])
+                case['sql_ms'] = entry['sql_ms']
+                results[label] = case
+                print(f"  {label:<18} plain {case['plain_ms']:>8} ms  traced {case['traced_ms']:>8} ms  "
+                      f"profiled {case['profiled_ms']:>8} ms  log entry {case['record_ms']:>6} ms "
+                      f"({case['statements']} statements, {case['sql_ms']} ms SQL)")
+            slowest = max(slow_requests.entries(), key=lambda entry: entry['sql_ms'])
+            print(f"  slowest statement of {slowest['path']}:")
+            statement = max(slowest['statements'], key=lambda statement: statement['ms'])
+            print(f"    {statement['ms']} ms  {statement['sql'][:100]}")
+            for detail in statement['plan'] or ():
+                print(f"      {detail}")
+            results['profiles_kept'] = len(profiler.names())
+        finally:
+            analytics.close()
+    return results
+
+
+def flatten_metrics(results, prefix: str = '') -> Dict[str, float]:
+    """Numeric leaves of a results tree as {'a/b/c': value}"""
+    if isinstance(results, dict):
+        metrics = {}
+        for key, value in results.items():
+            metrics.update(flatten_metrics(value, f"{prefix}/{key}" if prefix else str(key)))
+        return metrics
+    if isinstance(results, (int, float)) and not isinstance(results, bool):
+        return {prefix: results}
+    return {}
+
+
+def metric_direction(path: str) -> int:
+    """1 if a metric is better higher, -1 if better lower, 0 if it isn't a performance figure"""
+    if 'per_sec' in path or path.endswith('hit_rate'):
+        return 1
+    name = path.rsplit('/', 1)[-1]
+    if '/queries_ms/' in path or name.endswith(('_ms', '_s', '_ns', 'ns_per_beacon', '_bytes')) or \
+            name in ('bytes', 'bytes_per_pageview'):
+        return -1
+    return 0
+
+
+def compare_results(args) -> Dict:
+    """Compare two --json result files and fail on regressions beyond --threshold percent"""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline.get('command') != candidate.get('command'):
+        raise SystemExit(f"Can't compare {baseline.get('command')} results with {candidate.get('command')} results")
+    print(f"{baseline.get('commit') or args.baseline} -> {candidate.get('commit') or args.candidate}")
+    if baseline.get('args') != candidate.get('args'):
+        print('  warning: the runs used different arguments')
+    before = flatten_metrics(baseline['results'])
+    after = flatten_metrics(candidate['results'])
+    changes = {}
+    regressions = []
+    for path, old in before.items():
+        direction = metric_direction(path)
+        if not direction or path not in after or not old:
+            continue
+        change = (after[path] - old) / abs(old) * 100
+        changes[path] = round(change, 1)
+        regressed = change * direction < -args.threshold
+        if regressed:
+            regressions.append(path)
+        if regressed or abs(change) >= args.threshold:
+            print(f"  {'REGRESSED' if regressed else 'improved':<9} {path:<60} {old:>12} -> {after[path]:>12} "
+                  f"({change:+.1f}%)")
+    print(f"{len(changes)} metrics compared, {len(regressions)} regressed by more than {args.threshold}%")
+    if regressions:
+        raise SystemExit(1)
+    return {'changes_pct': changes, 'regressions': regressions}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SERVER_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='JADTrax benchmarks')
+    parser.add_argument('--json', help='Write results to this JSON file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    server = subparsers.add_parser('server', help='HTTP load test of the serving modes')
+    server.add_argument('--modes', nargs='+', default=['single', 'threaded', 'prefork'],
+                        choices=['single', 'threaded', 'prefork'])
+    server.add_argument('--concurrency', type=int, default=16)
+    server.add_argument('--duration', type=float, default=10.0)
+    server.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    server.add_argument('--rows', type=int, default=0, help='Pageviews of history generated before the load starts')
+    server.add_argument('--mix', nargs='+', metavar='ENDPOINT=WEIGHT',
+                        help=f"Traffic mix (default: the DEFAULT_MIX); endpoints: {', '.join(ENDPOINTS)}")
+    server.add_argument('--per-endpoint', action='store_true',
+                        help='After the mixed run, load each endpoint of the mix on its own')
+    server.add_argument('--seed', type=int, default=1)
+    server.set_defaults(func=bench_server)
+
+    plans = subparsers.add_parser('plans', help='Fail if a dashboard query full-scans a history table')
+    plans.add_argument('--rows', type=int, default=1000000)
+    plans.add_argument('--seed', type=int, default=1)
+    plans.set_defaults(func=check_plans)
+
+    summary = subparsers.add_parser('summary', help='get_analytics_summary latency vs the pre-rollup queries')
+    summary.add_argument('--rows', type=int, nargs='+', default=[1000000])
+    summary.add_argument('--repeat', type=int, default=5)
+    summary.add_argument('--seed', type=int, default=1)
+    summary.set_defaults(func=bench_summary)
+
+    backends = subparsers.add_parser('backends', help='region and heatmap latency per aggregation backend')
+    backends.add_argument('--rows', type=int, default=1000000)
+    backends.add_argument('--repeat', type=int, default=5)
+    backends.add_argument('--seed', type=int, default=1)
+    backends.set_defaults(func=bench_backends)
+
+    soak = subparsers.add_parser('soak', help='RSS over millions of tracked pageviews as sessions expire')
+    soak.add_argument('--pageviews', type=int, default=5000000)
+    soak.add_argument('--pages-per-session', type=int, default=5)
+    soak.add_argument('--step', type=float, default=0.01, help='Simulated seconds between pageviews')
+    soak.add_argument('--idle-timeout', type=float, default=1800)
+    soak.add_argument('--max-sessions', type=int, default=200000)
+    soak.add_argument('--sample-every', type=int, default=100000)
+    # Mapped database pages count towards RSS and grow with the file, which would hide the heap
+    soak.add_argument('--sqlite-mmap-size', type=int, default=0)
+    soak.add_argument('--sqlite-cache-size', type=int, default=-16384)
+    soak.set_defaults(func=bench_soak)
+
+    storage = subparsers.add_parser('storage', help='database size and dashboard latency for a generated history')
+    storage.add_argument('--rows', type=int, nargs='+', default=[1000000])
+    storage.add_argument('--repeat', type=int, default=5)
+    storage.add_argument('--seed', type=int, default=1)
+    storage.set_defaults(func=bench_storage)
+
+    funnels = subparsers.add_parser('funnels', help='funnel rebuild time, latency and incremental correctness')
+    funnels.add_argument('--rows', type=int, default=1000000)
+    funnels.add_argument('--sessions', type=int, default=100000, help='Funnel journeys tracked through ingest')
+    funnels.add_argument('--repeat', type=int, default=5)
+    funnels.add_argument('--seed', type=int, default=1)
+    funnels.set_defaults(func=bench_funnels)
+
+    useragents = subparsers.add_parser('useragents', help='per-beacon user agent classification cost')
+    useragents.add_argument('--beacons', type=int, default=1000000)
+    useragents.add_argument('--distinct', type=int, default=20000, help='Distinct user agents in the stream')
+    useragents.add_argument('--seed', type=int, default=1)
+    useragents.set_defaults(func=bench_useragents)
+
+    geoip = subparsers.add_parser('geoip', help='GeoIP index build time and per-beacon lookup cost')
+    geoip.add_argument('--ranges', type=int, default=1000000)
+    geoip.add_argument('--beacons', type=int, default=1000000)
+    geoip.add_argument('--distinct', type=int, default=100000, help='Distinct visitor addresses in the stream')
+    geoip.add_argument('--seed', type=int, default=1)
+    geoip.set_defaults(func=bench_geoip)
+
+    sketches = subparsers.add_parser('sketches', help='unique visitor sketch error and latency vs COUNT(DISTINCT)')
+    sketches.add_argument('--rows', type=int, default=1000000)
+    sketches.add_argument('--precision', type=int, nargs='+', default=[12], help='HyperLogLog precisions to compare')
+    sketches.add_argument('--repeat', type=int, default=5)
+    sketches.add_argument('--seed', type=int, default=1)
+    sketches.set_defaults(func=bench_sketches)
+
+    topk = subparsers.add_parser('topk', help='top pages, cities and countries: recall, error and latency vs exact')
+    topk.add_argument('--pageviews', type=int, default=1000000, help='Pageviews tracked through the ingest queue')
+    topk.add_argument('--days', type=int, default=30, help='Days the pageviews are spread over')
+    topk.add_argument('--tail', type=float, default=0.2, help='Share of pageviews to URLs seen only once')
+    topk.add_argument('--limit', type=int, default=10)
+    topk.add_argument('--repeat', type=int, default=5)
+    topk.add_argument('--seed', type=int, default=1)
+    topk.set_defaults(func=bench_topk)
+
+    durations = subparsers.add_parser('durations', help='time on page percentile error and latency vs sorting')
+    durations.add_argument('--pageviews', type=int, default=1000000, help='Pageviews tracked through the ingest queue')
+    durations.add_argument('--days', type=int, default=30, help='Days the pageviews are spread over')
+    durations.add_argument('--repeat', type=int, default=5)
+    durations.add_argument('--seed', type=int, default=1)
+    durations.set_defaults(func=bench_durations)
+
+    metrics = subparsers.add_parser('metrics', help='cost of the /metrics counters, histograms and SQLite timing')
+    metrics.add_argument('--calls', type=int, default=1000000, help='Calls timed per measurement')
+    metrics.add_argument('--repeat', type=int, default=5)
+    metrics.set_defaults(func=bench_metrics)
+
+    slowlog = subparsers.add_parser('slowlog', help='cost of slow request tracing, logging and profiling')
+    slowlog.add_argument('--rows', type=int, default=1000000)
+    slowlog.add_argument('--repeat', type=int, default=5)
+    slowlog.add_argument('--seed', type=int, default=1)
+    slowlog.set_defaults(func=bench_slowlog)
+
+    compare = subparsers.add_parser('compare', help='compare two --json result files, e.g. from two commits')
+    compare.add_argument('baseline')
+    compare.add_argument('candidate')
+    compare.add_argument('--threshold', type=float, default=10.0,
+                         help='Percent change counted as a regression')
+    compare.set_defaults(func=compare_results)
+
+    args = parser.parse_args(argv)
+    results = args.func(args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'command': args.command,
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'args': {key: value for key, value in vars(args).items() if key not in ('func', 'json')},
+                'results': results
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
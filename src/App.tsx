@@ -66,7 +66,7 @@ function App() {
       await fetchHeatmapData(formattedUrl);
       
       // Simulate tracking a pageview
-      await trackPageview({
+      trackPageview({
         url: formattedUrl,
         user_agent: navigator.userAgent,
         ip_address: '127.0.0.1',
@@ -1,20 +1,20 @@
 import React, { useRef, useEffect, useState } from 'react';
 import { MousePointer, Eye, Zap } from 'lucide-react';
-
-interface HeatmapData {
-  x: number;
-  y: number;
-  event_type: string;
-  intensity: number;
-}
+import { HeatmapData, HeatmapLayer } from '../hooks/useTrafficData';
 
 interface HeatmapVisualizerProps {
-  heatmapData: HeatmapData[];
+  heatmapData: HeatmapData | null;
   pageUrl: string;
   width?: number;
   height?: number;
 }
 
+// Decode a base64 density grid from /analytics/heatmap into its counts
+const decodeGrid = (layer: HeatmapLayer): Uint16Array | Uint32Array => {
+  const bytes = Uint8Array.from(atob(layer.grid), c => c.charCodeAt(0));
+  return layer.dtype === 'uint32' ? new Uint32Array(bytes.buffer) : new Uint16Array(bytes.buffer);
+};
+
 export const HeatmapVisualizer: React.FC<HeatmapVisualizerProps> = ({
   heatmapData,
   pageUrl,
@@ -26,7 +26,7 @@ export const HeatmapVisualizer: React.FC<HeatmapVisualizerProps> = ({
   const [maxIntensity, setMaxIntensity] = useState<number>(1);
 
   useEffect(() => {
-    if (!canvasRef.current || heatmapData.length === 0) return;
+    if (!canvasRef.current || !heatmapData || heatmapData.total === 0) return;
 
     const canvas = canvasRef.current;
     const ctx = canvas.getContext('2d');
@@ -35,36 +35,40 @@ export const HeatmapVisualizer: React.FC<HeatmapVisualizerProps> = ({
     // Clear canvas
     ctx.clearRect(0, 0, width, height);
 
+    // Sum the grids of the selected event types
+    const { columns, rows, cell_size: cellSize } = heatmapData;
+    const counts = new Float64Array(columns * rows);
+    Object.entries(heatmapData.event_types)
+      .filter(([type]) => selectedEventType === 'all' || type === selectedEventType)
+      .forEach(([, layer]) => {
+        decodeGrid(layer).forEach((count, i) => { counts[i] += count; });
+      });
+
     // Calculate max intensity for normalization
-    const maxInt = Math.max(...heatmapData.map(d => d.intensity));
+    const maxInt = counts.reduce((max, count) => Math.max(max, count), 0) || 1;
     setMaxIntensity(maxInt);
 
-    // Filter data by event type
-    const filteredData = selectedEventType === 'all' 
-      ? heatmapData 
-      : heatmapData.filter(d => d.event_type === selectedEventType);
-
-    // Create heatmap
-    filteredData.forEach(point => {
-      const intensity = point.intensity / maxInt;
-      const radius = Math.max(10, intensity * 50);
-      
-      // Create gradient
-      const gradient = ctx.createRadialGradient(
-        point.x, point.y, 0,
-        point.x, point.y, radius
-      );
-
-      const alpha = Math.min(0.8, intensity * 0.8);
-      gradient.addColorStop(0, `rgba(255, 0, 0, ${alpha})`);
-      gradient.addColorStop(0.5, `rgba(255, 165, 0, ${alpha * 0.7})`);
-      gradient.addColorStop(1, `rgba(255, 255, 0, ${alpha * 0.3})`);
-
-      ctx.fillStyle = gradient;
-      ctx.beginPath();
-      ctx.arc(point.x, point.y, radius, 0, 2 * Math.PI);
-      ctx.fill();
+    // Paint one pixel per cell, then scale it up; smoothing blends neighbouring cells.
+    // Cost depends on the grid size, not on how many points were tracked.
+    const grid = document.createElement('canvas');
+    grid.width = Math.max(columns, 1);
+    grid.height = Math.max(rows, 1);
+    const gridCtx = grid.getContext('2d');
+    if (!gridCtx) return;
+    const image = gridCtx.createImageData(grid.width, grid.height);
+    counts.forEach((count, i) => {
+      if (count === 0) return;
+      const intensity = count / maxInt;
+      // Yellow for the quietest cells through orange to red for the busiest
+      image.data[i * 4] = 255;
+      image.data[i * 4 + 1] = Math.round(255 * (1 - intensity));
+      image.data[i * 4 + 2] = 0;
+      image.data[i * 4 + 3] = Math.round(255 * Math.min(0.8, 0.15 + intensity * 0.8));
     });
+    gridCtx.putImageData(image, 0, 0);
+
+    ctx.imageSmoothingEnabled = true;
+    ctx.drawImage(grid, 0, 0, columns * cellSize, rows * cellSize);
 
     // Add page structure overlay
     ctx.strokeStyle = 'rgba(0, 0, 0, 0.1)';
@@ -93,7 +97,8 @@ export const HeatmapVisualizer: React.FC<HeatmapVisualizerProps> = ({
 
   }, [heatmapData, selectedEventType, width, height, maxIntensity]);
 
-  const eventTypes = ['all', ...new Set(heatmapData.map(d => d.event_type))];
+  const eventTypes = ['all', ...Object.keys(heatmapData?.event_types ?? {})];
+  const eventTotal = (type: string) => heatmapData?.event_types[type]?.total ?? 0;
 
   const getEventTypeIcon = (type: string) => {
     switch (type) {
@@ -184,7 +189,7 @@ export const HeatmapVisualizer: React.FC<HeatmapVisualizerProps> = ({
           <div className="flex items-center justify-between">
             <div>
               <p className="text-sm font-medium text-blue-600">Total Events</p>
-              <p className="text-2xl font-bold text-blue-900">{heatmapData.length}</p>
+              <p className="text-2xl font-bold text-blue-900">{heatmapData?.total ?? 0}</p>
             </div>
             <MousePointer className="w-8 h-8 text-blue-500" />
           </div>
@@ -195,7 +200,7 @@ export const HeatmapVisualizer: React.FC<HeatmapVisualizerProps> = ({
             <div>
               <p className="text-sm font-medium text-green-600">Click Events</p>
               <p className="text-2xl font-bold text-green-900">
-                {heatmapData.filter(d => d.event_type === 'click').length}
+                {eventTotal('click')}
               </p>
             </div>
             <MousePointer className="w-8 h-8 text-green-500" />
@@ -207,7 +212,7 @@ export const HeatmapVisualizer: React.FC<HeatmapVisualizerProps> = ({
             <div>
               <p className="text-sm font-medium text-purple-600">Scroll Events</p>
               <p className="text-2xl font-bold text-purple-900">
-                {heatmapData.filter(d => d.event_type === 'scroll').length}
+                {eventTotal('scroll')}
               </p>
             </div>
             <Eye className="w-8 h-8 text-purple-500" />
@@ -219,7 +224,7 @@ export const HeatmapVisualizer: React.FC<HeatmapVisualizerProps> = ({
             <div>
               <p className="text-sm font-medium text-orange-600">Hover Events</p>
               <p className="text-2xl font-bold text-orange-900">
-                {heatmapData.filter(d => d.event_type === 'hover').length}
+                {eventTotal('hover')}
               </p>
             </div>
             <Zap className="w-8 h-8 text-orange-500" />
@@ -231,7 +236,7 @@ export const HeatmapVisualizer: React.FC<HeatmapVisualizerProps> = ({
       <div className="mt-6 p-4 bg-gray-50 rounded-lg">
         <h4 className="text-sm font-medium text-gray-700 mb-2">Heatmap Insights</h4>
         <div className="space-y-2 text-sm text-gray-600">
-          {heatmapData.length > 0 ? (
+          {heatmapData && heatmapData.total > 0 ? (
             <>
               <p>• Most interactions occur in the top-left area of the page</p>
               <p>• Navigation elements show high click activity</p>
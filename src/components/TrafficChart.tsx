@@ -7,6 +7,7 @@ interface AnalyticsSummary {
   unique_visitors: number;
   bounce_rate: number;
   avg_session_duration: number;
+  duration_percentiles: Record<string, number | null>;
   traffic_sources: Record<string, number>;
   top_pages: Array<{ url: string; count: number }>;
   device_breakdown: Record<string, number>;
@@ -130,6 +131,11 @@ export const AnalyticsDashboard: React.FC<AnalyticsDashboardProps> = ({
           <p className="text-xs text-gray-500 mt-2">
             {analyticsSummary.avg_session_duration > 180 ? 'Excellent' : analyticsSummary.avg_session_duration > 60 ? 'Good' : 'Needs improvement'}
           </p>
+          {analyticsSummary.duration_percentiles?.p50 != null && (
+            <p className="text-xs text-gray-500">
+              Median {Math.round(analyticsSummary.duration_percentiles.p50)}s · p95 {Math.round(analyticsSummary.duration_percentiles.p95 ?? 0)}s
+            </p>
+          )}
         </div>
       </div>
 
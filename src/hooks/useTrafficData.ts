@@ -1,10 +1,11 @@
-import { useState, useEffect, useCallback } from 'react';
+import { useState, useEffect, useCallback, useRef } from 'react';
 
 export interface AnalyticsSummary {
   pageviews: number;
   unique_visitors: number;
   bounce_rate: number;
   avg_session_duration: number;
+  duration_percentiles: Record<string, number | null>;
   traffic_sources: Record<string, number>;
   top_pages: Array<{ url: string; count: number }>;
   device_breakdown: Record<string, number>;
@@ -40,11 +41,31 @@ export interface ConversionFunnel {
   total_conversion_rate: number;
 }
 
+// One event type's density grid: row-major little-endian counts, base64 encoded
+export interface HeatmapLayer {
+  total: number;
+  max: number;
+  dtype: 'uint16' | 'uint32';
+  grid: string;
+}
+
 export interface HeatmapData {
-  x: number;
-  y: number;
-  event_type: string;
-  intensity: number;
+  page_url: string;
+  level: number;
+  cell_size: number;
+  levels: number[];
+  columns: number;
+  rows: number;
+  total: number;
+  event_types: Record<string, HeatmapLayer>;
+}
+
+export interface HeatmapFilters {
+  timeRange?: string;
+  countryCode?: string;
+  city?: string;
+  eventType?: string;
+  level?: number;
 }
 
 export interface RegionalData {
@@ -77,6 +98,7 @@ export interface RegionWiseAnalytics {
   top_cities: TopCity[];
   traffic_sources: Record<string, number>;
   device_breakdown: Record<string, number>;
+  duration_percentiles: Record<string, number | null>;
   time_range: string;
   filter: {
     country_code: string | null;
@@ -94,14 +116,53 @@ export interface AvailableRegions {
   countries: AvailableRegion[];
 }
 
+export interface PageviewPayload {
+  url: string;
+  user_agent?: string;
+  ip_address?: string;
+  referrer?: string;
+  time_on_page?: number;
+  bounce?: boolean;
+}
+
+export interface EventPayload {
+  session_id?: string;
+  event_type: string;
+  event_data?: Record<string, unknown>;
+  page_url?: string;
+}
+
+export interface HeatmapPayload {
+  page_url: string;
+  x_coord: number;
+  y_coord: number;
+  event_type: string;
+}
+
+type TrackRecord =
+  | ({ type: 'pageview' } & PageviewPayload)
+  | ({ type: 'event' } & EventPayload)
+  | ({ type: 'heatmap' } & HeatmapPayload);
+
 const API_BASE_URL = 'http://localhost:8001';
 
+// Tracked records are buffered and sent to /track/batch together
+const BATCH_FLUSH_INTERVAL_MS = 5000;
+const BATCH_MAX_RECORDS = 100;
+// Records kept for retry while the server is unreachable
+const BATCH_MAX_PENDING = 2000;
+
+// The server sends a heartbeat every 15s; after this long without one the stream is treated as dead
+const STREAM_STALE_MS = 45000;
+// How long to poll before trying the stream again
+const STREAM_RETRY_MS = 60000;
+
 export const useTrafficData = () => {
   const [analyticsSummary, setAnalyticsSummary] = useState<AnalyticsSummary | null>(null);
   const [realTimeData, setRealTimeData] = useState<RealTimeData | null>(null);
   const [seoMetrics, setSeoMetrics] = useState<SEOMetrics | null>(null);
   const [conversionFunnel, setConversionFunnel] = useState<ConversionFunnel | null>(null);
-  const [heatmapData, setHeatmapData] = useState<HeatmapData[]>([]);
+  const [heatmapData, setHeatmapData] = useState<HeatmapData | null>(null);
   const [regionWiseAnalytics, setRegionWiseAnalytics] = useState<RegionWiseAnalytics | null>(null);
   const [availableRegions, setAvailableRegions] = useState<AvailableRegions | null>(null);
   const [isLoading, setIsLoading] = useState(false);
@@ -109,6 +170,7 @@ export const useTrafficData = () => {
   const [isServerConnected, setIsServerConnected] = useState(false);
   const [selectedTimeRange, setSelectedTimeRange] = useState<string>('24h');
   const [selectedUrl, setSelectedUrl] = useState<string>('');
+  const [isStreaming, setIsStreaming] = useState(false);
 
   // Check server connection
   const checkServer = useCallback(async () => {
@@ -225,9 +287,16 @@ export const useTrafficData = () => {
   }, []);
 
   // Fetch heatmap data
-  const fetchHeatmapData = useCallback(async (pageUrl: string) => {
+  const fetchHeatmapData = useCallback(async (pageUrl: string, filters: HeatmapFilters = {}) => {
     try {
-      const response = await fetch(`${API_BASE_URL}/analytics/heatmap?page_url=${encodeURIComponent(pageUrl)}`);
+      const params = new URLSearchParams({ page_url: pageUrl });
+      if (filters.timeRange) params.append('time_range', filters.timeRange);
+      if (filters.countryCode) params.append('country_code', filters.countryCode);
+      if (filters.city) params.append('city', filters.city);
+      if (filters.eventType) params.append('event_type', filters.eventType);
+      if (filters.level !== undefined) params.append('level', String(filters.level));
+
+      const response = await fetch(`${API_BASE_URL}/analytics/heatmap?${params}`);
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
@@ -243,104 +312,77 @@ export const useTrafficData = () => {
     }
   }, []);
 
-  // Track pageview
-  const trackPageview = useCallback(async (data: {
-    url: string;
-    user_agent?: string;
-    ip_address?: string;
-    referrer?: string;
-    time_on_page?: number;
-    bounce?: boolean;
-  }) => {
-    try {
-      const response = await fetch(`${API_BASE_URL}/track/pageview`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify(data),
-      });
-      
-      if (!response.ok) {
-        throw new Error(`HTTP error! status: ${response.status}`);
-      }
-      
-      const result = await response.json();
-      if (!result.success) {
-        throw new Error(result.error);
-      }
-      
-      return result.data;
-    } catch (err) {
-      console.error('Failed to track pageview:', err);
-      return null;
+  // Buffer of records waiting for the next /track/batch flush
+  const pendingRecords = useRef<TrackRecord[]>([]);
+
+  // Send buffered records; useBeacon survives the page being hidden or unloaded
+  const flushTrackingBatch = useCallback(async (useBeacon: boolean = false) => {
+    const records = pendingRecords.current;
+    if (records.length === 0) return;
+    pendingRecords.current = [];
+
+    const body = JSON.stringify(records);
+    // text/plain keeps sendBeacon a CORS-safelisted request; the server parses it as JSON
+    if (useBeacon && navigator.sendBeacon?.(`${API_BASE_URL}/track/batch`, new Blob([body], { type: 'text/plain' }))) {
+      return;
     }
-  }, []);
 
-  // Track custom event
-  const trackEvent = useCallback(async (data: {
-    session_id?: string;
-    event_type: string;
-    event_data?: Record<string, unknown>;
-    page_url?: string;
-  }) => {
+    const requeue = (unsent: TrackRecord[]) => {
+      pendingRecords.current = [...unsent, ...pendingRecords.current].slice(-BATCH_MAX_PENDING);
+    };
+
     try {
-      const response = await fetch(`${API_BASE_URL}/track/event`, {
+      const response = await fetch(`${API_BASE_URL}/track/batch`, {
         method: 'POST',
         headers: {
-          'Content-Type': 'application/json',
+          'Content-Type': 'text/plain',
         },
-        body: JSON.stringify(data),
+        body,
+        keepalive: true,
       });
-      
-      if (!response.ok) {
-        throw new Error(`HTTP error! status: ${response.status}`);
-      }
-      
+
       const result = await response.json();
-      if (!result.success) {
-        throw new Error(result.error);
+      if (response.status === 503) {
+        // Queue full on the server: keep what it did not queue, less the records it rejected
+        const rejected = new Set((result.errors ?? []).map((error: { index: number }) => error.index));
+        requeue(records.filter((_, index) => index >= (result.next_index ?? 0) && !rejected.has(index)));
+        return;
       }
-      
-      return result.data;
-    } catch (err) {
-      console.error('Failed to track event:', err);
-      return null;
-    }
-  }, []);
-
-  // Track heatmap data
-  const trackHeatmap = useCallback(async (data: {
-    page_url: string;
-    x_coord: number;
-    y_coord: number;
-    event_type: string;
-  }) => {
-    try {
-      const response = await fetch(`${API_BASE_URL}/track/heatmap`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify(data),
-      });
-      
-      if (!response.ok) {
-        throw new Error(`HTTP error! status: ${response.status}`);
+      if (!response.ok || !result.success) {
+        throw new Error(result.error || `HTTP error! status: ${response.status}`);
       }
-      
-      const result = await response.json();
-      if (!result.success) {
-        throw new Error(result.error);
+      if (result.errors?.length) {
+        console.error('Rejected tracking records:', result.errors);
       }
-      
-      return result.data;
     } catch (err) {
-      console.error('Failed to track heatmap data:', err);
-      return null;
+      console.error('Failed to send tracking batch:', err);
+      requeue(records);
     }
   }, []);
 
+  // Records are sent with the next batch, so there is no per-record result (or session_id) to return
+  const enqueueRecord = useCallback((record: TrackRecord): void => {
+    pendingRecords.current.push(record);
+    if (pendingRecords.current.length >= BATCH_MAX_RECORDS) {
+      flushTrackingBatch();
+    }
+  }, [flushTrackingBatch]);
+
+  // Track pageview
+  const trackPageview = useCallback((data: PageviewPayload): void => {
+    enqueueRecord({ type: 'pageview', ...data });
+  }, [enqueueRecord]);
+
+  // Track custom event
+  const trackEvent = useCallback((data: EventPayload): void => {
+    enqueueRecord({ type: 'event', ...data });
+  }, [enqueueRecord]);
+
+  // Track heatmap data
+  const trackHeatmap = useCallback((data: HeatmapPayload): void => {
+    enqueueRecord({ type: 'heatmap', ...data });
+  }, [enqueueRecord]);
+
   // Fetch region-wise analytics
   const fetchRegionWiseAnalytics = useCallback(async (timeRange: string = '24h', countryCode?: string, city?: string) => {
     try {
@@ -394,26 +436,118 @@ export const useTrafficData = () => {
     checkServer();
   }, [checkServer]);
 
-  // Auto-refresh real-time data
+  // Flush tracking records on an interval and when the page is hidden or closed
+  useEffect(() => {
+    const interval = setInterval(() => flushTrackingBatch(), BATCH_FLUSH_INTERVAL_MS);
+    const onVisibilityChange = () => {
+      if (document.visibilityState === 'hidden') {
+        flushTrackingBatch(true);
+      }
+    };
+    const onPageHide = () => flushTrackingBatch(true);
+
+    document.addEventListener('visibilitychange', onVisibilityChange);
+    window.addEventListener('pagehide', onPageHide);
+    return () => {
+      clearInterval(interval);
+      document.removeEventListener('visibilitychange', onVisibilityChange);
+      window.removeEventListener('pagehide', onPageHide);
+      flushTrackingBatch(true);
+    };
+  }, [flushTrackingBatch]);
+
   useEffect(() => {
     if (isServerConnected) {
-      fetchRealTimeData();
       fetchAvailableRegions();
+    }
+  }, [isServerConnected, fetchAvailableRegions]);
+
+  // Subscribe to pushed realtime and summary updates; the polling below covers any gaps
+  useEffect(() => {
+    if (!isServerConnected || typeof EventSource === 'undefined') {
+      return;
+    }
+
+    const params = new URLSearchParams({ time_range: selectedTimeRange });
+    if (selectedUrl) params.append('url', selectedUrl);
+
+    let source: EventSource | null = null;
+    let staleTimer: ReturnType<typeof setTimeout> | undefined;
+    let retryTimer: ReturnType<typeof setTimeout> | undefined;
+
+    const fallBackToPolling = () => {
+      source?.close();
+      source = null;
+      clearTimeout(staleTimer);
+      setIsStreaming(false);
+      retryTimer = setTimeout(connect, STREAM_RETRY_MS);
+    };
+
+    const markAlive = () => {
+      clearTimeout(staleTimer);
+      staleTimer = setTimeout(fallBackToPolling, STREAM_STALE_MS);
+    };
+
+    const connect = () => {
+      source = new EventSource(`${API_BASE_URL}/analytics/stream?${params}`);
+      markAlive();
+      source.onopen = () => {
+        setIsStreaming(true);
+        markAlive();
+      };
+      source.onerror = () => {
+        // EventSource retries on its own unless the server refused the stream
+        setIsStreaming(false);
+        if (source?.readyState === EventSource.CLOSED) {
+          fallBackToPolling();
+        }
+      };
+      source.addEventListener('heartbeat', markAlive);
+      source.addEventListener('realtime', (event) => {
+        markAlive();
+        const result = JSON.parse((event as MessageEvent).data);
+        if (result.success) setRealTimeData(result.data);
+      });
+      source.addEventListener('summary', (event) => {
+        markAlive();
+        const result = JSON.parse((event as MessageEvent).data);
+        if (result.success) setAnalyticsSummary(result.data);
+      });
+    };
+
+    connect();
+    return () => {
+      clearTimeout(staleTimer);
+      clearTimeout(retryTimer);
+      source?.close();
+      setIsStreaming(false);
+    };
+  }, [isServerConnected, selectedUrl, selectedTimeRange]);
+
+  // Poll real-time data while the stream is down
+  useEffect(() => {
+    if (isServerConnected && !isStreaming) {
+      fetchRealTimeData();
       const interval = setInterval(fetchRealTimeData, 30000); // Every 30 seconds
       return () => clearInterval(interval);
     }
-  }, [isServerConnected, fetchRealTimeData, fetchAvailableRegions]);
+  }, [isServerConnected, isStreaming, fetchRealTimeData]);
 
-  // Auto-refresh analytics summary
+  // Load the summary when the filters change, and poll it while the stream is down
   useEffect(() => {
     if (isServerConnected) {
       fetchAnalyticsSummary(selectedUrl, selectedTimeRange);
+    }
+  }, [isServerConnected, selectedUrl, selectedTimeRange, fetchAnalyticsSummary]);
+
+  useEffect(() => {
+    if (isServerConnected && !isStreaming) {
       const interval = setInterval(() => {
         fetchAnalyticsSummary(selectedUrl, selectedTimeRange);
       }, 60000); // Every minute
       return () => clearInterval(interval);
     }
-  }, [isServerConnected, selectedUrl, selectedTimeRange, fetchAnalyticsSummary]);
+  }, [isServerConnected, isStreaming, selectedUrl, selectedTimeRange, fetchAnalyticsSummary]);
 
   return {
     // Data
@@ -429,6 +563,7 @@ export const useTrafficData = () => {
     isLoading,
     error,
     isServerConnected,
+    isStreaming,
     selectedTimeRange,
     selectedUrl,
     
@@ -443,6 +578,7 @@ export const useTrafficData = () => {
     trackPageview,
     trackEvent,
     trackHeatmap,
+    flushTrackingBatch,
     checkServer,
     fetchRegionWiseAnalytics,
     fetchAvailableRegions,